@@ -621,7 +621,7 @@ class MuJsonTransfer(TransferBase):
 					logging.error(e)
 				try:
 					if 'forbidden_port' in row:
-						row['forbidden_port'] = common.PortRange(row['forbidden_port'])
+						row['forbidden_port'] = common.get_port_range(row['forbidden_port'])
 				except Exception as e:
 					logging.error(e)
 
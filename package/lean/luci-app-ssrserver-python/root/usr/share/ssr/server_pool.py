@@ -25,7 +25,7 @@ import os
 import logging
 import struct
 import time
-from shadowsocks import shell, eventloop, tcprelay, udprelay, asyncdns, common
+from shadowsocks import shell, eventloop, tcprelay, udprelay, asyncdns, common, handover
 import threading
 import sys
 import traceback
@@ -47,7 +47,9 @@ class ServerPool(object):
 	def __init__(self):
 		shell.check_python()
 		self.config = shell.get_config(False)
-		self.dns_resolver = asyncdns.DNSResolver()
+		self.dns_resolver = asyncdns.DNSResolver(
+			self.config.get('black_hostname_list'),
+			self.config.get('black_hostname_file'))
 		if not self.config.get('dns_ipv6', False):
 			asyncdns.IPV6_CONNECTION_SUPPORT = False
 
@@ -58,8 +60,19 @@ class ServerPool(object):
 		self.udp_servers_pool = {}
 		self.udp_ipv6_servers_pool = {}
 		self.stat_counter = {}
+		self.handed_over = False
 
 		self.loop = eventloop.EventLoop()
+		handover_path = self.config.get('handover_socket', None)
+		if handover_path and not handover.supported:
+			logging.warn('handover needs python 3.3 or newer')
+			handover_path = None
+		if handover_path:
+			if handover.receive(handover_path):
+				# ports are created as the db thread reads the users
+				self.loop.call_later(handover.HANDOVER_CLAIM_TIMEOUT, handover.close_unclaimed)
+			drain_timeout = self.config.get('handover_drain_timeout', handover.HANDOVER_DRAIN_TIMEOUT)
+			handover.HandoverServer(handover_path, self._handover_relays, self.loop.stop, drain_timeout).add_to_loop(self.loop)
 		self.thread = MainThread( (self.loop, self.dns_resolver, self.mgr) )
 		self.thread.start()
 
@@ -72,6 +85,12 @@ class ServerPool(object):
 	def stop(self):
 		self.loop.stop()
 
+	def _handover_relays(self):
+		# a new server took over, do not start new ports while draining
+		self.handed_over = True
+		return list(self.tcp_servers_pool.values()) + list(self.tcp_ipv6_servers_pool.values()) + \
+			list(self.udp_servers_pool.values()) + list(self.udp_ipv6_servers_pool.values())
+
 	@staticmethod
 	def _loop(loop, dns_resolver, mgr):
 		try:
@@ -109,6 +128,8 @@ class ServerPool(object):
 		ret = True
 		port = int(port)
 		ipv6_ok = False
+		if self.handed_over:
+			return 'handed over to a new server'
 
 		if 'server_ipv6' in self.config:
 			if port in self.tcp_ipv6_servers_pool:
@@ -254,6 +275,60 @@ class ServerPool(object):
 			ret[1] += d
 		return ret
 
+	def get_server_accept_stat(self, port):
+		port = int(port)
+		ret = {'accepted': 0, 'rejected': 0, 'backlog_full': 0, 'batch_exhausted': 0, 'limited': 0}
+		for pool in (self.tcp_servers_pool, self.tcp_ipv6_servers_pool):
+			if port in pool:
+				for k, v in pool[port].get_accept_stat().items():
+					ret[k] += v
+		return ret
+
+	def get_servers_accept_stat(self):
+		servers = self.tcp_servers_pool.copy()
+		servers.update(self.tcp_ipv6_servers_pool)
+		ret = {}
+		for port in servers.keys():
+			ret[port] = self.get_server_accept_stat(port)
+		return ret
+
+	def get_server_connect_stat(self, port):
+		port = int(port)
+		ret = {}
+		for pool in (self.tcp_servers_pool, self.tcp_ipv6_servers_pool):
+			if port in pool:
+				for dest, stat in pool[port].get_connect_stat().items():
+					if dest not in ret:
+						ret[dest] = stat
+						continue
+					for k in ('connected', 'failed', 'timeout', 'latency_sum'):
+						ret[dest][k] += stat[k]
+					ret[dest]['latency_max'] = max(ret[dest]['latency_max'], stat['latency_max'])
+		return ret
+
+	def get_server_buffered_stat(self, port):
+		port = int(port)
+		ret = {'up': 0, 'down': 0}
+		for pool in (self.tcp_servers_pool, self.tcp_ipv6_servers_pool):
+			if port in pool:
+				for k, v in pool[port].get_buffered_stat().items():
+					ret[k] += v
+		return ret
+
+	def get_servers_buffered_stat(self):
+		servers = self.tcp_servers_pool.copy()
+		servers.update(self.tcp_ipv6_servers_pool)
+		ret = {}
+		for port in servers.keys():
+			ret[port] = self.get_server_buffered_stat(port)
+		return ret
+
+	def get_dns_stat(self):
+		return self.dns_resolver.get_stat()
+
+	def get_dns_server_stat(self):
+		return self.dns_resolver.get_server_stat()
+
 	def get_server_mu_transfer(self, server):
 		return server.get_users_ud()
 
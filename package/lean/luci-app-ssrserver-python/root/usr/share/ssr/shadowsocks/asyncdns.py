@@ -19,6 +19,7 @@ from __future__ import absolute_import, division, print_function, \
     with_statement
 
 import os
+import time
 import socket
 import struct
 import re
@@ -31,9 +32,52 @@ if __name__ == '__main__':
     file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
     sys.path.insert(0, os.path.join(file_path, '../'))
 
-from shadowsocks import common, lru_cache, eventloop, shell
+from shadowsocks import common, eventloop, shell
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from shadowsocks.ordereddict import OrderedDict
 
 CACHE_SWEEP_INTERVAL = 30
+# at most this many names are cached, answers and failures alike, the least
+# recently used one goes first, so clients asking for random names can not
+# grow the cache until the entries expire
+DNS_CACHE_SIZE = 2048
+
+# answers are cached for the smallest TTL of their records, kept within
+# DNS_MIN_TTL and DNS_MAX_TTL
+DNS_MIN_TTL = 30
+DNS_MAX_TTL = 3600
+# names that do not resolve are cached for the TTL of the SOA record sent
+# along (rfc2308), DNS_NEGATIVE_TTL if there is none
+DNS_NEGATIVE_TTL = 30
+DNS_NEGATIVE_MAX_TTL = 300
+# a SERVFAIL or REFUSED is only cached briefly
+DNS_FAILURE_TTL = 5
+# a name hit DNS_PREFETCH_HITS times is queried again in the background when
+# less than DNS_PREFETCH_RATIO of its TTL is left, so callers keep hitting
+DNS_PREFETCH_HITS = 3
+DNS_PREFETCH_RATIO = 0.1
+
+# a query goes to the fastest healthy server, when it is not answered within
+# twice that server's smoothed RTT, DNS_MIN_TIMEOUT at least, it is sent to
+# the next one, the timeout doubling up to DNS_MAX_TIMEOUT
+# a query sent DNS_RETRIES times without an answer fails
+DNS_MIN_TIMEOUT = 0.3
+DNS_MAX_TIMEOUT = 2
+DNS_RETRIES = 4
+# a server that missed DNS_SERVER_MAX_FAILURES answers in a row is only
+# asked when no other is left, for DNS_SERVER_HOLD_DOWN seconds
+DNS_SERVER_MAX_FAILURES = 3
+DNS_SERVER_HOLD_DOWN = 30
+# with IPv6 the A and AAAA queries are sent together, once one family has
+# addresses the other one is waited for this long at most (rfc8305)
+DNS_RESOLUTION_DELAY = 0.05
+
+# black_hostname_file is read again when it has changed, which is checked
+# every BLOCKLIST_CHECK_INTERVAL seconds
+BLOCKLIST_CHECK_INTERVAL = 10
 
 VALID_HOSTNAME = re.compile(br"(?!-)[A-Z\d_-]{1,63}(?<!-)$", re.IGNORECASE)
 
@@ -75,8 +119,12 @@ QTYPE_A = 1
 QTYPE_AAAA = 28
 QTYPE_CNAME = 5
 QTYPE_NS = 2
+QTYPE_SOA = 6
 QCLASS_IN = 1
 
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
 
 def detect_ipv6_supprot():
     if 'has_ipv6' in dir(socket):
@@ -123,6 +171,11 @@ def parse_ip(addrtype, data, length, offset):
         return socket.inet_ntop(socket.AF_INET6, data[offset:offset + length])
     elif addrtype in [QTYPE_CNAME, QTYPE_NS]:
         return parse_name(data, offset)[1]
+    elif addrtype == QTYPE_SOA:
+        # MNAME and RNAME, then SERIAL, REFRESH, RETRY, EXPIRE and MINIMUM
+        p = offset + parse_name(data, offset)[0]
+        p += parse_name(data, p)[0]
+        return struct.unpack('!I', data[p + 16:p + 20])[0]
     else:
         return data[offset:offset + length]
 
@@ -227,19 +280,25 @@ def parse_response(data):
                 offset += l
                 if r:
                     ans.append(r)
+            soa = None
             for i in range(0, res_nscount):
                 l, r = parse_record(data, offset)
                 offset += l
+                if r and r[2] == QTYPE_SOA:
+                    soa = r
             for i in range(0, res_arcount):
                 l, r = parse_record(data, offset)
                 offset += l
             response = DNSResponse()
+            response.rcode = res_rcode
             if qds:
                 response.hostname = qds[0][0]
             for an in qds:
                 response.questions.append((an[1], an[2], an[3]))
             for an in ans:
-                response.answers.append((an[1], an[2], an[3]))
+                response.answers.append((an[1], an[2], an[3], an[4]))
+            if soa:
+                response.negative_ttl = min(soa[1], soa[4])
             return response
     except Exception as e:
         shell.print_exception(e)
@@ -257,25 +316,179 @@ def is_valid_hostname(hostname):
 class DNSResponse(object):
     def __init__(self):
         self.hostname = None
+        self.rcode = RCODE_NOERROR
         self.questions = []  # each: (addr, type, class)
-        self.answers = []  # each: (addr, type, class)
+        self.answers = []  # each: (addr, type, class, ttl)
+        # from the SOA record of a negative answer
+        self.negative_ttl = None
 
     def __str__(self):
         return '%s: %s' % (self.hostname, str(self.answers))
 
 
-STATUS_IPV4 = 0
-STATUS_IPV6 = 1
+class DNSCacheEntry(object):
+    def __init__(self, ips, ttl, now):
+        # ips is None for a name that did not resolve, else all addresses,
+        # those of the preferred family first
+        self.ips = ips
+        self.ttl = ttl
+        self.expire = now + ttl
+        self.hits = 0
+        self._families = []
+        if ips:
+            family = None
+            for ip in ips:
+                if common.is_ip(ip) != family:
+                    family = common.is_ip(ip)
+                    self._families.append([])
+                self._families[-1].append(ip)
+
+    def candidates(self):
+        # ips rotated by one address per use within each family, so
+        # connections spread over round robin records
+        ret = []
+        for ips in self._families:
+            i = self.hits % len(ips)
+            ret.extend(ips[i:])
+            ret.extend(ips[:i])
+        return ret
+
+
+class DNSLookup(object):
+    # the A and AAAA queries for one hostname
+    def __init__(self, hostname, qtypes):
+        self.hostname = hostname
+        self.qtypes = qtypes
+        # qtypes not answered yet
+        self.pending = set(qtypes)
+        # qtype -> (addresses, ttl)
+        self.answers = {}
+        # the last response without addresses, None if it timed out
+        self.negative = None
+        self.delivered = False
+        self.timer = None
+
+    def ips(self):
+        ret = []
+        for qtype in self.qtypes:
+            if qtype in self.answers:
+                ret.extend(self.answers[qtype][0])
+        return ret
+
+    def ttl(self):
+        return min(answer[1] for answer in self.answers.values())
+
+
+class DNSQuery(object):
+    def __init__(self, hostname, qtype):
+        self.hostname = hostname
+        self.qtype = qtype
+        self.request = build_request(hostname, qtype)
+        self.attempts = 0
+        # server -> when the request was last sent there
+        self.sent = {}
+        self.server = None
+        self.timeout = 0
+        self.timer = None
+
+
+class HostnameBlocklist(object):
+    # a blocked name blocks itself and every name below it, a lookup is one
+    # set lookup per label of the hostname whatever the size of the list
+    # the file has one name per line, '#' starts a comment, hosts file lines
+    # like '0.0.0.0 ads.example.com' are taken as well
+    def __init__(self, hostnames=None, path=None):
+        self._static = set(HostnameBlocklist._normalize(hostname)
+                           for hostname in hostnames or [])
+        self._static.discard(b'')
+        self._names = self._static
+        self._path = path
+        self._version = None
+        self._last_check = time.time()
+        if path:
+            self.load()
+
+    @staticmethod
+    def _normalize(hostname):
+        hostname = common.to_bytes(hostname).strip().lower()
+        if hostname.startswith(b'*.'):
+            hostname = hostname[2:]
+        return hostname.strip(b'.')
+
+    def load(self):
+        names = set(self._static)
+        # hosts files repeat the same one or two addresses
+        ips = set()
+        try:
+            st = os.stat(self._path)
+            with open(self._path, 'rb') as f:
+                for line in f:
+                    fields = line.split(b'#', 1)[0].split()
+                    if len(fields) > 1 and (fields[0] in ips or
+                                            common.is_ip(fields[0])):
+                        ips.add(fields[0])
+                        fields = fields[1:]
+                    for hostname in fields:
+                        names.add(HostnameBlocklist._normalize(hostname))
+        except (OSError, IOError) as e:
+            # keep what we have
+            logging.error('can not load black hostname file %s: %s' %
+                          (self._path, e))
+            return False
+        names.discard(b'')
+        self._names = names
+        self._version = (st.st_mtime, st.st_size)
+        logging.info('loaded %d black hostnames from %s' %
+                     (len(names) - len(self._static), self._path))
+        return True
+
+    def check_reload(self, now):
+        if not self._path or now - self._last_check < BLOCKLIST_CHECK_INTERVAL:
+            return
+        self._last_check = now
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return
+        if (st.st_mtime, st.st_size) != self._version:
+            self.load()
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, hostname):
+        names = self._names
+        if not names:
+            return False
+        hostname = hostname.lower().rstrip(b'.')
+        while True:
+            if hostname in names:
+                return True
+            i = hostname.find(b'.')
+            if i < 0:
+                return False
+            hostname = hostname[i + 1:]
 
 
 class DNSResolver(object):
-    def __init__(self, black_hostname_list=None):
+    def __init__(self, black_hostname_list=None, black_hostname_file=None,
+                 cache_size=DNS_CACHE_SIZE):
         self._loop = None
         self._hosts = {}
-        self._hostname_status = {}
+        # hostname -> DNSLookup being resolved
+        self._lookups = {}
         self._hostname_to_cb = {}
         self._cb_to_hostname = {}
-        self._cache = lru_cache.LRUCache(timeout=300)
+        # hostname -> DNSCacheEntry, least recently used first
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._last_sweep = time.time()
+        # names queried again before their entry expires
+        self._prefetching = set()
+        self.stat = {'hit': 0, 'negative_hit': 0, 'miss': 0, 'prefetch': 0,
+                     'timeout': 0, 'blocked': 0, 'evicted': 0}
+        # (hostname, qtype) -> DNSQuery waiting for an answer
+        self._queries = {}
         # read black_hostname_list from config
         if type(black_hostname_list) != list:
             self._black_hostname_list = []
@@ -285,9 +498,15 @@ class DNSResolver(object):
                 black_hostname_list
             ))
         logging.info('black_hostname_list init as : ' + str(self._black_hostname_list))
+        self._blocklist = HostnameBlocklist(self._black_hostname_list,
+                                            black_hostname_file or None)
         self._sock = None
         self._servers = None
         self._parse_resolv()
+        self._server_stat = dict(
+            (server, {'rtt': None, 'sent': 0, 'answered': 0, 'timeout': 0,
+                      'failures': 0, 'down_until': 0})
+            for server in self._servers)
         self._parse_hosts()
         # TODO monitor hosts change and reload hosts
         # TODO parse /etc/gai.conf and follow its rules
@@ -366,59 +585,164 @@ class DNSResolver(object):
         loop.add(self._sock, eventloop.POLL_IN, self)
         loop.add_periodic(self.handle_periodic)
 
-    def _call_callback(self, hostname, ip, error=None):
+    def _call_callback(self, hostname, ip, error=None, ips=None):
+        # a successful result is (hostname, ip, ips), ip being the first of
+        # all the addresses in ips
         callbacks = self._hostname_to_cb.get(hostname, [])
         for callback in callbacks:
             if callback in self._cb_to_hostname:
                 del self._cb_to_hostname[callback]
             if ip or error:
-                callback((hostname, ip), error)
+                callback((hostname, ip, ips or [ip]), error)
             else:
                 callback((hostname, None),
                          Exception('unable to parse hostname %s' % hostname))
         if hostname in self._hostname_to_cb:
             del self._hostname_to_cb[hostname]
-        if hostname in self._hostname_status:
-            del self._hostname_status[hostname]
 
-    def _handle_data(self, data):
+    def _cache_put(self, hostname, entry):
+        cache = self._cache
+        cache.pop(hostname, None)
+        cache[hostname] = entry
+        while len(cache) > self._cache_size:
+            hostname, entry = cache.popitem(last=False)
+            self._prefetching.discard(hostname)
+            self.stat['evicted'] += 1
+
+    def _cache_answer(self, hostname, ips, ttl):
+        ttl = max(DNS_MIN_TTL, min(ttl, DNS_MAX_TTL))
+        self._cache_put(hostname, DNSCacheEntry(ips, ttl, time.time()))
+
+    def _cache_failure(self, hostname, response):
+        # response is None when no server answered
+        now = time.time()
+        entry = self._cache.get(hostname, None)
+        if entry is not None and entry.ips and entry.expire > now:
+            # a refresh that failed, the old answer is good until it expires
+            return
+        if response is None or \
+                response.rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            ttl = DNS_FAILURE_TTL
+        elif response.negative_ttl is not None:
+            ttl = max(0, min(response.negative_ttl, DNS_NEGATIVE_MAX_TTL))
+        else:
+            ttl = DNS_NEGATIVE_TTL
+        if ttl:
+            self._cache_put(hostname, DNSCacheEntry(None, ttl, now))
+
+    def _cache_hit(self, hostname, entry, callback):
+        # python 2 OrderedDict has no move_to_end
+        del self._cache[hostname]
+        self._cache[hostname] = entry
+        entry.hits += 1
+        if entry.ips is None:
+            self.stat['negative_hit'] += 1
+            logging.debug('hit negative cache: %s', hostname)
+            callback((hostname, None),
+                     Exception('unable to parse hostname %s' % hostname))
+            return
+        self.stat['hit'] += 1
+        logging.debug('hit cache: %s ==>> %s', hostname, entry.ips)
+        if entry.hits >= DNS_PREFETCH_HITS and \
+                hostname not in self._prefetching and \
+                hostname not in self._lookups and \
+                entry.expire - time.time() < entry.ttl * DNS_PREFETCH_RATIO:
+            self.stat['prefetch'] += 1
+            self._prefetching.add(hostname)
+            self._query(hostname)
+        ips = entry.candidates()
+        callback((hostname, ips[0], ips), None)
+
+    def get_stat(self):
+        stat = self.stat.copy()
+        stat['size'] = len(self._cache)
+        stat['capacity'] = self._cache_size
+        return stat
+
+    def get_server_stat(self):
+        return dict((server, stat.copy())
+                    for server, stat in self._server_stat.items())
+
+    def _handle_data(self, data, server=None):
         response = parse_response(data)
-        if response and response.hostname:
-            hostname = response.hostname
-            ip = None
-            for answer in response.answers:
-                if answer[1] in (QTYPE_A, QTYPE_AAAA) and \
-                                answer[2] == QCLASS_IN:
-                    ip = answer[0]
-                    break
-            if IPV6_CONNECTION_SUPPORT:
-                if not ip and self._hostname_status.get(hostname, STATUS_IPV4) \
-                        == STATUS_IPV6:
-                    self._hostname_status[hostname] = STATUS_IPV4
-                    self._send_req(hostname, QTYPE_A)
-                else:
-                    if ip:
-                        self._cache[hostname] = ip
-                        self._call_callback(hostname, ip)
-                    elif self._hostname_status.get(hostname, None) == STATUS_IPV4:
-                        for question in response.questions:
-                            if question[1] == QTYPE_A:
-                                self._call_callback(hostname, None)
-                                break
+        if not response or not response.hostname or not response.questions:
+            return
+        hostname = response.hostname
+        query = self._queries.pop((hostname, response.questions[0][1]), None)
+        if query is None:
+            # answered already by another server, or not ours
+            return
+        if query.timer:
+            query.timer.cancel()
+        stat = self._server_stat.get(server, None)
+        if stat is not None and server in query.sent:
+            rtt = time.time() - query.sent[server]
+            if stat['rtt'] is None:
+                stat['rtt'] = rtt
             else:
-                if not ip and self._hostname_status.get(hostname, STATUS_IPV6) \
-                        == STATUS_IPV4:
-                    self._hostname_status[hostname] = STATUS_IPV6
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    if ip:
-                        self._cache[hostname] = ip
-                        self._call_callback(hostname, ip)
-                    elif self._hostname_status.get(hostname, None) == STATUS_IPV6:
-                        for question in response.questions:
-                            if question[1] == QTYPE_AAAA:
-                                self._call_callback(hostname, None)
-                                break
+                stat['rtt'] += (rtt - stat['rtt']) / 8
+            stat['answered'] += 1
+            stat['failures'] = 0
+            stat['down_until'] = 0
+        ips = [answer[0] for answer in response.answers
+               if answer[1] in (QTYPE_A, QTYPE_AAAA) and
+               answer[2] == QCLASS_IN]
+        self._handle_answer(hostname, query.qtype, ips, response)
+
+    def _handle_answer(self, hostname, qtype, ips, response):
+        # response is None when the query timed out
+        lookup = self._lookups.get(hostname, None)
+        if lookup is None or qtype not in lookup.pending:
+            return
+        lookup.pending.discard(qtype)
+        if ips:
+            lookup.answers[qtype] = (ips, min(answer[3] for answer in
+                                              response.answers
+                                              if answer[2] == QCLASS_IN))
+        else:
+            lookup.negative = response
+            if not lookup.answers and not lookup.pending and \
+                    len(lookup.qtypes) == 1:
+                # an IPv4 only server still connects to IPv6 only names
+                other = QTYPE_AAAA if qtype == QTYPE_A else QTYPE_A
+                lookup.qtypes.append(other)
+                lookup.pending.add(other)
+                self._send_req(hostname, other)
+                return
+        if not lookup.pending:
+            self._finish_lookup(lookup)
+        elif lookup.answers and not lookup.delivered and \
+                lookup.timer is None and self._loop:
+            lookup.timer = self._loop.call_later(
+                DNS_RESOLUTION_DELAY, lambda: self._deliver_lookup(lookup))
+
+    def _deliver_lookup(self, lookup):
+        # the callbacks get what is there, the cache is completed once the
+        # other family answers
+        lookup.timer = None
+        if lookup.delivered:
+            return
+        lookup.delivered = True
+        ips = lookup.ips()
+        self._cache_answer(lookup.hostname, ips, lookup.ttl())
+        self._call_callback(lookup.hostname, ips[0], ips=ips)
+
+    def _finish_lookup(self, lookup):
+        hostname = lookup.hostname
+        del self._lookups[hostname]
+        self._prefetching.discard(hostname)
+        if lookup.timer:
+            lookup.timer.cancel()
+            lookup.timer = None
+        if lookup.answers:
+            ips = lookup.ips()
+            self._cache_answer(hostname, ips, lookup.ttl())
+            if not lookup.delivered:
+                lookup.delivered = True
+                self._call_callback(hostname, ips[0], ips=ips)
+        else:
+            self._cache_failure(hostname, lookup.negative)
+            self._call_callback(hostname, None)
 
     def handle_event(self, sock, fd, event):
         if sock != self._sock:
@@ -437,10 +761,19 @@ class DNSResolver(object):
             if addr not in self._servers:
                 logging.warn('received a packet other than our dns')
                 return
-            self._handle_data(data)
+            self._handle_data(data, addr)
 
     def handle_periodic(self):
-        self._cache.sweep()
+        now = time.time()
+        self._blocklist.check_reload(now)
+        if now - self._last_sweep < CACHE_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for hostname, entry in list(self._cache.items()):
+            if entry.expire <= now:
+                del self._cache[hostname]
+                # its refresh got no answer
+                self._prefetching.discard(hostname)
 
     def remove_callback(self, callback):
         hostname = self._cb_to_hostname.get(callback)
@@ -450,35 +783,104 @@ class DNSResolver(object):
             if arr:
                 arr.remove(callback)
                 if not arr:
+                    # the query runs on, its answer is cached
                     del self._hostname_to_cb[hostname]
-                    if hostname in self._hostname_status:
-                        del self._hostname_status[hostname]
+
+    def _query(self, hostname):
+        if IPV6_CONNECTION_SUPPORT:
+            qtypes = [QTYPE_AAAA, QTYPE_A]
+        else:
+            qtypes = [QTYPE_A]
+        self._lookups[hostname] = DNSLookup(hostname, qtypes)
+        for qtype in qtypes:
+            self._send_req(hostname, qtype)
 
     def _send_req(self, hostname, qtype):
-        req = build_request(hostname, qtype)
-        for server in self._servers:
-            logging.debug('resolving %s with type %d using server %s',
-                          hostname, qtype, server)
-            self._sock.sendto(req, server)
+        key = (hostname, qtype)
+        if key not in self._queries:
+            query = DNSQuery(hostname, qtype)
+            self._queries[key] = query
+            self._transmit(query)
+
+    def _ordered_servers(self):
+        # healthy servers fastest first, a server not measured yet is tried
+        # before the others
+        now = time.time()
+        return sorted(self._servers, key=lambda server: (
+            self._server_stat[server]['down_until'] > now,
+            self._server_stat[server]['rtt'] or 0))
+
+    def _transmit(self, query):
+        servers = self._ordered_servers()
+        server = servers[0]
+        for s in servers:
+            if s not in query.sent:
+                server = s
+                break
+        stat = self._server_stat[server]
+        timeout = max(DNS_MIN_TIMEOUT, 2 * (stat['rtt'] or 0))
+        timeout = min(timeout * (2 ** query.attempts), DNS_MAX_TIMEOUT)
+        query.attempts += 1
+        query.server = server
+        query.timeout = timeout
+        query.sent[server] = time.time()
+        stat['sent'] += 1
+        logging.debug('resolving %s with type %d using server %s',
+                      query.hostname, query.qtype, server)
+        try:
+            self._sock.sendto(query.request, server)
+        except (OSError, IOError) as e:
+            # as good as lost, the timer sends it again
+            logging.warn('dns query to %s: %s' % (server, e))
+        if self._loop:
+            query.timer = self._loop.call_later(
+                timeout, lambda: self._handle_timeout(query))
+
+    def _handle_timeout(self, query):
+        query.timer = None
+        stat = self._server_stat[query.server]
+        stat['timeout'] += 1
+        stat['failures'] += 1
+        # counts as an answer that took the whole timeout
+        if stat['rtt'] is None:
+            stat['rtt'] = query.timeout
+        else:
+            stat['rtt'] += (query.timeout - stat['rtt']) / 8
+        if stat['failures'] >= DNS_SERVER_MAX_FAILURES and \
+                stat['down_until'] <= time.time():
+            logging.warn('dns server %s:%d is not answering' % query.server)
+            stat['down_until'] = time.time() + DNS_SERVER_HOLD_DOWN
+        if query.attempts < DNS_RETRIES:
+            self._transmit(query)
+            return
+        del self._queries[(query.hostname, query.qtype)]
+        self.stat['timeout'] += 1
+        logging.debug('dns query for %s with type %d timed out',
+                      query.hostname, query.qtype)
+        self._handle_answer(query.hostname, query.qtype, [], None)
 
     def resolve(self, hostname, callback):
+        # callback gets (hostname, ip, ips) where ips are all the addresses
+        # the outbound connect races, ip being the first one, callers also
+        # take the (hostname, ip) other resolvers give
         if type(hostname) != bytes:
             hostname = hostname.encode('utf8')
         if not hostname:
             callback(None, Exception('empty hostname'))
         elif common.is_ip(hostname):
-            callback((hostname, hostname), None)
+            callback((hostname, hostname, [hostname]), None)
         elif hostname in self._hosts:
             logging.debug('hit hosts: %s', hostname)
             ip = self._hosts[hostname]
-            callback((hostname, ip), None)
-        elif hostname in self._cache:
-            logging.debug('hit cache: %s ==>> %s', hostname, self._cache[hostname])
-            ip = self._cache[hostname]
-            callback((hostname, ip), None)
-        elif any(hostname.endswith(t) for t in self._black_hostname_list):
+            callback((hostname, ip, [ip]), None)
+        elif hostname in self._blocklist:
+            # before the cache, a name blocked by a reload is not served
+            self.stat['blocked'] += 1
             callback(None, Exception('hostname <%s> is block by the black hostname list' % hostname))
             return
+        elif hostname in self._cache and \
+                self._cache[hostname].expire > time.time():
+            self._cache_hit(hostname, self._cache[hostname], callback)
         else:
             if not is_valid_hostname(hostname):
                 callback(None, Exception('invalid hostname: %s' % hostname))
@@ -489,28 +891,31 @@ class DNSResolver(object):
                 if addrs:
                     af, socktype, proto, canonname, sa = addrs[0]
                     logging.debug('DNS resolve %s %s' % (hostname, sa[0]))
-                    self._cache[hostname] = sa[0]
-                    callback((hostname, sa[0]), None)
+                    self._cache_put(hostname, DNSCacheEntry([sa[0]], DNS_MIN_TTL,
+                                                            time.time()))
+                    callback((hostname, sa[0], [sa[0]]), None)
                     return
+            self.stat['miss'] += 1
+            # a name already being resolved, by a refresh too, is not
+            # queried again, the callbacks wait for the same answer
+            if hostname not in self._lookups:
+                self._query(hostname)
             arr = self._hostname_to_cb.get(hostname, None)
             if not arr:
-                if IPV6_CONNECTION_SUPPORT:
-                    self._hostname_status[hostname] = STATUS_IPV6
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    self._hostname_status[hostname] = STATUS_IPV4
-                    self._send_req(hostname, QTYPE_A)
                 self._hostname_to_cb[hostname] = [callback]
-                self._cb_to_hostname[callback] = hostname
             else:
                 arr.append(callback)
-                # TODO send again only if waited too long
-                if IPV6_CONNECTION_SUPPORT:
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    self._send_req(hostname, QTYPE_A)
+            self._cb_to_hostname[callback] = hostname
 
     def close(self):
+        for query in self._queries.values():
+            if query.timer:
+                query.timer.cancel()
+        self._queries.clear()
+        for lookup in self._lookups.values():
+            if lookup.timer:
+                lookup.timer.cancel()
+        self._lookups.clear()
         if self._sock:
             if self._loop:
                 self._loop.remove_periodic(self.handle_periodic)
@@ -588,5 +993,254 @@ def test():
     dns_resolver.close()
 
 
+def test_cache():
+    def response(hostname, qtype, rcode=0, ips=(), ttl=10, soa=None):
+        data = struct.pack('!HBBHHHH', 0, 0x81, 0x80 | rcode, 1, len(ips),
+                           soa is not None, 0)
+        data += build_address(hostname) + struct.pack('!HH', qtype, QCLASS_IN)
+        for ip in ips:
+            rdata = socket.inet_aton(ip)
+            data += b'\xc0\x0c' + struct.pack('!HHiH', QTYPE_A, QCLASS_IN,
+                                              ttl, len(rdata)) + rdata
+        if soa is not None:
+            rdata = build_address(b'ns.example.com') + \
+                build_address(b'root.example.com') + \
+                struct.pack('!IIIII', 1, 7200, 900, 86400, soa)
+            data += build_address(b'example.com') + \
+                struct.pack('!HHiH', QTYPE_SOA, QCLASS_IN, 120,
+                            len(rdata)) + rdata
+        return data
+
+    results = []
+    sent = []
+    dns_resolver = DNSResolver()
+    dns_resolver._transmit = lambda query: sent.append(query.qtype)
+
+    def resolve(hostname, **kwargs):
+        del sent[:]
+        del results[:]
+        dns_resolver.resolve(hostname, lambda r, e: results.append((r, e)))
+        # only the A query gets addresses
+        ips = kwargs.pop('ips', ())
+        while sent and not results:
+            qtype = sent.pop()
+            dns_resolver._handle_data(response(
+                hostname, qtype, ips=ips if qtype == QTYPE_A else (),
+                **kwargs))
+        return results[0]
+
+    r, e = resolve(b'www.example.com', ips=['192.0.2.1', '192.0.2.2'])
+    assert r == (b'www.example.com', '192.0.2.1', ['192.0.2.1', '192.0.2.2'])
+    entry = dns_resolver._cache[b'www.example.com']
+    assert entry.ttl == DNS_MIN_TTL
+    r, e = resolve(b'www.example.com')
+    assert r[2] == ['192.0.2.2', '192.0.2.1'] and not sent
+    assert dns_resolver.stat['hit'] == 1 and dns_resolver.stat['miss'] == 1
+
+    # hot and about to expire, answered from the cache and queried again
+    entry.hits = DNS_PREFETCH_HITS
+    entry.expire = time.time() + 1
+    r, e = resolve(b'www.example.com')
+    assert r[1] in entry.ips and sent
+    assert dns_resolver.stat['prefetch'] == 1
+    # the refresh fails, the old answer stays
+    while sent:
+        dns_resolver._handle_data(response(b'www.example.com', sent.pop(),
+                                           rcode=2))
+    assert dns_resolver._cache[b'www.example.com'] is entry
+    assert not dns_resolver._prefetching
+
+    r, e = resolve(b'nx.example.com', rcode=RCODE_NXDOMAIN, soa=60)
+    assert e is not None
+    assert dns_resolver._cache[b'nx.example.com'].ttl == 60
+    r, e = resolve(b'nx.example.com')
+    assert e is not None and not sent
+    assert dns_resolver.stat['negative_hit'] == 1
+
+    # expired entries are swept
+    dns_resolver._cache[b'nx.example.com'].expire = time.time()
+    dns_resolver._last_sweep = 0
+    dns_resolver.handle_periodic()
+    assert b'nx.example.com' not in dns_resolver._cache
+    assert dns_resolver.get_stat()['size'] == 1
+
+    # random names push out the least recently used entries, not the
+    # ones in use
+    dns_resolver._cache_size = 3
+    for i in range(4):
+        resolve(b'www.example.com')
+        resolve(common.to_bytes('nx%d.example.com' % i),
+                rcode=RCODE_NXDOMAIN)
+    assert list(dns_resolver._cache) == [b'nx2.example.com',
+                                         b'www.example.com',
+                                         b'nx3.example.com']
+    stat = dns_resolver.get_stat()
+    assert stat['size'] == stat['capacity'] == 3 and stat['evicted'] == 2
+    dns_resolver.close()
+
+
+def test_query():
+    global IPV6_CONNECTION_SUPPORT
+
+    class Sock(object):
+        def __init__(self):
+            self.sent = []
+
+        def sendto(self, data, server):
+            self.sent.append(server)
+
+    def answer(hostname, server):
+        query = dns_resolver._queries[(hostname, QTYPE_A)]
+        data = query.request[:2] + struct.pack('!BBHHHH', 0x81, 0x80, 1, 1,
+                                               0, 0)
+        data += query.request[12:] + b'\xc0\x0c' + \
+            struct.pack('!HHiH', QTYPE_A, QCLASS_IN, 60, 4) + \
+            socket.inet_aton('192.0.2.1')
+        dns_resolver._handle_data(data, server)
+
+    ipv6 = IPV6_CONNECTION_SUPPORT
+    IPV6_CONNECTION_SUPPORT = False
+    try:
+        results = []
+        s1, s2 = ('192.0.2.53', 53), ('198.51.100.53', 53)
+        dns_resolver = DNSResolver()
+        dns_resolver._servers = [s1, s2]
+        dns_resolver._server_stat = dict(
+            (server, {'rtt': None, 'sent': 0, 'answered': 0, 'timeout': 0,
+                      'failures': 0, 'down_until': 0})
+            for server in (s1, s2))
+        sock = dns_resolver._sock = Sock()
+        for i in range(3):
+            dns_resolver.resolve(b'www.example.com',
+                                 lambda r, e: results.append((r, e)))
+        # one query for all three
+        assert sock.sent == [s1]
+        query = dns_resolver._queries[(b'www.example.com', QTYPE_A)]
+        dns_resolver._handle_timeout(query)
+        assert sock.sent == [s1, s2]
+        answer(b'www.example.com', s2)
+        assert len(results) == 3 and results[0][0][1] == '192.0.2.1'
+        assert dns_resolver.get_server_stat()[s2]['answered'] == 1
+
+        # s1 timed out, s2 answered, s2 goes first now
+        del sock.sent[:]
+        dns_resolver.resolve(b'nx.example.com',
+                             lambda r, e: results.append((r, e)))
+        assert sock.sent == [s2]
+        # nobody answers, the A query, then the AAAA query fails
+        while dns_resolver._queries:
+            query = list(dns_resolver._queries.values())[0]
+            dns_resolver._handle_timeout(query)
+        assert len(results) == 4 and results[3][1] is not None
+        assert len(sock.sent) == 2 * DNS_RETRIES
+        assert dns_resolver.stat['timeout'] == 2
+        assert b'nx.example.com' in dns_resolver._cache
+        stat = dns_resolver.get_server_stat()
+        assert stat[s1]['down_until'] > time.time()
+        assert stat[s1]['timeout'] + stat[s2]['timeout'] == 2 * DNS_RETRIES + 1
+        dns_resolver._sock = None
+        dns_resolver.close()
+    finally:
+        IPV6_CONNECTION_SUPPORT = ipv6
+
+
+def test_lookup():
+    global IPV6_CONNECTION_SUPPORT
+
+    def answer(qtype, ips):
+        query = dns_resolver._queries[(b'www.example.com', qtype)]
+        family = socket.AF_INET if qtype == QTYPE_A else socket.AF_INET6
+        data = query.request[:2] + struct.pack('!BBHHHH', 0x81, 0x80, 1,
+                                               len(ips), 0, 0)
+        data += query.request[12:]
+        for ip in ips:
+            rdata = socket.inet_pton(family, ip)
+            data += b'\xc0\x0c' + struct.pack('!HHiH', qtype, QCLASS_IN, 60,
+                                              len(rdata)) + rdata
+        dns_resolver._handle_data(data)
+
+    ipv6 = IPV6_CONNECTION_SUPPORT
+    IPV6_CONNECTION_SUPPORT = True
+    try:
+        results = []
+        sent = []
+        dns_resolver = DNSResolver()
+        dns_resolver._transmit = lambda query: sent.append(query.qtype)
+        dns_resolver._loop = eventloop.EventLoop()
+        dns_resolver.resolve(b'www.example.com',
+                             lambda r, e: results.append((r, e)))
+        assert sent == [QTYPE_AAAA, QTYPE_A]
+        answer(QTYPE_A, ['192.0.2.1', '192.0.2.2'])
+        # waits a little for the AAAA answer
+        assert not results
+        lookup = dns_resolver._lookups[b'www.example.com']
+        lookup.timer.callback()
+        assert results[0][0][2] == ['192.0.2.1', '192.0.2.2']
+        answer(QTYPE_AAAA, ['2001:db8::1'])
+        assert len(results) == 1 and not dns_resolver._lookups
+        entry = dns_resolver._cache[b'www.example.com']
+        assert entry.ips == ['2001:db8::1', '192.0.2.1', '192.0.2.2']
+
+        # hits rotate the addresses of each family
+        del results[:]
+        for i in range(3):
+            dns_resolver.resolve(b'www.example.com',
+                                 lambda r, e: results.append((r, e)))
+        assert results[0][0][2] == ['2001:db8::1', '192.0.2.2', '192.0.2.1']
+        assert results[1][0][2] == ['2001:db8::1', '192.0.2.1', '192.0.2.2']
+        assert results[0][0][1] == '2001:db8::1'
+        assert len(sent) == 2
+        dns_resolver.close()
+    finally:
+        IPV6_CONNECTION_SUPPORT = ipv6
+
+
+def test_blocklist():
+    import tempfile
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b'# ads\nads.example.com\n0.0.0.0 tracker.example.net # hosts\n'
+                b'*.Malware.Example.ORG\n\n')
+    results = []
+    try:
+        dns_resolver = DNSResolver(black_hostname_list=['baidu.com'],
+                                   black_hostname_file=path)
+        blocklist = dns_resolver._blocklist
+        assert len(blocklist) == 4
+        assert b'baidu.com' in blocklist
+        assert b'map.baidu.com' in blocklist
+        assert b'xbaidu.com' not in blocklist
+        assert b'x.ads.example.com' in blocklist
+        assert b'example.com' not in blocklist
+        assert b'tracker.example.net.' in blocklist
+        assert b'a.b.malware.example.org' in blocklist
+        assert b'0.0.0.0' not in blocklist
+
+        # a cached name is blocked once the file lists it
+        dns_resolver._cache[b'www.example.com'] = \
+            DNSCacheEntry(['192.0.2.1'], 60, time.time())
+        with open(path, 'ab') as f:
+            f.write(b'www.example.com\n')
+        blocklist._last_check = 0
+        dns_resolver.handle_periodic()
+        dns_resolver.resolve(b'www.example.com',
+                             lambda r, e: results.append((r, e)))
+        assert results[0][1] is not None
+        assert dns_resolver.stat['blocked'] == 1 and len(blocklist) == 5
+
+        # an unreadable file leaves the list as it was
+        os.unlink(path)
+        assert not blocklist.load()
+        assert b'ads.example.com' in blocklist
+        dns_resolver.close()
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
 if __name__ == '__main__':
+    test_cache()
+    test_query()
+    test_lookup()
+    test_blocklist()
     test()
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import errno
+import socket
+import collections
+import itertools
+
+# BufferPool hands out fixed size bytearrays to recv_into and takes them
+# back once their data has been written, so a busy relay reuses a handful
+# of buffers instead of allocating a new bytes object for every read
+#
+# WriteQueue keeps the data a socket could not take yet as memoryviews
+# a partial send only moves the view of the first buffer forward, and when
+# several buffers are pending they are written with one sendmsg
+
+# at most this many buffers are gathered into one sendmsg
+IOV_BATCH = 64
+
+_has_sendmsg = hasattr(socket.socket, 'sendmsg')
+
+
+class BufferPool(object):
+    """This class is not thread safe"""
+
+    def __init__(self, size, max_free=32):
+        self.size = size
+        self._max_free = max_free
+        self._free = []
+
+    def get(self):
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.size)
+
+    def put(self, buf):
+        # anything that did not come from get, None included, is left to
+        # the gc
+        if type(buf) is bytearray and len(buf) == self.size and \
+                len(self._free) < self._max_free:
+            self._free.append(buf)
+
+
+class WriteQueue(object):
+    """This class is not thread safe"""
+
+    def __init__(self, pool=None):
+        self._bufs = collections.deque()
+        self._pool = pool
+        # bytes waiting to be written
+        self.size = 0
+
+    def __len__(self):
+        return len(self._bufs)
+
+    def append(self, data):
+        # data must not be modified until it has been written
+        if data:
+            self._bufs.append(data)
+            self.size += len(data)
+
+    def popleft(self):
+        data = self._bufs.popleft()
+        self.size -= len(data)
+        return data
+
+    def join(self):
+        # python 2 can not join memoryviews
+        return b''.join([b.tobytes() if type(b) is memoryview else b
+                         for b in self._bufs])
+
+    def clear(self):
+        bufs = self._bufs
+        if self._pool is not None:
+            for b in bufs:
+                if type(b) is memoryview:
+                    self._pool.put(getattr(b, 'obj', None))
+        bufs.clear()
+        self.size = 0
+
+    def consume(self, s):
+        # drop the first s bytes, written elsewhere, returns True if they
+        # ended on a buffer boundary
+        bufs = self._bufs
+        self.size -= s
+        while s:
+            head = bufs[0]
+            l = len(head)
+            if s < l:
+                bufs[0] = memoryview(head)[s:]
+                return False
+            s -= l
+            bufs.popleft()
+            if self._pool is not None and type(head) is memoryview:
+                # python 2 views do not tell what they were taken from
+                self._pool.put(getattr(head, 'obj', None))
+        return True
+
+    def write_to(self, sock):
+        # write as much as sock takes, returns True once the queue is empty
+        # socket errors other than EAGAIN are raised to the caller
+        bufs = self._bufs
+        try:
+            while bufs:
+                if len(bufs) > 1 and _has_sendmsg:
+                    s = sock.sendmsg(list(itertools.islice(bufs, IOV_BATCH)))
+                else:
+                    s = sock.send(bufs[0])
+                if not self.consume(s):
+                    return False
+        except (OSError, IOError) as e:
+            if e.args and e.args[0] in (errno.EAGAIN, errno.EINPROGRESS,
+                                        errno.EWOULDBLOCK):
+                return False
+            raise
+        return True
+
+
+def test_buffer_pool():
+    pool = BufferPool(16, max_free=1)
+    a = pool.get()
+    b = pool.get()
+    assert a is not b and len(a) == 16
+    pool.put(a)
+    pool.put(b)
+    pool.put(bytearray(8))
+    assert pool.get() is a
+    assert pool.get() is not b
+
+
+def test_write_queue():
+    pool = BufferPool(8192)
+    left, right = socket.socketpair()
+    left.setblocking(False)
+    right.setblocking(False)
+    left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    q = WriteQueue(pool)
+    sent = []
+    for i in range(64):
+        buf = pool.get()
+        buf[:] = bytearray([i]) * len(buf)
+        q.append(memoryview(buf))
+        sent.append(bytes(buf))
+    q.append(b'tail')
+    sent.append(b'tail')
+    assert q.size == 64 * 8192 + 4
+    assert not q.write_to(left)
+    assert q.size < 64 * 8192
+    received = []
+    while q:
+        try:
+            received.append(right.recv(65536))
+        except (OSError, IOError):
+            pass
+        q.write_to(left)
+    left.close()
+    right.setblocking(True)
+    while True:
+        data = right.recv(65536)
+        if not data:
+            break
+        received.append(data)
+    right.close()
+    assert b''.join(received) == b''.join(sent)
+    assert q.size == 0
+
+    # what is left when the connection goes away is joined or dropped, and
+    # its buffers come back either way
+    pool = BufferPool(8)
+    q = WriteQueue(pool)
+    buf = pool.get()
+    buf[:] = b'12345678'
+    q.append(memoryview(buf)[2:])
+    q.append(b'tail')
+    assert q.join() == b'345678tail'
+    q.clear()
+    assert q.size == 0 and not q
+    if hasattr(memoryview(buf), 'obj'):
+        assert pool.get() is buf
+
+
+if __name__ == '__main__':
+    test_buffer_pool()
+    test_write_queue()
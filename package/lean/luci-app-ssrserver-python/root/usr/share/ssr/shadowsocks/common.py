@@ -21,6 +21,9 @@ from __future__ import absolute_import, division, print_function, \
 import socket
 import struct
 import logging
+import array
+import bisect
+import weakref
 import binascii
 import re
 
@@ -121,6 +124,26 @@ def is_ip(address):
     return False
 
 
+# (af, sockaddr) of literal destination addresses, this is on the per
+# datagram path of UDP so it must never ask the resolver
+SOCKADDR_CACHE_SIZE = 4096
+_sockaddr_cache = {}
+
+
+def get_sockaddr(address, port):
+    key = (address, port)
+    r = _sockaddr_cache.get(key, None)
+    if r is None:
+        af = is_ip(address)
+        if af is False:
+            return None
+        if len(_sockaddr_cache) >= SOCKADDR_CACHE_SIZE:
+            _sockaddr_cache.clear()
+        r = (af, (to_str(address), port))
+        _sockaddr_cache[key] = r
+    return r
+
+
 def match_regex(regex, text):
     regex = re.compile(regex)
     for item in regex.findall(text):
@@ -246,55 +269,126 @@ class IPNetwork(object):
 
     def __init__(self, addrs):
         self.addrs_str = addrs
-        self._network_list_v4 = []
-        self._network_list_v6 = []
+        # the networks of each family are kept as sorted, merged
+        # [start, end] ranges, a lookup is one bisect over the starts
+        self._starts = {socket.AF_INET: [], socket.AF_INET6: []}
+        self._ends = {socket.AF_INET: [], socket.AF_INET6: []}
+        # ranges added since the last merge, as start << addr_len | end
+        self._pending = {socket.AF_INET: [], socket.AF_INET6: []}
         if type(addrs) == str:
             addrs = addrs.split(',')
         list(map(self.add_network, addrs))
+        self._merge()
 
     def add_network(self, addr):
-        if addr is "":
+        self._add_network(addr, True)
+
+    def add_file(self, path):
+        # one network per line, '#' starts a comment, an address without a
+        # prefix size is a single host, returns how many were added
+        count = 0
+        with open(path) as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    self._add_network(line, False)
+                except Exception:
+                    raise Exception("Not a valid CIDR notation: %s at %s:%d"
+                                    % (line, path, lineno))
+                count += 1
+        self._merge()
+        return count
+
+    def _add_network(self, addr, guess_prefix):
+        if addr == "":
             return
         block = addr.split('/')
-        addr_family = is_ip(block[0])
+        addr_family, ip = IPNetwork._parse_ip(block[0])
         addr_len = IPNetwork.ADDRLENGTH[addr_family]
-        if addr_family is socket.AF_INET:
-            ip, = struct.unpack("!I", socket.inet_aton(block[0]))
-        elif addr_family is socket.AF_INET6:
-            hi, lo = struct.unpack("!QQ", inet_pton(addr_family, block[0]))
-            ip = (hi << 64) | lo
-        else:
+        if addr_family is False:
             raise Exception("Not a valid CIDR notation: %s" % addr)
-        if len(block) is 1:
+        if len(block) == 1:
             prefix_size = 0
-            while (ip & 1) == 0 and ip is not 0:
-                ip >>= 1
-                prefix_size += 1
-            logging.warn("You did't specify CIDR routing prefix size for %s, "
-                         "implicit treated as %s/%d" % (addr, addr, addr_len))
+            if guess_prefix:
+                while (ip & 1) == 0 and ip != 0:
+                    ip >>= 1
+                    prefix_size += 1
+                logging.warn("You did't specify CIDR routing prefix size for "
+                             "%s, implicit treated as %s/%d" %
+                             (addr, addr, addr_len))
         elif block[1].isdigit() and int(block[1]) <= addr_len:
             prefix_size = addr_len - int(block[1])
             ip >>= prefix_size
         else:
             raise Exception("Not a valid CIDR notation: %s" % addr)
-        if addr_family is socket.AF_INET:
-            self._network_list_v4.append((ip, prefix_size))
+        start = ip << prefix_size
+        end = start | ((1 << prefix_size) - 1)
+        self._pending[addr_family].append((start << addr_len) | end)
+
+    def _merge(self):
+        for addr_family, ranges in self._pending.items():
+            if not ranges:
+                continue
+            addr_len = IPNetwork.ADDRLENGTH[addr_family]
+            mask = (1 << addr_len) - 1
+            ranges.extend((start << addr_len) | end for start, end in
+                          zip(self._starts[addr_family],
+                              self._ends[addr_family]))
+            ranges.sort()
+            starts = []
+            ends = []
+            for r in ranges:
+                start = r >> addr_len
+                end = r & mask
+                if ends and start <= ends[-1] + 1:
+                    if end > ends[-1]:
+                        ends[-1] = end
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            del ranges[:]
+            if addr_family is socket.AF_INET:
+                # a third of the memory of a list of ints
+                starts = array.array('L', starts)
+                ends = array.array('L', ends)
+            self._starts[addr_family] = starts
+            self._ends[addr_family] = ends
+
+    @staticmethod
+    def _parse_ip(addr):
+        # (family, address as int), or (False, 0)
+        # the native inet_pton is tried first, it is several times faster
+        # than is_ip, which also takes the shorthands our inet_pton allows
+        addr = to_str(addr)
+        for addr_family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                packed = socket.inet_pton(addr_family, addr)
+                break
+            except (TypeError, ValueError, OSError, IOError):
+                pass
         else:
-            self._network_list_v6.append((ip, prefix_size))
+            addr_family = is_ip(addr)
+            if addr_family is socket.AF_INET:
+                packed = socket.inet_aton(addr)
+            elif addr_family is socket.AF_INET6:
+                packed = inet_pton(addr_family, addr)
+            else:
+                return False, 0
+        if addr_family is socket.AF_INET:
+            return addr_family, struct.unpack("!I", packed)[0]
+        hi, lo = struct.unpack("!QQ", packed)
+        return addr_family, (hi << 64) | lo
 
     def __contains__(self, addr):
-        addr_family = is_ip(addr)
-        if addr_family is socket.AF_INET:
-            ip, = struct.unpack("!I", socket.inet_aton(addr))
-            return any(map(lambda n_ps: n_ps[0] == ip >> n_ps[1],
-                           self._network_list_v4))
-        elif addr_family is socket.AF_INET6:
-            hi, lo = struct.unpack("!QQ", inet_pton(addr_family, addr))
-            ip = (hi << 64) | lo
-            return any(map(lambda n_ps: n_ps[0] == ip >> n_ps[1],
-                           self._network_list_v6))
-        else:
+        addr_family, ip = IPNetwork._parse_ip(addr)
+        if addr_family is False:
             return False
+        if self._pending[addr_family]:
+            self._merge()
+        i = bisect.bisect_right(self._starts[addr_family], ip) - 1
+        return i >= 0 and ip <= self._ends[addr_family][i]
 
     def __cmp__(self, other):
         return cmp(self.addrs_str, other.addrs_str)
@@ -308,30 +402,38 @@ class IPNetwork(object):
 class PortRange(object):
     def __init__(self, range_str):
         self.range_str = to_str(range_str)
-        self.range = set()
+        # one bit per port, 8 KB whatever the ranges are
+        self._bitmap = bytearray(8192)
         range_str = to_str(range_str).split(',')
         for item in range_str:
             try:
                 int_range = item.split('-')
                 if len(int_range) == 1:
                     if item:
-                        self.range.add(int(item))
+                        self._add(int(item), int(item))
                 elif len(int_range) == 2:
-                    int_range[0] = int(int_range[0])
-                    int_range[1] = int(int_range[1])
-                    if int_range[0] < 0:
-                        int_range[0] = 0
-                    if int_range[1] > 65535:
-                        int_range[1] = 65535
-                    i = int_range[0]
-                    while i <= int_range[1]:
-                        self.range.add(i)
-                        i += 1
+                    self._add(int(int_range[0]), int(int_range[1]))
             except Exception as e:
                 logging.error(e)
 
+    def _add(self, start, end):
+        bitmap = self._bitmap
+        start = max(start, 0)
+        end = min(end, 65535)
+        while start <= end and start & 7:
+            bitmap[start >> 3] |= 1 << (start & 7)
+            start += 1
+        n = (end + 1 - start) >> 3
+        if n > 0:
+            bitmap[start >> 3:(start >> 3) + n] = b'\xff' * n
+            start += n << 3
+        while start <= end:
+            bitmap[start >> 3] |= 1 << (start & 7)
+            start += 1
+
     def __contains__(self, val):
-        return val in self.range
+        return 0 <= val <= 65535 and \
+            (self._bitmap[val >> 3] >> (val & 7)) & 1 == 1
 
     def __cmp__(self, other):
         return cmp(self.range_str, other.range_str)
@@ -342,6 +444,20 @@ class PortRange(object):
     def __ne__(self, other):
         return self.range_str != other.range_str
 
+
+# every user row of a multi user server has its own forbidden_port, most of
+# them the same string, which then share one PortRange
+_port_ranges = weakref.WeakValueDictionary()
+
+
+def get_port_range(range_str):
+    range_str = to_str(range_str)
+    port_range = _port_ranges.get(range_str, None)
+    if port_range is None:
+        port_range = PortRange(range_str)
+        _port_ranges[range_str] = port_range
+    return port_range
+
 class UDPAsyncDNSHandler(object):
     dns_cache = lru_cache.LRUCache(timeout=1800)
     def __init__(self, params):
@@ -379,6 +495,12 @@ def test_inet_conv():
     assert inet_ntop(socket.AF_INET6, b) == ipv6
 
 
+def test_get_sockaddr():
+    assert get_sockaddr(b'8.8.8.8', 53) == (socket.AF_INET, ('8.8.8.8', 53))
+    assert get_sockaddr('::1', 80) == (socket.AF_INET6, ('::1', 80))
+    assert get_sockaddr(b'www.google.com', 80) is None
+
+
 def test_parse_header():
     assert parse_header(b'\x03\x0ewww.google.com\x00\x50') == \
         (0, b'www.google.com', 80, 18)
@@ -411,8 +533,50 @@ def test_ip_network():
     assert 'www.google.com' not in ip_network
 
 
+def test_ip_network_file():
+    import os
+    import tempfile
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        f.write('# blocklist\n10.0.0.0/9\n10.128.0.0/9 # adjacent\n\n'
+                '10.1.0.0/16\n203.0.113.8\n2001:db8::/32\n')
+    ip_network = IPNetwork('')
+    try:
+        assert ip_network.add_file(path) == 5
+    finally:
+        os.unlink(path)
+    # merged into one range
+    assert list(ip_network._starts[socket.AF_INET]) == [0x0a000000, 0xcb007108]
+    assert '10.255.255.255' in ip_network
+    assert '11.0.0.0' not in ip_network
+    assert '9.255.255.255' not in ip_network
+    assert '203.0.113.8' in ip_network
+    assert '203.0.113.9' not in ip_network
+    assert '2001:db8:ffff::1' in ip_network
+    assert '2001:db9::' not in ip_network
+    assert '0.0.0.0' not in ip_network
+    ip_network.add_network('0.0.0.0/8')
+    assert '0.0.0.0' in ip_network
+
+
+def test_port_range():
+    port_range = PortRange('22,80-90,1000-1009,65530-70000')
+    for port in (22, 80, 85, 90, 1000, 1005, 1009, 65530, 65535):
+        assert port in port_range
+    for port in (0, 21, 23, 79, 91, 999, 1010, 65529, 65536, -1):
+        assert port not in port_range
+    assert all(port in PortRange('1-65535') for port in range(1, 65536))
+    assert 0 not in PortRange('1-65535')
+    assert 0 not in PortRange('')
+    assert get_port_range('1-1024') is get_port_range(b'1-1024')
+    assert get_port_range('1-1024') == PortRange('1-1024')
+
+
 if __name__ == '__main__':
     test_inet_conv()
+    test_get_sockaddr()
     test_parse_header()
     test_pack_header()
     test_ip_network()
+    test_ip_network_file()
+    test_port_range()
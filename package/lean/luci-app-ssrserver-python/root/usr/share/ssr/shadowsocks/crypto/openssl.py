@@ -18,7 +18,7 @@ from __future__ import absolute_import, division, print_function, \
     with_statement
 
 from ctypes import c_char_p, c_int, c_long, byref,\
-    create_string_buffer, c_void_p
+    create_string_buffer, c_void_p, string_at
 
 from shadowsocks import common
 from shadowsocks.crypto import util
@@ -28,11 +28,9 @@ __all__ = ['ciphers']
 libcrypto = None
 loaded = False
 
-buf_size = 2048
-
 
 def load_openssl():
-    global loaded, libcrypto, buf
+    global loaded, libcrypto
 
     libcrypto = util.find_library(('crypto', 'eay32'),
                                   'EVP_get_cipherbyname',
@@ -47,7 +45,7 @@ def load_openssl():
                                             c_char_p, c_char_p, c_int)
 
     libcrypto.EVP_CipherUpdate.argtypes = (c_void_p, c_void_p, c_void_p,
-                                           c_char_p, c_int)
+                                           c_void_p, c_int)
 
     if hasattr(libcrypto, "EVP_CIPHER_CTX_cleanup"):
         libcrypto.EVP_CIPHER_CTX_cleanup.argtypes = (c_void_p,)
@@ -61,7 +59,15 @@ def load_openssl():
     if hasattr(libcrypto, 'OpenSSL_add_all_ciphers'):
         libcrypto.OpenSSL_add_all_ciphers()
 
-    buf = create_string_buffer(buf_size)
+    if hasattr(libcrypto, 'OSSL_PROVIDER_load'):
+        # OpenSSL 3 moved rc4, bf, cast5, des, idea, rc2 and seed to the
+        # legacy provider, and loading any provider stops the default one
+        # from being loaded implicitly
+        libcrypto.OSSL_PROVIDER_load.restype = c_void_p
+        libcrypto.OSSL_PROVIDER_load.argtypes = (c_void_p, c_char_p)
+        libcrypto.OSSL_PROVIDER_load(None, b'legacy')
+        libcrypto.OSSL_PROVIDER_load(None, b'default')
+
     loaded = True
 
 
@@ -94,6 +100,8 @@ class OpenSSLCrypto(object):
             raise Exception('cipher %s not found in libcrypto' % cipher_name)
         key_ptr = c_char_p(key)
         iv_ptr = c_char_p(iv)
+        # without an iv, like rc4, only the key restarts the keystream
+        self._reset_key = None if iv else key
         self._ctx = libcrypto.EVP_CIPHER_CTX_new()
         if not self._ctx:
             raise Exception('can not create cipher context')
@@ -104,16 +112,33 @@ class OpenSSLCrypto(object):
             raise Exception('can not initialize cipher context')
 
     def update(self, data):
-        global buf_size, buf
-        cipher_out_len = c_long(0)
+        # data may be bytes or any buffer, like bytearray or memoryview
         l = len(data)
-        if buf_size < l:
-            buf_size = l * 2
-            buf = create_string_buffer(buf_size)
-        libcrypto.EVP_CipherUpdate(self._ctx, byref(buf),
-                                   byref(cipher_out_len), c_char_p(data), l)
-        # buf is copied to a str object when we access buf.raw
-        return buf.raw[:cipher_out_len.value]
+        buf = util.get_buffer(l + 64)
+        return string_at(buf, self._update(util.c_buffer(data), buf, l))
+
+    def update_into(self, data, out):
+        # writes into the writable buffer out, which needs room for
+        # len(data) bytes plus a block, returns the number of bytes written
+        # out may be data itself
+        return self._update(util.c_buffer(data), util.c_out_buffer(out),
+                            len(data))
+
+    def _update(self, data, out, l):
+        cipher_out_len = c_long(0)
+        libcrypto.EVP_CipherUpdate(self._ctx, out, byref(cipher_out_len),
+                                   data, l)
+        return cipher_out_len.value
+
+    def reset(self, iv, key=None):
+        # start a new message on the same context, cipher and op are kept
+        # and so is the key unless a new one is given
+        if key is None:
+            key = self._reset_key
+        r = libcrypto.EVP_CipherInit_ex(self._ctx, None, None,
+                                        key, iv, c_int(-1))
+        if not r:
+            raise Exception('can not reinitialize cipher context')
 
     def __del__(self):
         self.clean()
@@ -125,6 +150,7 @@ class OpenSSLCrypto(object):
             else:
                 libcrypto.EVP_CIPHER_CTX_reset(self._ctx)
             libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
 
 
 ciphers = {
@@ -167,6 +193,20 @@ def run_method(method):
     util.run_cipher(cipher, decipher)
 
 
+def test_update_into():
+    util.run_update_into(OpenSSLCrypto('aes-128-ctr', b'k' * 16, b'i' * 16, 1),
+                         OpenSSLCrypto('aes-128-ctr', b'k' * 16, b'i' * 16, 0))
+
+
+def test_reset():
+    for method in ('aes-128-ctr', 'aes-256-cfb'):
+        util.run_reset(OpenSSLCrypto(method, b'k' * 32, b'i' * 16, 1),
+                       lambda iv: OpenSSLCrypto(method, b'k' * 32, iv, 1),
+                       16)
+    util.run_reset(OpenSSLCrypto('rc4', b'k' * 16, b'', 1),
+                   lambda iv: OpenSSLCrypto('rc4', b'k' * 16, iv, 1), 0)
+
+
 def test_aes_128_cfb():
     run_method('aes-128-cfb')
 
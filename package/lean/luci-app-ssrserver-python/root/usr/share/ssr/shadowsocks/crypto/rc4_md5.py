@@ -24,13 +24,26 @@ from shadowsocks.crypto import openssl
 __all__ = ['ciphers']
 
 
+class RC4MD5Crypto(openssl.OpenSSLCrypto):
+    def __init__(self, key, iv, op):
+        self._key = key
+        openssl.OpenSSLCrypto.__init__(self, b'rc4', self._rc4_key(iv), b'',
+                                       op)
+
+    def _rc4_key(self, iv):
+        md5 = hashlib.md5()
+        md5.update(self._key)
+        md5.update(iv)
+        return md5.digest()
+
+    def reset(self, iv, key=None):
+        # the rc4 key is derived from the iv, so every message is a rekey
+        openssl.OpenSSLCrypto.reset(self, b'', self._rc4_key(iv))
+
+
 def create_cipher(alg, key, iv, op, key_as_bytes=0, d=None, salt=None,
                   i=1, padding=1):
-    md5 = hashlib.md5()
-    md5.update(key)
-    md5.update(iv)
-    rc4_key = md5.digest()
-    return openssl.OpenSSLCrypto(b'rc4', rc4_key, b'', op)
+    return RC4MD5Crypto(key, iv, op)
 
 
 ciphers = {
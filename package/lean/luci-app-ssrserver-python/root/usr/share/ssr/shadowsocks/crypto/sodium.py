@@ -18,7 +18,7 @@ from __future__ import absolute_import, division, print_function, \
     with_statement
 
 from ctypes import c_char_p, c_int, c_ulong, c_ulonglong, byref, \
-    create_string_buffer, c_void_p
+    create_string_buffer, c_void_p, string_at, memmove, addressof, cast
 
 from shadowsocks.crypto import util
 
@@ -27,14 +27,12 @@ __all__ = ['ciphers']
 libsodium = None
 loaded = False
 
-buf_size = 2048
-
 # for salsa20 and chacha20 and chacha20-ietf
 BLOCK_SIZE = 64
 
 
 def load_libsodium():
-    global loaded, libsodium, buf
+    global loaded, libsodium
 
     libsodium = util.find_library('sodium', 'crypto_stream_salsa20_xor_ic',
                                   'libsodium')
@@ -42,26 +40,25 @@ def load_libsodium():
         raise Exception('libsodium not found')
 
     libsodium.crypto_stream_salsa20_xor_ic.restype = c_int
-    libsodium.crypto_stream_salsa20_xor_ic.argtypes = (c_void_p, c_char_p,
+    libsodium.crypto_stream_salsa20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                        c_ulonglong,
                                                        c_char_p, c_ulonglong,
                                                        c_char_p)
     libsodium.crypto_stream_chacha20_xor_ic.restype = c_int
-    libsodium.crypto_stream_chacha20_xor_ic.argtypes = (c_void_p, c_char_p,
+    libsodium.crypto_stream_chacha20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                         c_ulonglong,
                                                         c_char_p, c_ulonglong,
                                                         c_char_p)
 
     try:
         libsodium.crypto_stream_chacha20_ietf_xor_ic.restype = c_int
-        libsodium.crypto_stream_chacha20_ietf_xor_ic.argtypes = (c_void_p, c_char_p,
+        libsodium.crypto_stream_chacha20_ietf_xor_ic.argtypes = (c_void_p, c_void_p,
                                                         c_ulonglong,
                                                         c_char_p, c_ulong,
                                                         c_char_p)
     except:
         pass
 
-    buf = create_string_buffer(buf_size)
     loaded = True
 
 
@@ -85,24 +82,46 @@ class SodiumCrypto(object):
         self.counter = 0
 
     def update(self, data):
-        global buf_size, buf
+        # data may be bytes or any buffer, like bytearray or memoryview
         l = len(data)
+        buf = util.get_buffer(l)
+        self._update(util.c_buffer(data), buf, l)
+        return string_at(buf, l)
 
-        # we can only prepend some padding to make the encryption align to
-        # blocks
-        padding = self.counter % BLOCK_SIZE
-        if buf_size < padding + l:
-            buf_size = (padding + l) * 2
-            buf = create_string_buffer(buf_size)
+    def update_into(self, data, out):
+        # writes len(data) bytes into the writable buffer out, which may be
+        # data itself
+        l = len(data)
+        self._update(util.c_buffer(data), util.c_out_buffer(out), l)
+        return l
 
-        if padding:
-            data = (b'\0' * padding) + data
-        self.cipher(byref(buf), c_char_p(data), padding + l,
-                    self.iv_ptr, int(self.counter / BLOCK_SIZE), self.key_ptr)
-        self.counter += l
-        # buf is copied to a str object when we access buf.raw
-        # strip off the padding
-        return buf.raw[padding:padding + l]
+    def _update(self, data, out, l):
+        # the stream can only start at a block boundary, so a partial first
+        # block goes through a small block with some padding prepended
+        padding = self.counter % BLOCK_SIZE
+        if padding and l:
+            head = min(BLOCK_SIZE - padding, l)
+            data = cast(data, c_void_p).value
+            out = cast(out, c_void_p).value
+            block = create_string_buffer(BLOCK_SIZE)
+            memmove(addressof(block) + padding, data, head)
+            self.cipher(block, block, BLOCK_SIZE, self.iv_ptr,
+                        self.counter // BLOCK_SIZE, self.key_ptr)
+            memmove(out, addressof(block) + padding, head)
+            self.counter += head
+            data += head
+            out += head
+            l -= head
+        if l:
+            self.cipher(out, data, l, self.iv_ptr,
+                        self.counter // BLOCK_SIZE, self.key_ptr)
+            self.counter += l
+
+    def reset(self, iv):
+        # start a new message with the same key
+        self.iv = iv
+        self.iv_ptr = c_char_p(iv)
+        self.counter = 0
 
 
 ciphers = {
@@ -127,6 +146,16 @@ def test_chacha20():
     util.run_cipher(cipher, decipher)
 
 
+def test_update_into():
+    util.run_update_into(SodiumCrypto('chacha20', b'k' * 32, b'i' * 8, 1),
+                         SodiumCrypto('chacha20', b'k' * 32, b'i' * 8, 0))
+
+
+def test_reset():
+    util.run_reset(SodiumCrypto('chacha20', b'k' * 32, b'i' * 8, 1),
+                   lambda iv: SodiumCrypto('chacha20', b'k' * 32, iv, 1), 8)
+
+
 def test_chacha20_ietf():
 
     cipher = SodiumCrypto('chacha20-ietf', b'k' * 32, b'i' * 16, 1)
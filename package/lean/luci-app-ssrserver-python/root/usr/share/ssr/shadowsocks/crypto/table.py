@@ -60,11 +60,21 @@ class TableCipher(object):
         self._op = op
 
     def update(self, data):
+        if type(data) is not bytes:
+            data = memoryview(data).tobytes()
         if self._op:
             return translate(data, self._encrypt_table)
         else:
             return translate(data, self._decrypt_table)
 
+    def update_into(self, data, out):
+        l = len(data)
+        out[:l] = self.update(data)
+        return l
+
+    def reset(self, iv):
+        pass
+
 class NoneCipher(object):
     def __init__(self, cipher_name, key, iv, op):
         pass
@@ -72,6 +82,15 @@ class NoneCipher(object):
     def update(self, data):
         return data
 
+    def update_into(self, data, out):
+        l = len(data)
+        if out is not data:
+            out[:l] = data
+        return l
+
+    def reset(self, iv):
+        pass
+
 ciphers = {
     'none': (16, 0, NoneCipher),
     'table': (16, 0, TableCipher)
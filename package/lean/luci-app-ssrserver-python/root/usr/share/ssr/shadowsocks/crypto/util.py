@@ -19,6 +19,39 @@ from __future__ import absolute_import, division, print_function, \
 
 import os
 import logging
+import threading
+from ctypes import c_char, create_string_buffer
+
+# every thread gets its own scratch output buffer, so ciphers can run in
+# several loops or threads at the same time
+_scratch = threading.local()
+
+
+def get_buffer(size):
+    buf = getattr(_scratch, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = create_string_buffer(max(size * 2, 2048))
+        _scratch.buf = buf
+    return buf
+
+
+def c_buffer(data):
+    # data as an argument for a c_void_p parameter, bytes and writable
+    # buffers such as bytearray are passed without a copy
+    if type(data) is bytes:
+        return data
+    try:
+        return (c_char * len(data)).from_buffer(data)
+    except TypeError:
+        # read only buffers like a memoryview of bytes
+        if isinstance(data, memoryview):
+            return data.tobytes()
+        return bytes(data)
+
+
+def c_out_buffer(out):
+    # out has to be writable, raises TypeError otherwise
+    return (c_char * len(out)).from_buffer(out)
 
 
 def find_library_nt(name):
@@ -123,6 +156,32 @@ def run_cipher(cipher, decipher):
     assert b''.join(results) == plain
 
 
+def run_reset(cipher, new_cipher, iv_len):
+    # a reset context must encrypt exactly like a fresh one
+    from os import urandom
+
+    plain = urandom(1400)
+    cipher.update(urandom(100))
+    for i in range(4):
+        iv = urandom(iv_len)
+        cipher.reset(iv)
+        assert cipher.update(plain) == new_cipher(iv).update(plain)
+
+
+def run_update_into(cipher, decipher):
+    # update_into must agree with update, also when working in place
+    from os import urandom
+
+    plain = urandom(5000)
+    c = cipher.update(plain[:333])
+    buf = bytearray(plain[333:])
+    assert cipher.update_into(memoryview(buf), buf) == len(buf)
+    c += bytes(buf)
+    out = bytearray(len(c) + 64)
+    assert decipher.update_into(c, out) == len(c)
+    assert bytes(out[:len(c)]) == plain
+
+
 def test_find_library():
     assert find_library('c', 'strcpy', 'libc') is not None
     assert find_library(['c'], 'strcpy', 'libc') is not None
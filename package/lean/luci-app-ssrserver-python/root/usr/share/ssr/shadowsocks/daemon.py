@@ -27,6 +27,9 @@ from shadowsocks import common, shell
 
 # this module is ported from ShadowVPN daemon.c
 
+# the locked pid file of this daemon
+_pid_file_fd = None
+
 
 def daemon_exec(config):
     if 'daemon' in config:
@@ -51,6 +54,7 @@ def daemon_exec(config):
 
 
 def write_pid_file(pid_file, pid):
+    global _pid_file_fd
     import fcntl
     import stat
 
@@ -79,9 +83,18 @@ def write_pid_file(pid_file, pid):
         return -1
     os.ftruncate(fd, 0)
     os.write(fd, common.to_bytes(str(pid)))
+    _pid_file_fd = fd
     return 0
 
 
+def release_pid_file():
+    # unlocks the pid file so a server this one handed over to can take it
+    global _pid_file_fd
+    if _pid_file_fd is not None:
+        os.close(_pid_file_fd)
+        _pid_file_fd = None
+
+
 def freopen(f, mode, stream):
     oldf = open(f, mode)
     oldfd = oldf.fileno()
@@ -146,6 +146,16 @@ class Encryptor(object):
         else:
             return b''
 
+    def encrypt_in_place(self, buf, l):
+        # encrypts the first l bytes of the writable buffer buf, which needs
+        # some spare room after them, and returns the length of the result
+        # only for after the iv has been sent, see encrypt
+        return self.cipher.update_into(memoryview(buf)[:l], buf)
+
+    def decrypt_in_place(self, buf, l):
+        # like encrypt_in_place, once the decipher is set up, see decrypt
+        return self.decipher.update_into(memoryview(buf)[:l], buf)
+
 def encrypt_all(password, method, op, data):
     result = []
     method = method.lower()
@@ -183,7 +193,9 @@ def encrypt_new_iv(method):
     (key_len, iv_len, m) = method_supported[method]
     return random_string(iv_len)
 
-def encrypt_all_iv(key, method, op, data, ref_iv):
+def encrypt_all_iv(key, method, op, data, ref_iv, cipher_cache=None):
+    # cipher_cache is a dict owned by the caller, contexts found there are
+    # reset to the new iv instead of creating a new cipher per message
     result = []
     method = method.lower()
     (key_len, iv_len, m) = method_supported[method]
@@ -194,7 +206,15 @@ def encrypt_all_iv(key, method, op, data, ref_iv):
         iv = data[:iv_len]
         data = data[iv_len:]
         ref_iv[0] = iv
-    cipher = m(method, key, iv, op)
+    if cipher_cache is None:
+        cipher = m(method, key, iv, op)
+    else:
+        cipher = cipher_cache.get((method, key, op), None)
+        if cipher is None:
+            cipher = m(method, key, iv, op)
+            cipher_cache[(method, key, op)] = cipher
+        else:
+            cipher.reset(iv)
     result.append(cipher.update(data))
     return b''.join(result)
 
@@ -231,6 +251,23 @@ def test_encrypt_all():
         assert plain == plain2
 
 
+def test_encrypt_all_iv_cache():
+    from os import urandom
+    cache = {}
+    # rc4 has no iv, a cached context has to be rekeyed for every message
+    for method in CIPHERS_TO_TEST + ['rc4']:
+        logging.warn(method)
+        key = encrypt_key(b'key', method)
+        for i in range(3):
+            plain = urandom(1400)
+            ref_iv = [encrypt_new_iv(method)]
+            cipher = encrypt_all_iv(key, method, 1, plain, ref_iv, cache)
+            assert cipher == encrypt_all_iv(key, method, 1, plain, ref_iv)
+            plain2 = encrypt_all_iv(key, method, 0, cipher, [b''], cache)
+            assert plain == plain2
+
+
 if __name__ == '__main__':
     test_encrypt_all()
     test_encryptor()
+    test_encrypt_all_iv_cache()
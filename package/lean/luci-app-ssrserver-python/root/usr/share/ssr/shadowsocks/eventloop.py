@@ -23,6 +23,7 @@ from __future__ import absolute_import, division, print_function, \
 
 import os
 import time
+import heapq
 import socket
 import select
 import errno
@@ -55,6 +56,10 @@ EVENT_NAMES = {
 # we check timeouts every TIMEOUT_PRECISION seconds
 TIMEOUT_PRECISION = 2
 
+# rebuild the timer heap once this many cancelled timers pile up in it and
+# they make up more than half of the heap
+TIMER_COMPACT_MIN = 256
+
 
 class KqueueLoop(object):
 
@@ -110,6 +115,8 @@ class SelectLoop(object):
         self._x_list = set()
 
     def poll(self, timeout):
+        if timeout < 0:
+            timeout = None  # block until an event arrives
         r, w, x = select.select(self._r_list, self._w_list, self._x_list,
                                 timeout)
         results = defaultdict(lambda: POLL_NULL)
@@ -142,6 +149,26 @@ class SelectLoop(object):
         pass
 
 
+class Timer(object):
+    # a callback scheduled on the event loop, returned by call_at,
+    # call_later and call_repeating so the caller can cancel it
+    # interval > 0 makes it fire repeatedly every interval seconds
+    def __init__(self, loop, deadline, callback, interval=0):
+        self._loop = loop
+        self._scheduled = False
+        self.deadline = deadline
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self._scheduled:
+            self._loop._timer_cancelled()
+
+
 class EventLoop(object):
     def __init__(self):
         if hasattr(select, 'epoll'):
@@ -157,9 +184,15 @@ class EventLoop(object):
             raise Exception('can not find any available functions in select '
                             'package')
         self._fdmap = {}  # (f, handler)
-        self._last_time = time.time()
         self._periodic_callbacks = []
+        self._periodic_timer = None
+        self._timers = []  # heap of (deadline, seq, timer)
+        self._timer_seq = 0
+        self._timers_cancelled = 0
         self._stopping = False
+        # coarse clock, refreshed once per iteration after poll returns,
+        # cheap enough to read on every packet
+        self.now = time.time()
         logging.debug('using event model: %s', model)
 
     def poll(self, timeout=None):
@@ -181,15 +214,89 @@ class EventLoop(object):
         self._impl.unregister(fd)
 
     def add_periodic(self, callback):
+        # periodic callbacks share one repeating timer
         self._periodic_callbacks.append(callback)
+        if self._periodic_timer is None:
+            self._periodic_timer = self.call_repeating(TIMEOUT_PRECISION,
+                                                       self._run_periodic)
 
     def remove_periodic(self, callback):
         self._periodic_callbacks.remove(callback)
+        if not self._periodic_callbacks and self._periodic_timer:
+            self._periodic_timer.cancel()
+            self._periodic_timer = None
+
+    def _run_periodic(self):
+        for callback in list(self._periodic_callbacks):
+            callback()
 
     def modify(self, f, mode):
         fd = f.fileno()
         self._impl.modify(fd, mode)
 
+    def call_at(self, deadline, callback):
+        # O(log n), deadline is an absolute time.time() value
+        return self._schedule(Timer(self, deadline, callback))
+
+    def call_later(self, delay, callback):
+        return self._schedule(Timer(self, time.time() + delay, callback))
+
+    def call_repeating(self, interval, callback):
+        # first call after interval seconds, then every interval seconds
+        return self._schedule(Timer(self, time.time() + interval, callback,
+                                    interval))
+
+    def _schedule(self, timer):
+        self._timer_seq += 1
+        timer._scheduled = True
+        heapq.heappush(self._timers, (timer.deadline, self._timer_seq, timer))
+        return timer
+
+    def _timer_cancelled(self):
+        # cancelled timers stay in the heap until they reach the top,
+        # compact it if they start to dominate
+        self._timers_cancelled += 1
+        if self._timers_cancelled > TIMER_COMPACT_MIN and \
+                self._timers_cancelled * 2 > len(self._timers):
+            self._timers = [t for t in self._timers if not t[2].cancelled]
+            heapq.heapify(self._timers)
+            self._timers_cancelled = 0
+
+    def _pop_timer(self):
+        timer = heapq.heappop(self._timers)[2]
+        timer._scheduled = False
+        if timer.cancelled:
+            self._timers_cancelled -= 1
+        return timer
+
+    def _poll_timeout(self):
+        # sleep exactly until the next deadline, -1 blocks until an event
+        while self._timers and self._timers[0][2].cancelled:
+            self._pop_timer()
+        if self._timers:
+            return max(self._timers[0][0] - time.time(), 0)
+        return -1
+
+    def _run_timers(self, now):
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            timer = self._pop_timer()
+            if timer.cancelled:
+                continue
+            if timer.interval > 0:
+                timer.deadline += timer.interval
+                if timer.deadline <= now:
+                    # we fell behind, do not fire a burst to catch up
+                    timer.deadline = now + timer.interval
+                self._schedule(timer)
+            else:
+                timer.cancelled = True
+            try:
+                timer.callback()
+            except (OSError, IOError) as e:
+                shell.print_exception(e)
+            timers = self._timers
+
     def stop(self):
         self._stopping = True
 
@@ -198,8 +305,9 @@ class EventLoop(object):
         while not self._stopping:
             asap = False
             try:
-                events = self.poll(TIMEOUT_PRECISION)
+                events = self.poll(self._poll_timeout())
             except (OSError, IOError) as e:
+                events = []
                 if errno_from_exception(e) in (errno.EPIPE, errno.EINTR):
                     # EPIPE: Happens when the client closes the connection
                     # EINTR: Happens when received a signal
@@ -212,6 +320,7 @@ class EventLoop(object):
                     traceback.print_exc()
                     continue
 
+            self.now = time.time()
             handle = False
             for sock, fd, event in events:
                 handler = self._fdmap.get(fd, None)
@@ -221,11 +330,9 @@ class EventLoop(object):
                         handle = handler.handle_event(sock, fd, event) or handle
                     except (OSError, IOError) as e:
                         shell.print_exception(e)
-            now = time.time()
-            if asap or now - self._last_time >= TIMEOUT_PRECISION:
-                for callback in self._periodic_callbacks:
-                    callback()
-                self._last_time = now
+            if asap:
+                self._run_periodic()
+            self._run_timers(self.now)
             if events and not handle:
                 time.sleep(0.001)
 
@@ -256,3 +363,42 @@ def errno_from_exception(e):
 def get_sock_error(sock):
     error_number = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
     return socket.error(error_number, os.strerror(error_number))
+
+
+def test_call_later():
+    loop = EventLoop()
+    fired = []
+    t = loop.call_later(0.05, lambda: fired.append(2))
+    loop.call_later(0.01, lambda: fired.append(1))
+    loop.call_later(0.02, lambda: fired.append(0)).cancel()
+    assert 0 < loop._poll_timeout() <= 0.01
+    time.sleep(0.06)
+    loop._run_timers(time.time())
+    assert fired == [1, 2]
+    assert t.cancelled
+    assert loop._poll_timeout() == -1
+
+
+def test_call_repeating():
+    loop = EventLoop()
+    fired = []
+    now = time.time()
+    t = loop.call_repeating(10, lambda: fired.append(1))
+    loop.call_at(now + 5, lambda: fired.append(0))
+    loop._run_timers(now + 11)
+    assert fired == [0, 1]
+    assert now + 20 <= t.deadline < now + 21
+    loop._run_timers(now + 45)
+    assert fired == [0, 1, 1]
+    assert t.deadline == now + 55  # rescheduled from now, no burst
+    t.cancel()
+    assert loop._poll_timeout() == -1
+
+    for i in range(TIMER_COMPACT_MIN * 2):
+        loop.call_later(i + 1, lambda: None).cancel()
+    assert len(loop._timers) <= TIMER_COMPACT_MIN + 1
+
+
+if __name__ == '__main__':
+    test_call_later()
+    test_call_repeating()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import errno
+import array
+import socket
+import logging
+
+from shadowsocks import eventloop, daemon, shell, common
+
+# hot upgrade, with 'handover_socket' set to a path a running server listens
+# there on a UNIX socket, a newly started server connects to it before
+# binding anything and is sent the listening TCP and UDP sockets with
+# SCM_RIGHTS, the relays it creates then reuse them instead of binding new
+# ones, so no connection attempt is refused while both run
+# the old server stops accepting, leaves its pid file to the new one and
+# keeps relaying its connections until they are done or
+# 'handover_drain_timeout' seconds have passed
+
+HANDOVER_DRAIN_TIMEOUT = 120
+# a server pool closes the received sockets no port was created for after
+# this many seconds
+HANDOVER_CLAIM_TIMEOUT = 60
+HANDOVER_CONNECT_TIMEOUT = 5
+# SCM_MAX_FD is 253 on Linux
+FDS_PER_MESSAGE = 200
+
+supported = hasattr(socket, 'AF_UNIX') and \
+    hasattr(socket.socket, 'sendmsg') and hasattr(socket.socket, 'recvmsg')
+
+# (socket type, address, port) -> socket received from the old server
+_inherited = {}
+
+
+def _key(socktype, sa):
+    return int(socktype), sa[0], sa[1]
+
+
+def receive(path):
+    # takes over the listening sockets of the server at path, returns how
+    # many were received
+    if not path or not supported:
+        return 0
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(HANDOVER_CONNECT_TIMEOUT)
+    try:
+        conn.connect(path)
+    except (OSError, IOError) as e:
+        conn.close()
+        if eventloop.errno_from_exception(e) not in (errno.ENOENT,
+                                                     errno.ECONNREFUSED):
+            shell.print_exception(e)
+        return 0
+    fds = []
+    try:
+        while True:
+            data, ancdata, flags, addr = conn.recvmsg(
+                1, socket.CMSG_SPACE(FDS_PER_MESSAGE * 4))
+            for level, kind, cdata in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    a = array.array('i')
+                    a.frombytes(cdata[:len(cdata) - len(cdata) % a.itemsize])
+                    fds.extend(a)
+            if not data:
+                break
+    except (OSError, IOError) as e:
+        shell.print_exception(e)
+    finally:
+        conn.close()
+    for fd in fds:
+        sock = socket.socket(fileno=fd)
+        _inherited[_key(sock.type, sock.getsockname())] = sock
+    logging.info('took over %d sockets from %s' %
+                 (len(fds), common.to_str(path)))
+    return len(fds)
+
+
+def take(socktype, sa):
+    # a received socket bound to sa, or None
+    return _inherited.pop(_key(socktype, sa), None)
+
+
+def close_unclaimed():
+    # sockets of ports no relay was created for
+    for key, sock in list(_inherited.items()):
+        logging.info('closing unclaimed %s:%d' % key[1:])
+        sock.close()
+    _inherited.clear()
+
+
+class HandoverServer(object):
+    def __init__(self, path, get_relays, drain_callback,
+                 drain_timeout=HANDOVER_DRAIN_TIMEOUT):
+        # get_relays returns the TCPRelays and UDPRelays to hand over,
+        # drain_callback is called once they are done
+        self._path = path
+        self._get_relays = get_relays
+        self._drain_callback = drain_callback
+        self._drain_timeout = drain_timeout
+        self._eventloop = None
+        self._relays = None
+        self._deadline = 0
+        if os.path.exists(path):
+            # left over by a server that did not exit cleanly
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(1)
+        sock.setblocking(False)
+        self._sock = sock
+
+    def add_to_loop(self, loop):
+        if self._eventloop:
+            raise Exception('already add to loop')
+        self._eventloop = loop
+        loop.add(self._sock, eventloop.POLL_IN, self)
+
+    def handle_event(self, sock, fd, event):
+        try:
+            conn = self._sock.accept()[0]
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in (errno.EAGAIN,
+                                                         errno.EWOULDBLOCK):
+                shell.print_exception(e)
+            return True
+        # the new server serves the path from now on
+        self.close()
+        relays = [r for r in self._get_relays()
+                  if r.get_server_socket() is not None]
+        fds = [r.get_server_socket().fileno() for r in relays]
+        conn.setblocking(True)
+        try:
+            for i in range(0, len(fds), FDS_PER_MESSAGE):
+                a = array.array('i', fds[i:i + FDS_PER_MESSAGE])
+                conn.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                       a.tobytes())])
+        except (OSError, IOError) as e:
+            # the new server did not get them, keep serving
+            shell.print_exception(e)
+            conn.close()
+            return True
+        # the new server takes the pid file as soon as it sees the
+        # connection closed, it has to be unlocked by then
+        daemon.release_pid_file()
+        conn.close()
+        logging.warn('handed %d sockets over, draining connections' %
+                     len(fds))
+        for relay in relays:
+            relay.stop_listening()
+        self._relays = relays
+        self._deadline = self._eventloop.now + self._drain_timeout
+        self._eventloop.add_periodic(self.handle_periodic)
+        return True
+
+    def handle_periodic(self):
+        if self._eventloop.now < self._deadline and \
+                not all(r.is_idle() for r in self._relays):
+            return
+        self._eventloop.remove_periodic(self.handle_periodic)
+        if self._eventloop.now >= self._deadline:
+            logging.warn('drain timed out')
+        else:
+            logging.info('drained')
+        self._drain_callback()
+
+    def close(self):
+        if self._sock is None:
+            return
+        if self._eventloop:
+            self._eventloop.remove(self._sock)
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+
+def test_handover():
+    import tempfile
+
+    class Relay(object):
+        def __init__(self, sock):
+            self.sock = sock
+            self.stopped = False
+
+        def get_server_socket(self):
+            return self.sock
+
+        def stop_listening(self):
+            self.stopped = True
+
+        def is_idle(self):
+            return True
+
+    if not supported:
+        return
+    path = os.path.join(tempfile.mkdtemp(), 'handover.sock')
+    tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp.bind(('127.0.0.1', 0))
+    tcp.listen(1)
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind(('127.0.0.1', 0))
+    relays = [Relay(tcp), Relay(udp)]
+    drained = []
+    loop = eventloop.EventLoop()
+    server = HandoverServer(path, lambda: relays,
+                            lambda: drained.append(1) or loop.stop())
+    server.add_to_loop(loop)
+    # the receiving side blocks, so the old server runs in a child
+    pid = os.fork()
+    if pid == 0:
+        try:
+            loop.run()
+        finally:
+            os._exit(0 if drained and relays[0].stopped else 1)
+    assert receive(path) == 2
+    assert os.waitpid(pid, 0)[1] == 0
+    server._sock.close()
+    t = take(socket.SOCK_STREAM, tcp.getsockname())
+    u = take(socket.SOCK_DGRAM, udp.getsockname())
+    assert t is not None and u is not None
+    assert take(socket.SOCK_STREAM, tcp.getsockname()) is None
+    c = socket.create_connection(tcp.getsockname())
+    tcp.close()
+    # still accepting on the same socket after the old copy is closed
+    t.accept()[0].close()
+    c.close()
+    for s in (t, u, udp):
+        s.close()
+    assert not os.path.exists(path)
+
+
+def test_handover_pid_file():
+    # the old server holds the lock on the pid file until it hands over,
+    # the new one locks it right after receiving the sockets
+    import tempfile
+
+    class Relay(object):
+        def __init__(self, sock):
+            self.sock = sock
+
+        def get_server_socket(self):
+            return self.sock
+
+        def stop_listening(self):
+            pass
+
+        def is_idle(self):
+            return True
+
+    if not supported:
+        return
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'handover.sock')
+    pid_file = os.path.join(tmp, 'ssr.pid')
+    tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp.bind(('127.0.0.1', 0))
+    tcp.listen(1)
+    server = HandoverServer(path, lambda: [Relay(tcp)], lambda: None)
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        ok = False
+        try:
+            ok = daemon.write_pid_file(pid_file, os.getpid()) == 0
+            os.write(w, b'1')
+            loop = eventloop.EventLoop()
+            server.add_to_loop(loop)
+            loop.call_later(5, loop.stop)
+            server._drain_callback = loop.stop
+            loop.run()
+        finally:
+            os._exit(0 if ok else 1)
+    server._sock.close()
+    # the child has the lock before we connect
+    assert os.read(r, 1) == b'1'
+    assert daemon.write_pid_file(pid_file, os.getpid()) == -1
+    assert receive(path) == 1
+    try:
+        assert daemon.write_pid_file(pid_file, os.getpid()) == 0
+    finally:
+        daemon.release_pid_file()
+        assert os.waitpid(pid, 0)[1] == 0
+        close_unclaimed()
+        tcp.close()
+        os.close(r)
+        os.close(w)
+
+
+if __name__ == '__main__':
+    test_handover()
+    test_handover_pid_file()
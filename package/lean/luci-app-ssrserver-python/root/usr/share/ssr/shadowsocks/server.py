@@ -30,7 +30,7 @@ if __name__ == '__main__':
     sys.path.insert(0, os.path.join(file_path, '../'))
 
 from shadowsocks import shell, daemon, eventloop, tcprelay, udprelay, \
-    asyncdns, manager, common
+    asyncdns, manager, common, handover
 
 
 def main():
@@ -40,6 +40,17 @@ def main():
 
     shell.log_shadowsocks_version()
 
+    handover_path = config.get('handover_socket', None)
+    if handover_path and int(config['workers']) > 1:
+        logging.warn('handover is not available with workers')
+        handover_path = None
+    if handover_path and not handover.supported:
+        logging.warn('handover needs python 3.3 or newer')
+        handover_path = None
+    if handover_path and config.get('daemon', None) in (None, '', 'start'):
+        # before forking, the old server leaves the pid file to us
+        handover.receive(handover_path)
+
     daemon.daemon_exec(config)
 
     try:
@@ -70,7 +81,8 @@ def main():
 
     tcp_servers = []
     udp_servers = []
-    dns_resolver = asyncdns.DNSResolver(config['black_hostname_list'])
+    dns_resolver = asyncdns.DNSResolver(config['black_hostname_list'],
+                                        config.get('black_hostname_file'))
     if int(config['workers']) > 1:
         stat_counter_dict = None
     else:
@@ -148,6 +160,7 @@ def main():
         except Exception as e:
             if not ipv6_ok:
                 shell.print_exception(e)
+    handover.close_unclaimed()
 
     def run_server():
         def child_handler(signum, _):
@@ -167,6 +180,13 @@ def main():
             loop = eventloop.EventLoop()
             dns_resolver.add_to_loop(loop)
             list(map(lambda s: s.add_to_loop(loop), tcp_servers + udp_servers))
+            if handover_path:
+                handover.HandoverServer(handover_path,
+                                        lambda: tcp_servers + udp_servers,
+                                        loop.stop,
+                                        config.get('handover_drain_timeout',
+                                                   handover.HANDOVER_DRAIN_TIMEOUT)
+                                        ).add_to_loop(loop)
 
             daemon.set_user(config.get('user', None))
             loop.run()
@@ -23,7 +23,8 @@ import json
 import sys
 import getopt
 import logging
-from shadowsocks.common import to_bytes, to_str, IPNetwork, PortRange
+from shadowsocks.common import to_bytes, to_str, IPNetwork, \
+    get_port_range
 from shadowsocks import encrypt
 
 VERBOSE_LEVEL = 5
@@ -145,7 +146,8 @@ def get_config(is_local):
     else:
         shortopts = 'hd:s:p:k:m:O:o:G:g:c:t:vq'
         longopts = ['help', 'fast-open', 'pid-file=', 'log-file=', 'workers=',
-                    'forbidden-ip=', 'user=', 'manager-address=', 'version']
+                    'forbidden-ip=', 'forbidden-ip-file=', 'user=',
+                    'manager-address=', 'version']
     try:
         optlist, args = getopt.getopt(sys.argv[1:], shortopts, longopts)
         for key, value in optlist:
@@ -210,6 +212,8 @@ def get_config(is_local):
                 config['user'] = to_str(value)
             elif key == '--forbidden-ip':
                 config['forbidden_ip'] = to_str(value)
+            elif key == '--forbidden-ip-file':
+                config['forbidden_ip_file'] = to_str(value)
 
             elif key == '-d':
                 config['daemon'] = to_str(value)
@@ -264,14 +268,22 @@ def get_config(is_local):
         config['black_hostname_list'] = to_str(config.get('black_hostname_list', '')).split(',')
         if len(config['black_hostname_list']) == 1 and config['black_hostname_list'][0] == '':
             config['black_hostname_list'] = []
+        config['black_hostname_file'] = \
+            to_str(config.get('black_hostname_file', ''))
         try:
             config['forbidden_ip'] = \
                 IPNetwork(config.get('forbidden_ip', '127.0.0.0/8,::1/128'))
+            # large blocklists are kept in files, one network per line
+            for path in to_str(config.get('forbidden_ip_file', '')).split(','):
+                if path:
+                    count = config['forbidden_ip'].add_file(path)
+                    logging.info('loaded %d forbidden networks from %s' %
+                                 (count, path))
         except Exception as e:
             logging.error(e)
             sys.exit(2)
         try:
-            config['forbidden_port'] = PortRange(config.get('forbidden_port', ''))
+            config['forbidden_port'] = get_port_range(config.get('forbidden_port', ''))
         except Exception as e:
             logging.error(e)
             sys.exit(2)
@@ -361,6 +373,9 @@ Proxy options:
   --fast-open            use TCP_FASTOPEN, requires Linux 3.7+
   --workers WORKERS      number of workers, available on Unix/Linux
   --forbidden-ip IPLIST  comma seperated IP list forbidden to connect
+  --forbidden-ip-file FILES
+                         comma seperated files of networks forbidden to
+                         connect, one per line
   --manager-address ADDR optional server manager UDP address, see wiki
 
 General options:
@@ -18,6 +18,8 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import os
+import re
 import time
 import socket
 import errno
@@ -28,10 +30,24 @@ import traceback
 import random
 import platform
 import threading
+import array
 
-from shadowsocks import encrypt, obfs, eventloop, shell, common, lru_cache, version
+try:
+    import fcntl
+    import termios
+    FIONREAD = termios.FIONREAD
+except (ImportError, AttributeError):
+    FIONREAD = None
+
+from shadowsocks import encrypt, obfs, eventloop, shell, common, timing_wheel, \
+    buffer_pool, handover, version
 from shadowsocks.common import pre_parse_header, parse_header
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    from shadowsocks.ordereddict import OrderedDict
+
 # we clear at most TIMEOUTS_CLEAN_SIZE timeouts each time
 TIMEOUTS_CLEAN_SIZE = 512
 
@@ -95,6 +111,80 @@ TCP_MSS = NETWORK_MTU - 40
 BUF_SIZE = 32 * 1024
 UDP_MAX_BUF_SIZE = 65536
 
+# UDP over TCP, a connection packs up to this many datagrams that arrived
+# together into one TCP write, and remembers this many destination and
+# source addresses so their headers are only parsed once, a destination
+# given by name is left to the resolver, which knows when it expires
+UDP_RECV_BATCH = 16
+UDP_ADDR_CACHE_SIZE = 256
+
+# a speed limited stream sleeps at least this long before reading again
+PACE_MIN_DELAY = 0.005
+
+# accept at most this many connections per POLL_IN on a listening socket,
+# whatever is left in the backlog is picked up on the next loop iteration
+# so a connection flood on one port can not starve the other ports
+ACCEPT_BATCH = 16
+ACCEPT_BATCH_MAX = 256
+
+# a stream keeps reading while less than the high watermark is waiting to be
+# written to the other side, once it gets there reading stops until the
+# queue drains below the low watermark, configurable per direction with
+# write_buffer_high_up / _down and write_buffer_low_up / _down
+WRITE_BUFFER_HIGH = 64 * 1024
+WRITE_BUFFER_LOW = 16 * 1024
+
+# outbound connects race the resolved addresses as RFC 8305 describes, a
+# new attempt starts every 'connect_attempt_delay' seconds while the earlier
+# ones are pending, or right away when one fails, and each attempt is given
+# up after 'connect_timeout' seconds
+CONNECT_ATTEMPT_DELAY = 0.25
+CONNECT_TIMEOUT = 10
+# at most this many destinations are kept in a port's connect stats
+CONNECT_STAT_SIZE = 1024
+
+# admission control, a connection over one of these limits is closed before
+# a handler is built for it, 0 means no limit
+#   max_conn_per_ip    concurrent connections from one client address
+#   max_conn_per_port  concurrent connections on the port
+#   max_conn_per_user  concurrent connections of one user in mu mode, also
+#                      settable in a user's own config, this one is only
+#                      known once the protocol header has been decoded
+MAX_CONN_PER_IP = 0
+MAX_CONN_PER_PORT = 0
+MAX_CONN_PER_USER = 0
+# refused connections are all counted as 'limited' in the accept stats but
+# logged at most once every this many seconds for a client address or user
+LIMITED_LOG_INTERVAL = 60
+
+# 'socket_profile' tunes the accepted and the outbound sockets of a port, a
+# dict with any of sndbuf, rcvbuf, notsent_lowat (bytes), keepalive (idle
+# seconds before the first probe), keepalive_interval and keepalive_count
+if hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+    TCP_NOTSENT_LOWAT = socket.TCP_NOTSENT_LOWAT
+elif platform.system() == 'Linux':
+    TCP_NOTSENT_LOWAT = 25
+else:
+    TCP_NOTSENT_LOWAT = None
+
+# how _get_read_size learns how much is queued on a socket, per port with
+# 'read_size_policy'
+#   peek      recv with MSG_PEEK, an extra syscall copying the data
+#   fionread  ioctl(FIONREAD), an extra syscall that copies nothing
+#   adaptive  no extra syscall, guessed from how the last read went
+READ_SIZE_POLICIES = ('peek', 'fionread', 'adaptive')
+if FIONREAD is not None:
+    READ_SIZE_POLICY = 'fionread'
+else:
+    READ_SIZE_POLICY = 'peek'
+
+# with 'tcp_splice' a plain stream (method none, protocol origin, obfs plain)
+# is moved between the sockets by splice(2) once it reaches STAGE_STREAM
+# at most this much is moved per read, the default pipe capacity
+SPLICE_SIZE = 65536
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | \
+    getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
 class SpeedTester(object):
     def __init__(self, max_speed = 0):
         self.max_speed = max_speed * 1024
@@ -123,6 +213,207 @@ class SpeedTester(object):
             return self.sum_len >= self.max_speed
         return False
 
+    def wait_time(self):
+        # seconds until the bucket drains below the limit again,
+        # 0 if we can read right now
+        if self.isExceed():
+            return (self.sum_len - self.max_speed) / self.max_speed + PACE_MIN_DELAY
+        return 0
+
+
+def conn_limit(value, default):
+    # a limit left null, as mudb rows may have it, is the default
+    if value is None:
+        return default
+    return int(value)
+
+
+def socket_options(profile):
+    # the setsockopt calls a 'socket_profile' asks for
+    opts = []
+    if not profile:
+        return opts
+    if profile.get('sndbuf'):
+        opts.append((socket.SOL_SOCKET, socket.SO_SNDBUF, int(profile['sndbuf'])))
+    if profile.get('rcvbuf'):
+        opts.append((socket.SOL_SOCKET, socket.SO_RCVBUF, int(profile['rcvbuf'])))
+    if profile.get('notsent_lowat'):
+        if TCP_NOTSENT_LOWAT is None:
+            logging.warn('TCP_NOTSENT_LOWAT not supported on this OS')
+        else:
+            opts.append((socket.SOL_TCP, TCP_NOTSENT_LOWAT, int(profile['notsent_lowat'])))
+    if profile.get('keepalive'):
+        opts.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        for key, name in (('keepalive', 'TCP_KEEPIDLE'),
+                          ('keepalive_interval', 'TCP_KEEPINTVL'),
+                          ('keepalive_count', 'TCP_KEEPCNT')):
+            if profile.get(key) and hasattr(socket, name):
+                opts.append((socket.SOL_TCP, getattr(socket, name), int(profile[key])))
+    return opts
+
+
+def apply_socket_options(sock, opts):
+    for level, opt, value in opts:
+        try:
+            sock.setsockopt(level, opt, value)
+        except (OSError, IOError) as e:
+            logging.debug('setsockopt %d %d %d: %s' % (level, opt, value, e))
+
+
+class ConnectAttempt(object):
+    def __init__(self, sock, sa, start):
+        self.sock = sock
+        self.sa = sa
+        self.start = start
+        self.timer = None
+        # bytes of the queued upstream data sent in the SYN
+        self.sent = 0
+
+
+def parse_redirect_host(host):
+    # 'host:port' or 'host', None if the port is not a number
+    items = common.to_str(host).rsplit(':', 1)
+    if len(items) > 1:
+        try:
+            return (items[0], int(items[1]))
+        except ValueError:
+            return None
+    return (items[0], 80)
+
+
+class RedirectTable(object):
+    # the 'redirect' option compiled for one port, where a connection that
+    # fails the handshake is sent to, either of
+    #   ['host:port', ...]           picked by a hash of the client address
+    #                                and the data, entries with this port
+    #                                are preferred
+    #   ['regex:port#host:port', ...]
+    #                                the first entry whose regex is found in
+    #                                the data and whose port is this port,
+    #                                0 or *, '*' matches any data
+    def __init__(self, redirect, listen_port):
+        self.source = redirect
+        host_list = redirect or ["*#0.0.0.0:0"]
+        if type(host_list) != list:
+            host_list = [host_list]
+        self._ring = None
+        self._rules = []
+        if len(common.to_str(host_list[0]).rsplit('#', 1)) < 2:
+            ring = [hp for hp in map(parse_redirect_host, host_list) if hp]
+            same_port = [hp for hp in ring if hp[1] == listen_port]
+            self._ring = tuple(same_port or ring)
+            return
+        for host in host_list:
+            items_sum = common.to_str(host).rsplit('#', 1)
+            if len(items_sum) < 2:
+                continue
+            items_match = items_sum[0].rsplit(':', 1)
+            if len(items_match) > 1 and items_match[1] != "*":
+                try:
+                    port = int(items_match[1])
+                    if port != listen_port and port != 0:
+                        continue
+                except ValueError:
+                    pass
+            host_port = parse_redirect_host(items_sum[1])
+            if host_port is None:
+                continue
+            if items_match[0] == "*":
+                regex = None
+            else:
+                regex = re.compile(common.to_bytes(items_match[0]))
+            self._rules.append((regex, host_port))
+
+    def get_host(self, client_address, ogn_data):
+        if self._ring is not None:
+            if not self._ring:
+                return ("0.0.0.0", 0)
+            hash_code = binascii.crc32(ogn_data) & 0xffffffff
+            return self._ring[(hash_code + client_address_number(client_address[0])) % len(self._ring)]
+        for regex, host_port in self._rules:
+            if regex is None or regex.search(ogn_data):
+                return host_port
+        return ("0.0.0.0", 0)
+
+
+def client_address_number(address):
+    # the IPv4 address or the low 64 bits of the IPv6 one as an integer
+    af = common.is_ip(address)
+    if af == socket.AF_INET6:
+        return struct.unpack('>Q', common.inet_pton(af, address)[8:])[0]
+    elif af == socket.AF_INET:
+        return struct.unpack('>I', common.inet_pton(af, address))[0]
+    return 0
+
+
+def udp_header_length(frame):
+    # length of the address header frame starts with, 0 if it is not valid
+    addrtype = common.ord(frame[0]) & 7
+    if addrtype == 1:
+        return 7
+    if addrtype == 4:
+        return 19
+    if addrtype == 3 and len(frame) > 1:
+        return 4 + common.ord(frame[1])
+    return 0
+
+
+def interleave_families(ips):
+    # alternate between the address families, starting with the family of
+    # the first address so the resolver's preference still comes first
+    if not ips:
+        return []
+    family = common.is_ip(ips[0])
+    first = [ip for ip in ips if common.is_ip(ip) == family]
+    other = [ip for ip in ips if common.is_ip(ip) != family]
+    ret = []
+    for i in range(max(len(first), len(other))):
+        if i < len(first):
+            ret.append(first[i])
+        if i < len(other):
+            ret.append(other[i])
+    return ret
+
+
+class SplicePipe(object):
+    # one direction of a spliced stream, bytes go from the source socket
+    # into the pipe and from the pipe into the destination socket without
+    # ever being copied into python
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        self.pending = 0
+
+    def pull(self, fd):
+        # returns the number of bytes read from fd, 0 at EOF and None if
+        # there was nothing to read
+        try:
+            l = os.splice(fd, self._w, SPLICE_SIZE, flags=SPLICE_FLAGS)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                return None
+            raise
+        self.pending += l
+        return l
+
+    def push(self, fd):
+        # returns True once everything pulled has been written to fd
+        while self.pending:
+            try:
+                l = os.splice(self._r, fd, self.pending, flags=SPLICE_FLAGS)
+            except (OSError, IOError) as e:
+                if eventloop.errno_from_exception(e) in (errno.EAGAIN,
+                                                         errno.EWOULDBLOCK):
+                    return False
+                raise
+            self.pending -= l
+        return True
+
+    def close(self):
+        os.close(self._r)
+        os.close(self._w)
+
+
 class TCPRelayHandler(object):
     def __init__(self, server, fd_to_handlers, loop, local_sock, config,
                  dns_resolver, is_local):
@@ -146,6 +437,7 @@ class TCPRelayHandler(object):
         self._accept_address = local_sock.getsockname()[:2]
         self._user = None
         self._user_id = server._listen_port
+        self._user_counted = False
         self._update_tcp_mss(local_sock)
 
         # TCP Relay works as either sslocal or ssserver
@@ -156,6 +448,23 @@ class TCPRelayHandler(object):
         self._protocol = obfs.obfs(config['protocol'])
         self._overhead = self._obfs.get_overhead(self._is_local) + self._protocol.get_overhead(self._is_local)
         self._recv_buffer_size = BUF_SIZE - self._overhead
+        # without obfs and protocol the server can en/decrypt a stream right
+        # in the buffer it was received into
+        self._in_place = not is_local and \
+            self._obfs.method in ('plain', 'origin') and \
+            self._protocol.method in ('plain', 'origin')
+        self._splice = self._in_place and hasattr(os, 'splice') and \
+            config.get('tcp_splice', False) and \
+            config['method'].lower() == 'none'
+        self._splice_pipes = [None, None]  # indexed by STREAM_UP / STREAM_DOWN
+        self._eof = [False, False]  # indexed by STREAM_UP / STREAM_DOWN
+        self._connect_attempts = {}  # fd -> ConnectAttempt
+        self._connect_candidates = []
+        self._connect_port = 0
+        self._connect_timer = None
+        self._connect_timeout = config.get('connect_timeout', CONNECT_TIMEOUT)
+        self._connect_delay = config.get('connect_attempt_delay', CONNECT_ATTEMPT_DELAY)
+        self._fast_open_remote = not is_local and server.fast_open_remote
 
         server_info = obfs.server_info(server.obfs_data)
         server_info.host = config['server']
@@ -202,9 +511,19 @@ class TCPRelayHandler(object):
         self._ignore_bind_list = config.get('ignore_bind', [])
 
         self._fastopen_connected = False
-        self._data_to_write_to_local = []
-        self._data_to_write_to_remote = []
-        self._udp_data_send_buffer = b''
+        self._pace_timers = [None, None]  # indexed by STREAM_UP / STREAM_DOWN
+        self._data_to_write_to_local = buffer_pool.WriteQueue(server.buffer_pool)
+        self._data_to_write_to_remote = buffer_pool.WriteQueue(server.buffer_pool)
+        # indexed by STREAM_UP / STREAM_DOWN
+        self._write_high = [config.get('write_buffer_high_up', WRITE_BUFFER_HIGH),
+                            config.get('write_buffer_high_down', WRITE_BUFFER_HIGH)]
+        self._write_low = [min(config.get('write_buffer_low_up', WRITE_BUFFER_LOW), self._write_high[STREAM_UP]),
+                           min(config.get('write_buffer_low_down', WRITE_BUFFER_LOW), self._write_high[STREAM_DOWN])]
+        # frames from the client, read from _udp_data_send_offset on
+        self._udp_data_send_buffer = bytearray()
+        self._udp_data_send_offset = 0
+        self._udp_dest_cache = {}  # IPv4 or IPv6 address header -> (af, sa, remote_addr, server_addr)
+        self._udp_src_headers = {}  # source address -> address header
         self._upstream_status = WAIT_STATUS_READING
         self._downstream_status = WAIT_STATUS_INIT
         self._remote_address = None
@@ -216,6 +535,7 @@ class TCPRelayHandler(object):
 
         self.last_activity = 0
         self._update_activity()
+        self._server.add_handler(self)
         self._server.add_connection(1)
         self._server.stat_add(self._client_address[0], 1)
         self._add_ref = 1
@@ -223,12 +543,18 @@ class TCPRelayHandler(object):
         self.speed_tester_d = SpeedTester(config.get("speed_limit_per_con", 0))
         self._recv_u_max_size = BUF_SIZE
         self._recv_d_max_size = BUF_SIZE
+        self._read_size_policy = config.get('read_size_policy', READ_SIZE_POLICY)
+        if self._read_size_policy == 'fionread' and FIONREAD is None:
+            self._read_size_policy = 'peek'
+        self._fionread_buf = array.array('i', [0])
+        self._read_estimate = [BUF_SIZE, BUF_SIZE]  # indexed by STREAM_UP / STREAM_DOWN
         self._recv_pack_id = 0
         self._udp_send_pack_id = 0
         self._udpv6_send_pack_id = 0
 
         local_sock.setblocking(False)
         local_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        apply_socket_options(local_sock, server.socket_options)
         self._local_sock_fd = local_sock.fileno()
         fd_to_handlers[self._local_sock_fd] = self
         loop.add(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR, self._server)
@@ -243,6 +569,18 @@ class TCPRelayHandler(object):
     def remote_address(self):
         return self._remote_address
 
+    def buffered_bytes(self):
+        # bytes waiting to be written, (upstream, downstream)
+        up = self._data_to_write_to_remote.size
+        down = self._data_to_write_to_local.size
+        pipe = self._splice_pipes[STREAM_UP]
+        if pipe is not None:
+            up += pipe.pending
+        pipe = self._splice_pipes[STREAM_DOWN]
+        if pipe is not None:
+            down += pipe.pending
+        return up, down
+
     def _get_a_server(self):
         server = self._config['server']
         server_port = self._config['server_port']
@@ -273,7 +611,10 @@ class TCPRelayHandler(object):
             logging.error('create encryptor fail at port %d', self._server._listen_port)
 
     def _update_user(self, user):
+        if self._user_counted:
+            self._server.add_user_connection(self._user, -1)
         self._user = user
+        self._user_counted = self._server.add_user_connection(user, 1)
         self._user_id = struct.unpack('<I', user)[0]
         if self._user in self._server.server_users_cfg:
             cfg = self._server.server_users_cfg[self._user]
@@ -301,22 +642,103 @@ class TCPRelayHandler(object):
                 self._upstream_status = status
                 dirty = True
         if dirty:
-            if self._local_sock:
-                event = eventloop.POLL_ERR
-                if self._downstream_status & WAIT_STATUS_WRITING:
-                    event |= eventloop.POLL_OUT
-                if self._upstream_status & WAIT_STATUS_READING:
-                    event |= eventloop.POLL_IN
-                self._loop.modify(self._local_sock, event)
-            if self._remote_sock:
-                event = eventloop.POLL_ERR
-                if self._downstream_status & WAIT_STATUS_READING:
-                    event |= eventloop.POLL_IN
-                if self._upstream_status & WAIT_STATUS_WRITING:
-                    event |= eventloop.POLL_OUT
-                self._loop.modify(self._remote_sock, event)
-                if self._remote_sock_v6:
-                    self._loop.modify(self._remote_sock_v6, event)
+            self._update_poll()
+
+    def _update_poll(self):
+        # a paused stream keeps its status but drops its read interest
+        if self._local_sock:
+            event = eventloop.POLL_ERR
+            if self._downstream_status & WAIT_STATUS_WRITING:
+                event |= eventloop.POLL_OUT
+            if self._upstream_status & WAIT_STATUS_READING and \
+                    self._pace_timers[STREAM_UP] is None:
+                event |= eventloop.POLL_IN
+            self._loop.modify(self._local_sock, event)
+        if self._remote_sock:
+            event = eventloop.POLL_ERR
+            if self._downstream_status & WAIT_STATUS_READING and \
+                    self._pace_timers[STREAM_DOWN] is None:
+                event |= eventloop.POLL_IN
+            if self._upstream_status & WAIT_STATUS_WRITING:
+                event |= eventloop.POLL_OUT
+            self._loop.modify(self._remote_sock, event)
+            if self._remote_sock_v6:
+                self._loop.modify(self._remote_sock_v6, event)
+
+    def _speed_limit_delay(self, stream):
+        # how long the stream has to wait for both the per connection and
+        # the per user token bucket, 0 if it can read right now
+        if stream == STREAM_UP:
+            delay = self.speed_tester_u.wait_time()
+            return max(delay, self._server.speed_tester_u(self._user_id).wait_time())
+        delay = self.speed_tester_d.wait_time()
+        return max(delay, self._server.speed_tester_d(self._user_id).wait_time())
+
+    def _pause_reading(self, stream, delay):
+        # stop polling the stream for reading instead of spinning on a
+        # level-triggered POLL_IN, a one-shot timer re-arms it when the
+        # bucket has enough tokens again
+        if self._pace_timers[stream] is not None:
+            return
+        self._pace_timers[stream] = self._loop.call_later(
+            delay, lambda: self._resume_reading(stream))
+        self._update_poll()
+
+    def _splice_stream(self, stream):
+        # relay whatever the source socket of the stream has, counting it
+        # like _write_to_sock and _on_remote_read do for copied data
+        pipe = self._splice_pipes[stream]
+        if pipe is None:
+            pipe = self._splice_pipes[stream] = SplicePipe()
+        if stream == STREAM_UP:
+            sock = self._local_sock
+        else:
+            sock = self._remote_sock
+        try:
+            l = pipe.pull(sock.fileno())
+        except (OSError, IOError) as e:
+            shell.print_exception(e)
+            self.destroy()
+            return
+        if l is None:
+            return
+        if not l:
+            self.destroy()
+            return
+        if stream == STREAM_UP:
+            self.speed_tester_u.add(l)
+            self._server.speed_tester_u(self._user_id).add(l)
+            self._server.add_transfer_u(self._user, l)
+        else:
+            self.speed_tester_d.add(l)
+            self._server.speed_tester_d(self._user_id).add(l)
+            self._server.add_transfer_d(self._user, l)
+        self._update_activity(l)
+        self._flush_splice(stream)
+
+    def _flush_splice(self, stream):
+        # a stream whose pipe can not be emptied waits for writing, like a
+        # partial send in _write_to_sock
+        if stream == STREAM_UP:
+            sock = self._remote_sock
+        else:
+            sock = self._local_sock
+        try:
+            done = self._splice_pipes[stream].push(sock.fileno())
+        except (OSError, IOError) as e:
+            shell.print_exception(e)
+            logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+            self.destroy()
+            return
+        if done:
+            self._update_stream(stream, WAIT_STATUS_READING)
+        else:
+            self._update_stream(stream, WAIT_STATUS_WRITING)
+
+    def _resume_reading(self, stream):
+        self._pace_timers[stream] = None
+        if self._stage != STAGE_DESTROYED:
+            self._update_poll()
 
     def _write_to_sock(self, data, sock):
         # write data to sock
@@ -324,118 +746,140 @@ class TCPRelayHandler(object):
         # and update the stream to wait for writing
         if not sock:
             return False
-        uncomplete = False
         if self._remote_udp and sock == self._remote_sock:
-            try:
-                self._udp_data_send_buffer += data
-                #logging.info('UDP over TCP sendto %d %s' % (len(data), binascii.hexlify(data)))
-                while len(self._udp_data_send_buffer) > 6:
-                    length = struct.unpack('>H', self._udp_data_send_buffer[:2])[0]
-
-                    if length > len(self._udp_data_send_buffer):
-                        break
-
-                    data = self._udp_data_send_buffer[:length]
-                    self._udp_data_send_buffer = self._udp_data_send_buffer[length:]
-
-                    frag = common.ord(data[2])
-                    if frag != 0:
-                        logging.warn('drop a message since frag is %d' % (frag,))
-                        continue
-                    else:
-                        data = data[3:]
-                    header_result = parse_header(data)
-                    if header_result is None:
-                        continue
-                    connecttype, addrtype, dest_addr, dest_port, header_length = header_result
-                    if (addrtype & 7) == 3:
-                        af = common.is_ip(dest_addr)
-                        if af == False:
-                            handler = common.UDPAsyncDNSHandler(data[header_length:])
-                            handler.resolve(self._dns_resolver, (dest_addr, dest_port), self._handle_server_dns_resolved)
-                        else:
-                            return self._handle_server_dns_resolved("", (dest_addr, dest_port), dest_addr, data[header_length:])
-                    else:
-                        return self._handle_server_dns_resolved("", (dest_addr, dest_port), dest_addr, data[header_length:])
-
-            except Exception as e:
-                #trace = traceback.format_exc()
-                #logging.error(trace)
-                error_no = eventloop.errno_from_exception(e)
-                if error_no in (errno.EAGAIN, errno.EINPROGRESS,
-                                errno.EWOULDBLOCK):
-                    uncomplete = True
-                else:
-                    shell.print_exception(e)
-                    logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+            buf = self._udp_data_send_buffer
+            buf += data
+            pos = self._udp_data_send_offset
+            end = len(buf)
+            while end - pos > 6:
+                length = struct.unpack_from('>H', buf, pos)[0]
+                if length > end - pos:
+                    break
+                if length < 7:
+                    logging.error('bad UDP over TCP frame from %s:%d' % (self._client_address[0], self._client_address[1]))
                     self.destroy()
                     return False
+                frag = buf[pos + 2]
+                frame = bytes(buf[pos + 3:pos + length])
+                pos += length
+                if frag != 0:
+                    logging.warn('drop a message since frag is %d' % (frag,))
+                    continue
+                self._send_udp_frame(frame)
+            if pos == end:
+                del buf[:]
+                pos = 0
+            elif pos > UDP_MAX_BUF_SIZE:
+                del buf[:pos]
+                pos = 0
+            self._udp_data_send_offset = pos
             return True
         else:
-            try:
-                if self._encrypt_correct:
-                    if sock == self._remote_sock:
-                        self._server.add_transfer_u(self._user, len(data))
-                self._update_activity(len(data))
-                if data:
-                    l = len(data)
-                    s = sock.send(data)
-                    if s < l:
-                        data = data[s:]
-                        uncomplete = True
-                else:
-                    return
-            except (OSError, IOError) as e:
-                error_no = eventloop.errno_from_exception(e)
-                if error_no in (errno.EAGAIN, errno.EINPROGRESS,
-                                errno.EWOULDBLOCK):
-                    uncomplete = True
-                else:
-                    #traceback.print_exc()
-                    shell.print_exception(e)
-                    logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
-                    self.destroy()
-                    return False
-            except Exception as e:
-                shell.print_exception(e)
-                logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
-                self.destroy()
-                return False
-        if uncomplete:
+            if self._encrypt_correct:
+                if sock == self._remote_sock:
+                    self._server.add_transfer_u(self._user, len(data))
+            self._update_activity(len(data))
+            if not data:
+                return
             if sock == self._local_sock:
                 self._data_to_write_to_local.append(data)
-                self._update_stream(STREAM_DOWN, WAIT_STATUS_WRITING)
             elif sock == self._remote_sock:
                 self._data_to_write_to_remote.append(data)
-                self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
             else:
                 logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+                return False
+            return self._flush_to_sock(sock)
+
+    def _flush_to_sock(self, sock):
+        # write what is queued for sock, whatever it does not take waits
+        # for _on_local_write / _on_remote_write
+        if sock == self._local_sock:
+            queue, stream = self._data_to_write_to_local, STREAM_DOWN
+            status = self._downstream_status
         else:
-            if sock == self._local_sock:
-                self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
-            elif sock == self._remote_sock:
-                self._update_stream(STREAM_UP, WAIT_STATUS_READING)
-            else:
-                logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+            queue, stream = self._data_to_write_to_remote, STREAM_UP
+            status = self._upstream_status
+        try:
+            done = queue.write_to(sock)
+        except Exception as e:
+            shell.print_exception(e)
+            logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+            self.destroy()
+            return False
+        if done and self._eof[stream]:
+            self.destroy()
+            return False
+        if done:
+            self._update_stream(stream, WAIT_STATUS_READING)
+        elif queue.size >= self._write_high[stream]:
+            self._update_stream(stream, WAIT_STATUS_WRITING)
+        elif queue.size <= self._write_low[stream]:
+            self._update_stream(stream, WAIT_STATUS_READWRITING)
+        else:
+            # between the watermarks, keep reading only if we already were
+            self._update_stream(stream, WAIT_STATUS_WRITING |
+                                (status & WAIT_STATUS_READING))
         return True
 
-    def _handle_server_dns_resolved(self, error, remote_addr, server_addr, data):
+    def _on_eof(self, stream):
+        # the stream's source is closed, as reading went on below the high
+        # watermark there may still be data for the other side to write
+        # before the connection can be closed
+        if stream == STREAM_UP:
+            queue = self._data_to_write_to_remote
+        else:
+            queue = self._data_to_write_to_local
+        if queue and self._stage == STAGE_STREAM:
+            self._eof[stream] = True
+            self._update_stream(stream, WAIT_STATUS_WRITING)
+        else:
+            self.destroy()
+
+    def _send_udp_frame(self, frame):
+        # frame is an address header followed by the datagram
+        header_length = udp_header_length(frame)
+        dest = self._udp_dest_cache.get(frame[:header_length], None)
+        if dest is not None:
+            return self._udp_sendto(dest, frame[header_length:])
+        header_result = parse_header(frame)
+        if header_result is None:
+            return
+        connecttype, addrtype, dest_addr, dest_port, header_length = header_result
+        params = (frame[:header_length], frame[header_length:])
+        if (addrtype & 7) == 3 and not common.is_ip(dest_addr):
+            handler = common.UDPAsyncDNSHandler(params)
+            handler.resolve(self._dns_resolver, (dest_addr, dest_port), self._handle_server_dns_resolved)
+        else:
+            self._handle_server_dns_resolved("", (dest_addr, dest_port), dest_addr, params)
+
+    def _handle_server_dns_resolved(self, error, remote_addr, server_addr, params):
         if error:
             return
+        if self._stage == STAGE_DESTROYED:
+            return
+        addrinfo = common.get_sockaddr(server_addr, remote_addr[1])
+        if addrinfo is None: # drop
+            return
+        header, data = params
+        dest = addrinfo + (remote_addr, server_addr)
+        if (common.ord(header[0]) & 7) in (1, 4):
+            if len(self._udp_dest_cache) >= UDP_ADDR_CACHE_SIZE:
+                self._udp_dest_cache.clear()
+            self._udp_dest_cache[header] = dest
+        return self._udp_sendto(dest, data)
+
+    def _udp_sendto(self, dest, data):
+        af, sa, remote_addr, server_addr = dest
         try:
-            addrs = socket.getaddrinfo(server_addr, remote_addr[1], 0, socket.SOCK_DGRAM, socket.SOL_UDP)
-            if not addrs: # drop
-                return
-            af, socktype, proto, canonname, sa = addrs[0]
             if af == socket.AF_INET6:
-                self._remote_sock_v6.sendto(data, (server_addr, remote_addr[1]))
+                self._remote_sock_v6.sendto(data, sa)
                 if self._udpv6_send_pack_id == 0:
                     addr, port = self._remote_sock_v6.getsockname()[:2]
                     common.connect_log('UDPv6 sendto %s(%s):%d from %s:%d by user %d' %
                         (common.to_str(remote_addr[0]), common.to_str(server_addr), remote_addr[1], addr, port, self._user_id))
                 self._udpv6_send_pack_id += 1
             else:
-                self._remote_sock.sendto(data, (server_addr, remote_addr[1]))
+                self._remote_sock.sendto(data, sa)
                 if self._udp_send_pack_id == 0:
                     addr, port = self._remote_sock.getsockname()[:2]
                     common.connect_log('UDP sendto %s(%s):%d from %s:%d by user %d' %
@@ -446,76 +890,22 @@ class TCPRelayHandler(object):
             shell.print_exception(e)
             logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
 
-    def _get_redirect_host(self, client_address, ogn_data):
-        host_list = self._redir_list or ["*#0.0.0.0:0"]
-
-        if type(host_list) != list:
-            host_list = [host_list]
-
-        items_sum = common.to_str(host_list[0]).rsplit('#', 1)
-        if len(items_sum) < 2:
-            hash_code = binascii.crc32(ogn_data)
-            addrs = socket.getaddrinfo(client_address[0], client_address[1], 0, socket.SOCK_STREAM, socket.SOL_TCP)
-            af, socktype, proto, canonname, sa = addrs[0]
-            address_bytes = common.inet_pton(af, sa[0])
-            if af == socket.AF_INET6:
-                addr = struct.unpack('>Q', address_bytes[8:])[0]
-            elif af == socket.AF_INET:
-                addr = struct.unpack('>I', address_bytes)[0]
-            else:
-                addr = 0
-
-            host_port = []
-            match_port = False
-            for host in host_list:
-                items = common.to_str(host).rsplit(':', 1)
-                if len(items) > 1:
-                    try:
-                        port = int(items[1])
-                        if port == self._server._listen_port:
-                            match_port = True
-                        host_port.append((items[0], port))
-                    except:
-                        pass
-                else:
-                    host_port.append((host, 80))
-
-            if match_port:
-                last_host_port = host_port
-                host_port = []
-                for host in last_host_port:
-                    if host[1] == self._server._listen_port:
-                        host_port.append(host)
-
-            return host_port[((hash_code & 0xffffffff) + addr) % len(host_port)]
-
-        else:
-            host_port = []
-            for host in host_list:
-                items_sum = common.to_str(host).rsplit('#', 1)
-                items_match = common.to_str(items_sum[0]).rsplit(':', 1)
-                items = common.to_str(items_sum[1]).rsplit(':', 1)
-                if len(items_match) > 1:
-                    if items_match[1] != "*":
-                        try:
-                            if self._server._listen_port != int(items_match[1]) and int(items_match[1]) != 0:
-                                continue
-                        except:
-                            pass
-
-                if items_match[0] != "*" and common.match_regex(
-                        items_match[0], ogn_data) == False:
-                    continue
-                if len(items) > 1:
-                    try:
-                        port = int(items[1])
-                        return (items[0], port)
-                    except:
-                        pass
-                else:
-                    return (items[0], 80)
+    def _udp_frame(self, data, addr):
+        # frames a datagram from addr for the client
+        header = self._udp_src_headers.get(addr, None)
+        if header is None:
+            port = struct.pack('>H', addr[1])
+            try:
+                header = b'\x00\x01' + socket.inet_aton(addr[0]) + port
+            except Exception as e:
+                header = b'\x00\x04' + socket.inet_pton(socket.AF_INET6, addr[0]) + port
+            if len(self._udp_src_headers) >= UDP_ADDR_CACHE_SIZE:
+                self._udp_src_headers.clear()
+            self._udp_src_headers[addr] = header
+        return struct.pack('>H', len(header) + len(data) + 2) + header + data
 
-            return ("0.0.0.0", 0)
+    def _get_redirect_host(self, client_address, ogn_data):
+        return self._server.get_redirect_table(self._redir_list).get_host(client_address, ogn_data)
 
     def _handel_protocol_error(self, client_address, ogn_data):
         logging.warn("Protocol ERROR, TCP ogn data %s from %s:%d via port %d by UID %d" % (binascii.hexlify(ogn_data), client_address[0], client_address[1], self._server._listen_port, self._user_id))
@@ -548,14 +938,12 @@ class TCPRelayHandler(object):
                     self._create_remote_socket(self._chosen_server[0],
                                                self._chosen_server[1])
                 self._loop.add(remote_sock, eventloop.POLL_ERR, self._server)
-                data = b''.join(self._data_to_write_to_remote)
+                data = self._data_to_write_to_remote.join()
                 l = len(data)
                 s = remote_sock.sendto(data, MSG_FASTOPEN, self._chosen_server)
+                self._data_to_write_to_remote.clear()
                 if s < l:
-                    data = data[s:]
-                    self._data_to_write_to_remote = [data]
-                else:
-                    self._data_to_write_to_remote = []
+                    self._data_to_write_to_remote.append(memoryview(data)[s:])
                 self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
             except (OSError, IOError) as e:
                 if eventloop.errno_from_exception(e) == errno.EINPROGRESS:
@@ -571,6 +959,9 @@ class TCPRelayHandler(object):
                         traceback.print_exc()
                     logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
                     self.destroy()
+        elif self._data_to_write_to_remote.size >= self._write_high[STREAM_UP]:
+            # still connecting, stop reading until the remote takes the data
+            self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
 
     def _get_head_size(self, buf, def_value):
         if len(buf) < 2:
@@ -696,54 +1087,201 @@ class TCPRelayHandler(object):
                 except Exception as e:
                     logging.warn("bind %s fail" % (bind_addr,))
 
-    def _create_remote_socket(self, ip, port):
-        if self._remote_udp:
-            addrs_v6 = socket.getaddrinfo("::", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
-            addrs = socket.getaddrinfo("0.0.0.0", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
-        else:
+    def _check_forbidden(self, sa):
+        if self._forbidden_iplist:
+            if common.to_str(sa[0]) in self._forbidden_iplist:
+                if self._remote_address:
+                    raise Exception('IP %s is in forbidden list, when connect to %s:%d via port %d by UID %d' %
+                        (common.to_str(sa[0]), self._remote_address[0], self._remote_address[1], self._server._listen_port, self._user_id))
+                raise Exception('IP %s is in forbidden list, reject' %
+                                common.to_str(sa[0]))
+        if self._forbidden_portset:
+            if sa[1] in self._forbidden_portset:
+                if self._remote_address:
+                    raise Exception('Port %d is in forbidden list, when connect to %s:%d via port %d by UID %d' %
+                        (sa[1], self._remote_address[0], self._remote_address[1], self._server._listen_port, self._user_id))
+                raise Exception('Port %d is in forbidden list, reject' % sa[1])
+
+    def _new_remote_tcp_socket(self, ip, port):
+        r = common.get_sockaddr(ip, port)
+        if r is None:
             addrs = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM, socket.SOL_TCP)
+            if len(addrs) == 0:
+                raise Exception("getaddrinfo failed for %s:%d" % (ip, port))
+            r = (addrs[0][0], addrs[0][4])
+        af, sa = r
+        if not self._is_redirect:
+            self._check_forbidden(sa)
+        remote_sock = socket.socket(af, socket.SOCK_STREAM, socket.SOL_TCP)
+        remote_sock.setblocking(False)
+        remote_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        apply_socket_options(remote_sock, self._server.socket_options)
+        if not self._is_local:
+            self._socket_bind_addr(remote_sock, af)
+        return remote_sock, sa
+
+    def _create_remote_socket(self, ip, port):
+        if not self._remote_udp:
+            remote_sock, sa = self._new_remote_tcp_socket(ip, port)
+            self._remote_sock = remote_sock
+            self._remote_sock_fd = remote_sock.fileno()
+            self._fd_to_handlers[self._remote_sock_fd] = self
+            return remote_sock
+
+        addrs_v6 = socket.getaddrinfo("::", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
+        addrs = socket.getaddrinfo("0.0.0.0", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
         if len(addrs) == 0:
             raise Exception("getaddrinfo failed for %s:%d" % (ip, port))
         af, socktype, proto, canonname, sa = addrs[0]
-        if not self._remote_udp and not self._is_redirect:
-            if self._forbidden_iplist:
-                if common.to_str(sa[0]) in self._forbidden_iplist:
-                    if self._remote_address:
-                        raise Exception('IP %s is in forbidden list, when connect to %s:%d via port %d by UID %d' %
-                            (common.to_str(sa[0]), self._remote_address[0], self._remote_address[1], self._server._listen_port, self._user_id))
-                    raise Exception('IP %s is in forbidden list, reject' %
-                                    common.to_str(sa[0]))
-            if self._forbidden_portset:
-                if sa[1] in self._forbidden_portset:
-                    if self._remote_address:
-                        raise Exception('Port %d is in forbidden list, when connect to %s:%d via port %d by UID %d' %
-                            (sa[1], self._remote_address[0], self._remote_address[1], self._server._listen_port, self._user_id))
-                    raise Exception('Port %d is in forbidden list, reject' % sa[1])
         remote_sock = socket.socket(af, socktype, proto)
         self._remote_sock = remote_sock
         self._remote_sock_fd = remote_sock.fileno()
         self._fd_to_handlers[self._remote_sock_fd] = self
 
-        if self._remote_udp:
-            af, socktype, proto, canonname, sa = addrs_v6[0]
-            remote_sock_v6 = socket.socket(af, socktype, proto)
-            self._remote_sock_v6 = remote_sock_v6
-            self._remotev6_sock_fd = remote_sock_v6.fileno()
-            self._fd_to_handlers[self._remotev6_sock_fd] = self
+        af, socktype, proto, canonname, sa = addrs_v6[0]
+        remote_sock_v6 = socket.socket(af, socktype, proto)
+        self._remote_sock_v6 = remote_sock_v6
+        self._remotev6_sock_fd = remote_sock_v6.fileno()
+        self._fd_to_handlers[self._remotev6_sock_fd] = self
 
         remote_sock.setblocking(False)
-        if self._remote_udp:
-            remote_sock_v6.setblocking(False)
-
-            if not self._is_local:
-                self._socket_bind_addr(remote_sock, af)
-                self._socket_bind_addr(remote_sock_v6, af)
-        else:
-            remote_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-            if not self._is_local:
-                self._socket_bind_addr(remote_sock, af)
+        remote_sock_v6.setblocking(False)
+        if not self._is_local:
+            self._socket_bind_addr(remote_sock, af)
+            self._socket_bind_addr(remote_sock_v6, af)
         return remote_sock
 
+    def _connect_dest(self):
+        if self._remote_address:
+            return '%s:%d' % (common.to_str(self._remote_address[0]), self._remote_address[1])
+        return '%s:%d' % (common.to_str(self._chosen_server[0]), self._chosen_server[1])
+
+    def _connect_remote(self, ips, port):
+        self._connect_candidates = interleave_families(ips)
+        self._connect_port = port
+        self._connect_next()
+
+    def _connect_next(self):
+        # start an attempt on the next candidate that can be connected to
+        # and schedule the one after it
+        self._connect_timer = None
+        while self._connect_candidates:
+            ip = self._connect_candidates.pop(0)
+            try:
+                remote_sock, sa = self._new_remote_tcp_socket(ip, self._connect_port)
+            except Exception as e:
+                shell.print_exception(e)
+                continue
+            attempt = ConnectAttempt(remote_sock, sa, time.time())
+            try:
+                if self._fast_open_remote and not self._connect_attempts:
+                    attempt.sent = self._connect_fast_open(remote_sock, sa)
+                else:
+                    remote_sock.connect(sa)
+            except (OSError, IOError) as e:
+                if eventloop.errno_from_exception(e) not in (errno.EINPROGRESS,
+                        errno.EWOULDBLOCK):
+                    shell.print_exception(e)
+                    remote_sock.close()
+                    self._server.add_connect_stat(self._connect_dest())
+                    continue
+            fd = remote_sock.fileno()
+            attempt.timer = self._loop.call_later(self._connect_timeout,
+                    lambda: self._connect_failed(fd, True))
+            self._connect_attempts[fd] = attempt
+            self._fd_to_handlers[fd] = self
+            self._loop.add(remote_sock, eventloop.POLL_ERR | eventloop.POLL_OUT,
+                           self._server)
+            addr, port = remote_sock.getsockname()[:2]
+            common.connect_log('TCP connecting %s(%s):%d from %s:%d by user %d' %
+                (common.to_str(self._remote_address[0]), common.to_str(sa[0]), sa[1], addr, port, self._user_id))
+            if self._connect_candidates:
+                self._connect_timer = self._loop.call_later(self._connect_delay,
+                                                            self._connect_next)
+            return
+        if not self._connect_attempts:
+            logging.error('can not connect to %s from %s:%d' %
+                          (self._connect_dest(), self._client_address[0], self._client_address[1]))
+            self.destroy()
+
+    def _connect_fast_open(self, remote_sock, sa):
+        # put what the client sent along with its header into the SYN, it
+        # stays queued until this attempt wins, and only the first attempt
+        # does this so no other destination sees the data
+        # returns how much of it the kernel took
+        data = self._data_to_write_to_remote.join()
+        if not data:
+            remote_sock.connect(sa)
+            return 0
+        try:
+            return remote_sock.sendto(data, MSG_FASTOPEN, sa)
+        except (OSError, IOError) as e:
+            error_no = eventloop.errno_from_exception(e)
+            if error_no in (errno.ENOTCONN, errno.EOPNOTSUPP):
+                logging.error('fast open not supported on this OS')
+                self._server.fast_open_remote = False
+                self._fast_open_remote = False
+                remote_sock.connect(sa)
+                return 0
+            raise
+
+    def _close_connect_attempt(self, fd):
+        attempt = self._connect_attempts.pop(fd)
+        attempt.timer.cancel()
+        try:
+            self._loop.removefd(fd)
+        except Exception as e:
+            shell.print_exception(e)
+        del self._fd_to_handlers[fd]
+        attempt.sock.close()
+        return attempt
+
+    def _connect_failed(self, fd, timed_out=False, error=None):
+        # give up on one attempt and move on to the next address
+        if fd not in self._connect_attempts:
+            return
+        attempt = self._connect_attempts[fd]
+        if timed_out:
+            error = 'timed out'
+        elif error is None:
+            error = eventloop.get_sock_error(attempt.sock)
+        logging.warn('connect to %s:%d failed: %s' % (common.to_str(attempt.sa[0]), attempt.sa[1], error))
+        self._close_connect_attempt(fd)
+        self._server.add_connect_stat(self._connect_dest(), timed_out=timed_out)
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+        self._connect_next()
+
+    def _connect_succeeded(self, fd):
+        # the first attempt to connect wins, the others are dropped
+        attempt = self._connect_attempts[fd]
+        err = attempt.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._connect_failed(fd, error=os.strerror(err))
+            return
+        attempt.timer.cancel()
+        del self._connect_attempts[fd]
+        self._cancel_connecting()
+        self._server.add_connect_stat(self._connect_dest(), time.time() - attempt.start)
+        self._remote_sock = attempt.sock
+        self._remote_sock_fd = fd
+        if attempt.sent:
+            # went out in the SYN, _on_remote_write counts what is left
+            if self._encrypt_correct:
+                self._server.add_transfer_u(self._user, attempt.sent)
+            self._update_activity(attempt.sent)
+            self._data_to_write_to_remote.consume(attempt.sent)
+        self._update_poll()
+        self._on_remote_write()
+
+    def _cancel_connecting(self):
+        for fd in list(self._connect_attempts.keys()):
+            self._close_connect_attempt(fd)
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        self._connect_candidates = []
+
     def _handle_dns_resolved(self, result, error):
         if error:
             self._log_error(error)
@@ -770,9 +1308,9 @@ class TCPRelayHandler(object):
                         # TODO when there is already data in this packet
                     else:
                         # else do connect
-                        remote_sock = self._create_remote_socket(remote_addr,
-                                                                 remote_port)
                         if self._remote_udp:
+                            remote_sock = self._create_remote_socket(remote_addr,
+                                                                     remote_port)
                             self._loop.add(remote_sock,
                                            eventloop.POLL_IN,
                                            self._server)
@@ -781,28 +1319,19 @@ class TCPRelayHandler(object):
                                         eventloop.POLL_IN,
                                         self._server)
                         else:
-                            try:
-                                remote_sock.connect((remote_addr, remote_port))
-                            except (OSError, IOError) as e:
-                                if eventloop.errno_from_exception(e) in (errno.EINPROGRESS,
-                                        errno.EWOULDBLOCK):
-                                    pass # always goto here
-                                else:
-                                    raise e
-                            addr, port = self._remote_sock.getsockname()[:2]
-                            common.connect_log('TCP connecting %s(%s):%d from %s:%d by user %d' %
-                                (common.to_str(self._remote_address[0]), common.to_str(remote_addr), remote_port, addr, port, self._user_id))
-
-                            self._loop.add(remote_sock,
-                                       eventloop.POLL_ERR | eventloop.POLL_OUT,
-                                       self._server)
+                            if len(result) > 2:
+                                ips = result[2]
+                            else:
+                                ips = [ip]
+                            self._connect_remote(ips, remote_port)
+                            if self._stage == STAGE_DESTROYED:
+                                return
                         self._stage = STAGE_CONNECTING
                         self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
                         self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
                         if self._remote_udp:
                             while self._data_to_write_to_remote:
-                                data = self._data_to_write_to_remote[0]
-                                del self._data_to_write_to_remote[0]
+                                data = self._data_to_write_to_remote.popleft()
                                 self._write_to_sock(data, self._remote_sock)
                     return
                 except Exception as e:
@@ -812,10 +1341,32 @@ class TCPRelayHandler(object):
                     logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
         self.destroy()
 
+    def _get_queued_size(self, sock, recv_buffer_size, up):
+        policy = self._read_size_policy
+        if policy == 'fionread':
+            fcntl.ioctl(sock.fileno(), FIONREAD, self._fionread_buf, True)
+            if not self._fionread_buf[0]:
+                # nothing queued or EOF, let recv tell which
+                return recv_buffer_size
+            return min(self._fionread_buf[0], recv_buffer_size)
+        elif policy == 'adaptive':
+            if up:
+                return min(self._read_estimate[STREAM_UP], recv_buffer_size)
+            return min(self._read_estimate[STREAM_DOWN], recv_buffer_size)
+        return len(sock.recv(recv_buffer_size, socket.MSG_PEEK))
+
+    def _update_read_estimate(self, stream, requested, received):
+        # a read that got all it asked for probably left more behind, else
+        # the next batch is guessed to be about as large as this one
+        if received >= requested:
+            self._read_estimate[stream] = BUF_SIZE
+        elif received:
+            self._read_estimate[stream] = received
+
     def _get_read_size(self, sock, recv_buffer_size, up):
         if self._overhead == 0:
             return recv_buffer_size
-        buffer_size = len(sock.recv(recv_buffer_size, socket.MSG_PEEK))
+        buffer_size = self._get_queued_size(sock, recv_buffer_size, up)
         frame_size = self._tcp_mss - self._overhead
         if up:
             buffer_size = min(buffer_size, self._recv_u_max_size)
@@ -834,24 +1385,44 @@ class TCPRelayHandler(object):
         # each stage
         if not self._local_sock:
             return
+        if self._splice and self._stage == STAGE_STREAM and \
+                not self._remote_udp and not self._data_to_write_to_remote:
+            self._splice_stream(STREAM_UP)
+            return
         is_local = self._is_local
         if is_local:
             recv_buffer_size = self._get_read_size(self._local_sock, self._recv_buffer_size, True)
         else:
             recv_buffer_size = BUF_SIZE
         data = None
+        buf = None
+        in_place = self._in_place and self._stage == STAGE_STREAM and \
+            self._encrypt_correct and self._encryptor is not None and \
+            self._encryptor.decipher is not None
         try:
-            data = self._local_sock.recv(recv_buffer_size)
+            if in_place:
+                buf = self._server.buffer_pool.get()
+                data = memoryview(buf)[:self._local_sock.recv_into(buf, recv_buffer_size)]
+            else:
+                data = self._local_sock.recv(recv_buffer_size)
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+                self._server.buffer_pool.put(buf)
                 return
         if not data:
-            self.destroy()
+            self._server.buffer_pool.put(buf)
+            self._on_eof(STREAM_UP)
             return
+        if is_local:
+            self._update_read_estimate(STREAM_UP, recv_buffer_size, len(data))
 
         self.speed_tester_u.add(len(data))
         self._server.speed_tester_u(self._user_id).add(len(data))
+        if in_place:
+            l = self._encryptor.decrypt_in_place(buf, len(data))
+            self._write_to_sock(memoryview(buf)[:l], self._remote_sock)
+            return
         ogn_data = data
         if not is_local:
             if self._encryptor is not None:
@@ -887,6 +1458,14 @@ class TCPRelayHandler(object):
                         data = obfs_decode[0]
                     try:
                         data, sendback = self._protocol.server_post_decrypt(data)
+                        if self._user is not None and not self._user_counted:
+                            self._server.limited(
+                                'user %d' % self._user_id,
+                                'user %d: too many connections, refused %s:%d' %
+                                (self._user_id, self._client_address[0],
+                                 self._client_address[1]))
+                            self.destroy()
+                            return
                         if sendback:
                             backdata = self._protocol.server_pre_encrypt(b'')
                             backdata = self._encryptor.encrypt(backdata)
@@ -928,36 +1507,54 @@ class TCPRelayHandler(object):
 
     def _on_remote_read(self, is_remote_sock):
         # handle all remote read events
+        if self._splice and self._stage == STAGE_STREAM and \
+                not self._remote_udp and not self._data_to_write_to_local:
+            self._splice_stream(STREAM_DOWN)
+            return
         data = None
+        buf = None
+        in_place = False
         try:
             if self._remote_udp:
                 if is_remote_sock:
-                    data, addr = self._remote_sock.recvfrom(UDP_MAX_BUF_SIZE)
+                    sock = self._remote_sock
                 else:
-                    data, addr = self._remote_sock_v6.recvfrom(UDP_MAX_BUF_SIZE)
-                port = struct.pack('>H', addr[1])
-                try:
-                    ip = socket.inet_aton(addr[0])
-                    data = b'\x00\x01' + ip + port + data
-                except Exception as e:
-                    ip = socket.inet_pton(socket.AF_INET6, addr[0])
-                    data = b'\x00\x04' + ip + port + data
-                size = len(data) + 2
-                data = struct.pack('>H', size) + data
+                    sock = self._remote_sock_v6
+                # whatever else is queued goes out in the same write
+                frames = []
+                for i in range(UDP_RECV_BATCH):
+                    try:
+                        data, addr = sock.recvfrom(UDP_MAX_BUF_SIZE)
+                    except (OSError, IOError):
+                        if not frames:
+                            raise
+                        break
+                    frames.append(self._udp_frame(data, addr))
+                data = b''.join(frames)
                 #logging.info('UDP over TCP recvfrom %s:%d %d bytes to %s:%d' % (addr[0], addr[1], len(data), self._client_address[0], self._client_address[1]))
             else:
                 if self._is_local:
                     recv_buffer_size = BUF_SIZE
                 else:
                     recv_buffer_size = self._get_read_size(self._remote_sock, self._recv_buffer_size, False)
-                data = self._remote_sock.recv(recv_buffer_size)
+                in_place = self._in_place and self._encrypt_correct and \
+                    self._encryptor is not None and self._encryptor.iv_sent
+                if in_place:
+                    buf = self._server.buffer_pool.get()
+                    data = memoryview(buf)[:self._remote_sock.recv_into(buf, recv_buffer_size)]
+                else:
+                    data = self._remote_sock.recv(recv_buffer_size)
+                if not self._is_local:
+                    self._update_read_estimate(STREAM_DOWN, recv_buffer_size, len(data))
                 self._recv_pack_id += 1
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK, 10035): #errno.WSAEWOULDBLOCK
+                self._server.buffer_pool.put(buf)
                 return
         if not data:
-            self.destroy()
+            self._server.buffer_pool.put(buf)
+            self._on_eof(STREAM_DOWN)
             return
 
         self.speed_tester_d.add(len(data))
@@ -988,7 +1585,10 @@ class TCPRelayHandler(object):
                     self.destroy()
                     return
             else:
-                if self._encrypt_correct:
+                if in_place:
+                    data = memoryview(buf)[:self._encryptor.encrypt_in_place(buf, len(data))]
+                    self._server.add_transfer_d(self._user, len(data))
+                elif self._encrypt_correct:
                     data = self._protocol.server_pre_encrypt(data)
                     data = self._encryptor.encrypt(data)
                     data = self._obfs.server_encode(data)
@@ -1007,20 +1607,35 @@ class TCPRelayHandler(object):
 
     def _on_local_write(self):
         # handle local writable event
-        if self._data_to_write_to_local:
-            data = b''.join(self._data_to_write_to_local)
-            self._data_to_write_to_local = []
-            self._write_to_sock(data, self._local_sock)
+        pipe = self._splice_pipes[STREAM_DOWN]
+        if pipe is not None and pipe.pending:
+            self._flush_splice(STREAM_DOWN)
+        elif self._data_to_write_to_local:
+            self._update_activity()
+            self._flush_to_sock(self._local_sock)
         else:
             self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
 
     def _on_remote_write(self):
         # handle remote writable event
+        if self._stage != STAGE_STREAM and not self._remote_udp:
+            # just connected, count what was queued while connecting
+            l = self._data_to_write_to_remote.size
+            if self._encrypt_correct:
+                self._server.add_transfer_u(self._user, l)
+            self._update_activity(l)
         self._stage = STAGE_STREAM
-        if self._data_to_write_to_remote:
-            data = b''.join(self._data_to_write_to_remote)
-            self._data_to_write_to_remote = []
+        pipe = self._splice_pipes[STREAM_UP]
+        if pipe is not None and pipe.pending:
+            self._flush_splice(STREAM_UP)
+        elif self._data_to_write_to_remote and self._remote_udp:
+            # frames that came in while connecting, for the deframer
+            data = self._data_to_write_to_remote.join()
+            self._data_to_write_to_remote.clear()
             self._write_to_sock(data, self._remote_sock)
+        elif self._data_to_write_to_remote:
+            self._update_activity()
+            self._flush_to_sock(self._remote_sock)
         else:
             self._update_stream(STREAM_UP, WAIT_STATUS_READING)
 
@@ -1057,11 +1672,15 @@ class TCPRelayHandler(object):
                 handle = True
                 self._on_remote_error()
             elif event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                if not self.speed_tester_d.isExceed() and not self._server.speed_tester_d(self._user_id).isExceed():
-                    handle = True
+                handle = True
+                delay = 0
+                if not event & eventloop.POLL_HUP:
+                    delay = self._speed_limit_delay(STREAM_DOWN)
+                if not delay:
                     self._on_remote_read(sock == self._remote_sock)
                 else:
                     self._recv_d_max_size = self._tcp_mss - self._overhead
+                    self._pause_reading(STREAM_DOWN, delay)
             elif event & eventloop.POLL_OUT:
                 handle = True
                 self._on_remote_write()
@@ -1070,14 +1689,24 @@ class TCPRelayHandler(object):
                 handle = True
                 self._on_local_error()
             elif event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                if not self.speed_tester_u.isExceed() and not self._server.speed_tester_u(self._user_id).isExceed():
-                    handle = True
+                handle = True
+                delay = 0
+                if not event & eventloop.POLL_HUP:
+                    delay = self._speed_limit_delay(STREAM_UP)
+                if not delay:
                     self._on_local_read()
                 else:
                     self._recv_u_max_size = self._tcp_mss - self._overhead
+                    self._pause_reading(STREAM_UP, delay)
             elif event & eventloop.POLL_OUT:
                 handle = True
                 self._on_local_write()
+        elif fd in self._connect_attempts:
+            handle = True
+            if event & (eventloop.POLL_ERR | eventloop.POLL_HUP):
+                self._connect_failed(fd)
+            elif event & eventloop.POLL_OUT:
+                self._connect_succeeded(fd)
         else:
             logging.warn('unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
             try:
@@ -1162,12 +1791,24 @@ class TCPRelayHandler(object):
         if self._protocol:
             self._protocol.dispose()
             self._protocol = None
+        for timer in self._pace_timers:
+            if timer is not None:
+                timer.cancel()
+        self._pace_timers = [None, None]
+        self._cancel_connecting()
+        for pipe in self._splice_pipes:
+            if pipe is not None:
+                pipe.close()
+        self._splice_pipes = [None, None]
         self._encryptor = None
         self._dns_resolver.remove_callback(self._handle_dns_resolved)
         self._server.remove_handler(self)
         if self._add_ref > 0:
             self._server.add_connection(-1)
             self._server.stat_add(self._client_address[0], -1)
+        if self._user_counted:
+            self._server.add_user_connection(self._user, -1)
+            self._user_counted = False
 
 class TCPRelay(object):
     def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None):
@@ -1179,6 +1820,18 @@ class TCPRelay(object):
         self._fd_to_handlers = {}
         self.server_transfer_ul = 0
         self.server_transfer_dl = 0
+        # buffers the handlers receive and en/decrypt in place into, with
+        # some room for a cipher block after the data, they come back once
+        # the write queues are done with them
+        self.buffer_pool = buffer_pool.BufferPool(BUF_SIZE + 64)
+        self.accept_stat = {'accepted': 0, 'rejected': 0, 'backlog_full': 0,
+                            'batch_exhausted': 0, 'limited': 0}
+        self.connect_stat = OrderedDict()  # 'host:port' -> stat, oldest first
+        self._redirect_table = None
+        self.socket_options = socket_options(config.get('socket_profile', None))
+        self.fast_open_remote = config.get('fast_open_remote', False)
+        accept_batch = int(config.get('accept_batch', ACCEPT_BATCH))
+        self._accept_batch = max(1, min(accept_batch, ACCEPT_BATCH_MAX))
         self.server_users = {}
         self.server_users_cfg = {}
         self.server_user_transfer_ul = {}
@@ -1187,6 +1840,12 @@ class TCPRelay(object):
         self._speed_tester_u = {}
         self._speed_tester_d = {}
         self.server_connections = 0
+        self.ip_connections = {}
+        self.user_connections = {}
+        self._max_conn_per_ip = conn_limit(config.get('max_conn_per_ip'), MAX_CONN_PER_IP)
+        self._max_conn_per_port = conn_limit(config.get('max_conn_per_port'), MAX_CONN_PER_PORT)
+        self._max_conn_per_user = conn_limit(config.get('max_conn_per_user'), MAX_CONN_PER_USER)
+        self._limited_log = {}  # address or user -> [last logged, refused since]
         self.protocol_data = obfs.obfs(config['protocol']).init_data()
         self.obfs_data = obfs.obfs(config['obfs']).init_data()
 
@@ -1194,7 +1853,7 @@ class TCPRelay(object):
             common.connect_log = logging.info
 
         self._timeout = config['timeout']
-        self._timeout_cache = lru_cache.LRUCache(timeout=self._timeout,
+        self._timeout_wheel = timing_wheel.TimingWheel(timeout=self._timeout,
                                          close_callback=self._close_tcp_client)
 
         if is_local:
@@ -1214,9 +1873,11 @@ class TCPRelay(object):
             raise Exception("can't get addrinfo for %s:%d" %
                             (listen_addr, listen_port))
         af, socktype, proto, canonname, sa = addrs[0]
-        server_socket = socket.socket(af, socktype, proto)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind(sa)
+        server_socket = handover.take(socktype, sa)
+        if server_socket is None:
+            server_socket = socket.socket(af, socktype, proto)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind(sa)
         server_socket.setblocking(False)
         if config['fast_open']:
             try:
@@ -1240,17 +1901,133 @@ class TCPRelay(object):
                             eventloop.POLL_IN | eventloop.POLL_ERR, self)
         self._eventloop.add_periodic(self.handle_periodic)
 
+    def add_handler(self, client):
+        self._timeout_wheel.add(hash(client), client)
+
     def remove_handler(self, client):
-        if hash(client) in self._timeout_cache:
-            del self._timeout_cache[hash(client)]
+        self._timeout_wheel.remove(hash(client))
 
     def add_connection(self, val):
         self.server_connections += val
         logging.debug('server port %5d connections = %d' % (self._listen_port, self.server_connections,))
 
+    def add_user_connection(self, user, val):
+        # returns False, without counting it, for a connection over the
+        # user's limit
+        n = self.user_connections.get(user, 0)
+        if val > 0:
+            cfg = self.server_users_cfg.get(user, {})
+            limit = conn_limit(cfg.get('max_conn_per_user'), self._max_conn_per_user)
+            if limit and n >= limit:
+                return False
+        n += val
+        if n > 0:
+            self.user_connections[user] = n
+        else:
+            self.user_connections.pop(user, None)
+        return True
+
+    def admit(self, client_ip):
+        # whether a just accepted connection from client_ip may get a handler
+        if self._max_conn_per_port and \
+                self.server_connections >= self._max_conn_per_port:
+            self.limited('port %d' % self._listen_port,
+                         'port %d: too many connections, refused %s' %
+                         (self._listen_port, client_ip))
+            return False
+        if self._max_conn_per_ip and \
+                self.ip_connections.get(client_ip, 0) >= self._max_conn_per_ip:
+            self.limited('port %d from %s' % (self._listen_port, client_ip),
+                         'port %d: too many connections from %s, refused' %
+                         (self._listen_port, client_ip))
+            return False
+        return True
+
+    def limited(self, key, msg):
+        # counts a refused connection, msg is logged unless another one with
+        # the same key, like 'user 5', was in the last LIMITED_LOG_INTERVAL
+        self.accept_stat['limited'] += 1
+        now = time.time()
+        entry = self._limited_log.get(key, None)
+        if entry is None:
+            self._limited_log[key] = [now, 0]
+        elif now - entry[0] < LIMITED_LOG_INTERVAL:
+            entry[1] += 1
+            return
+        else:
+            if entry[1]:
+                msg += ', %d more refused in %ds' % (entry[1], now - entry[0])
+            entry[0] = now
+            entry[1] = 0
+        logging.warn(msg)
+
+    def _sweep_limited_log(self):
+        now = time.time()
+        for key in [key for key, entry in self._limited_log.items()
+                    if now - entry[0] >= LIMITED_LOG_INTERVAL]:
+            entry = self._limited_log.pop(key)
+            if entry[1]:
+                logging.warn('%s: %d more connections refused' %
+                             (key, entry[1]))
+
+    def get_redirect_table(self, redirect):
+        # compiled once, and again only when the option changes
+        table = self._redirect_table
+        if table is None or (redirect is not table.source and
+                             redirect != table.source):
+            table = RedirectTable(redirect, self._listen_port)
+            self._redirect_table = table
+        return table
+
+    def get_server_socket(self):
+        return self._server_socket
+
+    def stop_listening(self):
+        # after a handover, the connections already accepted keep going
+        if self._server_socket:
+            self._eventloop.removefd(self._server_socket_fd)
+            self._server_socket.close()
+            self._server_socket = None
+
+    def is_idle(self):
+        return not self._fd_to_handlers
+
     def get_ud(self):
         return (self.server_transfer_ul, self.server_transfer_dl)
 
+    def get_accept_stat(self):
+        return self.accept_stat.copy()
+
+    def add_connect_stat(self, dest, latency=None, timed_out=False):
+        # latency is None for a failed attempt
+        stat = self.connect_stat.pop(dest, None)
+        if stat is None:
+            stat = {'connected': 0, 'failed': 0, 'timeout': 0,
+                    'latency_sum': 0.0, 'latency_max': 0.0}
+            if len(self.connect_stat) >= CONNECT_STAT_SIZE:
+                self.connect_stat.popitem(last=False)
+        self.connect_stat[dest] = stat
+        if latency is not None:
+            stat['connected'] += 1
+            stat['latency_sum'] += latency
+            stat['latency_max'] = max(stat['latency_max'], latency)
+        elif timed_out:
+            stat['timeout'] += 1
+        else:
+            stat['failed'] += 1
+
+    def get_connect_stat(self):
+        return dict((dest, stat.copy()) for dest, stat in self.connect_stat.items())
+
+    def get_buffered_stat(self):
+        # bytes the handlers of this port hold waiting to be written
+        ret = {'up': 0, 'down': 0}
+        for handler in set(self._fd_to_handlers.values()):
+            up, down = handler.buffered_bytes()
+            ret['up'] += up
+            ret['down'] += down
+        return ret
+
     def get_users_ud(self):
         return (self.server_user_transfer_ul.copy(), self.server_user_transfer_dl.copy())
 
@@ -1359,6 +2136,11 @@ class TCPRelay(object):
             stat_dict[-1] = stat_dict.get(-1, 0) - connections_step
 
     def stat_add(self, local_addr, val):
+        n = self.ip_connections.get(local_addr, 0) + val
+        if n > 0:
+            self.ip_connections[local_addr] = n
+        else:
+            self.ip_connections.pop(local_addr, None)
         if self._stat_counter is not None:
             if self._listen_port not in self._stat_counter:
                 self._stat_counter[self._listen_port] = {}
@@ -1386,10 +2168,11 @@ class TCPRelay(object):
         if data_len and self._stat_callback:
             self._stat_callback(self._listen_port, data_len)
 
-        self._timeout_cache[hash(client)] = client
+        # the timing wheel picks this up when the handler's slot comes due
+        client.last_activity = self._eventloop.now
 
     def _sweep_timeout(self):
-        self._timeout_cache.sweep()
+        self._timeout_wheel.sweep(self._eventloop.now)
 
     def _close_tcp_client(self, client):
         if client.remote_address:
@@ -1399,37 +2182,60 @@ class TCPRelay(object):
             logging.debug('timed out')
         client.destroy()
 
-    def handle_event(self, sock, fd, event):
-        # handle events and dispatch to handlers
-        handle = False
-        if sock:
-            logging.log(shell.VERBOSE_LEVEL, 'fd %d %s', fd,
-                        eventloop.EVENT_NAMES.get(event, event))
-        if sock == self._server_socket:
-            if event & eventloop.POLL_ERR:
-                # TODO
-                raise Exception('server_socket error')
+    def _accept_batched(self):
+        # accept until EAGAIN or until the batch is used up
+        accepted = 0
+        for i in range(self._accept_batch):
             handler = None
-            handle = True
             try:
                 logging.debug('accept')
                 conn = self._server_socket.accept()
+                accepted += 1
+                if not self.admit(conn[1][0]):
+                    conn[0].close()
+                    continue
                 handler = TCPRelayHandler(self, self._fd_to_handlers,
                                 self._eventloop, conn[0], self._config,
                                 self._dns_resolver, self._is_local)
                 if handler.stage() == STAGE_DESTROYED:
                     conn[0].close()
+                    self.accept_stat['rejected'] += 1
+                else:
+                    self.accept_stat['accepted'] += 1
             except (OSError, IOError) as e:
                 error_no = eventloop.errno_from_exception(e)
                 if error_no in (errno.EAGAIN, errno.EINPROGRESS,
                                 errno.EWOULDBLOCK):
-                    return
+                    return accepted > 0
+                if error_no in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                                errno.ENOMEM):
+                    # the connection stays queued in the backlog
+                    self.accept_stat['backlog_full'] += 1
                 else:
-                    shell.print_exception(e)
-                    if self._config['verbose']:
-                        traceback.print_exc()
-                    if handler:
-                        handler.destroy()
+                    self.accept_stat['rejected'] += 1
+                shell.print_exception(e)
+                if self._config['verbose']:
+                    traceback.print_exc()
+                if handler:
+                    handler.destroy()
+                return True
+        # the batch ran out before accept() said EAGAIN, there may or may not
+        # be more connections queued, a count that keeps going up with the
+        # accepted one means accept_batch is too small for the port
+        self.accept_stat['batch_exhausted'] += 1
+        return True
+
+    def handle_event(self, sock, fd, event):
+        # handle events and dispatch to handlers
+        handle = False
+        if sock:
+            logging.log(shell.VERBOSE_LEVEL, 'fd %d %s', fd,
+                        eventloop.EVENT_NAMES.get(event, event))
+        if sock == self._server_socket:
+            if event & eventloop.POLL_ERR:
+                # TODO
+                raise Exception('server_socket error')
+            handle = self._accept_batched()
         else:
             if sock:
                 handler = self._fd_to_handlers.get(fd, None)
@@ -1463,6 +2269,8 @@ class TCPRelay(object):
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
         self._sweep_timeout()
+        if self._limited_log:
+            self._sweep_limited_log()
 
     def close(self, next_tick=False):
         logging.debug('TCP close')
@@ -1470,7 +2278,183 @@ class TCPRelay(object):
         if not next_tick:
             if self._eventloop:
                 self._eventloop.remove_periodic(self.handle_periodic)
-                self._eventloop.removefd(self._server_socket_fd)
-            self._server_socket.close()
+            if self._server_socket:
+                if self._eventloop:
+                    self._eventloop.removefd(self._server_socket_fd)
+                self._server_socket.close()
+                self._server_socket = None
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
+
+
+def test_redirect_table():
+    data = b'\x16\x03\x01GET / HTTP/1.1\r\n'
+    table = RedirectTable(None, 8388)
+    assert table.get_host(('1.2.3.4', 1), data) == ("0.0.0.0", 0)
+    table = RedirectTable(['a.com:443', 'b.com:8388', 'c.com:8388', 'd.com'], 8388)
+    hosts = set(table.get_host(('10.0.0.%d' % i, 1), data) for i in range(16))
+    assert hosts == set([('b.com', 8388), ('c.com', 8388)])
+    assert table.get_host(('::1', 1), data) == table.get_host(('::1', 2), data)
+    table = RedirectTable('d.com', 8388)
+    assert table.get_host(('1.2.3.4', 1), data) == ('d.com', 80)
+    table = RedirectTable(['GET:443#a.com:443', 'GET:8388#b.com:80',
+                           'POST:*#c.com:80', '*#d.com:8080'], 8388)
+    assert table.get_host(('1.2.3.4', 1), data) == ('b.com', 80)
+    assert table.get_host(('1.2.3.4', 1), b'PUT /') == ('d.com', 8080)
+
+
+def test_splice():
+    # a tcp_splice port relays a plain stream with splice and still frames
+    # UDP over TCP
+    class FakeDNS(object):
+        def resolve(self, hostname, callback):
+            callback((hostname, '127.0.0.1', ['127.0.0.1']), None)
+
+        def remove_callback(self, callback):
+            pass
+
+    def echo_tcp(sock):
+        conn = sock.accept()[0]
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    def echo_udp(sock):
+        data, addr = sock.recvfrom(65536)
+        sock.sendto(data, addr)
+
+    if not hasattr(os, 'splice'):
+        return
+    tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp.bind(('127.0.0.1', 0))
+    tcp.listen(1)
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind(('127.0.0.1', 0))
+    for target, sock in ((echo_tcp, tcp), (echo_udp, udp)):
+        t = threading.Thread(target=target, args=(sock,))
+        t.daemon = True
+        t.start()
+    config = {'server': '127.0.0.1', 'server_port': 0, 'password': 'pw',
+              'method': 'none', 'protocol': 'origin', 'obfs': 'plain',
+              'protocol_param': '', 'obfs_param': '', 'timeout': 60,
+              'fast_open': False, 'verbose': 0, 'tcp_splice': True}
+    loop = eventloop.EventLoop()
+    relay = TCPRelay(config, FakeDNS(), False)
+    relay.add_to_loop(loop)
+    server_port = relay.get_server_socket().getsockname()[1]
+    pulled = []
+    pull = SplicePipe.pull
+    SplicePipe.pull = lambda self, fd: pulled.append(fd) or pull(self, fd)
+    t = threading.Thread(target=loop.run)
+    t.start()
+    try:
+        payload = os.urandom(1024 * 1024)
+        c = socket.create_connection(('127.0.0.1', server_port))
+        c.settimeout(5)
+        c.sendall(b'\x01' + socket.inet_aton('127.0.0.1') +
+                  struct.pack('>H', tcp.getsockname()[1]) + payload[:100])
+        sender = threading.Thread(target=c.sendall, args=(payload[100:],))
+        sender.start()
+        received = 0
+        while received < len(payload):
+            data = c.recv(65536)
+            assert data == payload[received:received + len(data)]
+            received += len(data)
+        sender.join()
+        c.close()
+        assert pulled
+
+        addr = b'\x01' + socket.inet_aton('127.0.0.1') + \
+            struct.pack('>H', udp.getsockname()[1])
+        c = socket.create_connection(('127.0.0.1', server_port))
+        c.settimeout(5)
+        c.sendall(b'\x09' + addr[1:])
+        time.sleep(0.1)
+        body = b'\x00' + addr + b'datagram'
+        c.sendall(struct.pack('>H', len(body) + 2) + body)
+        frame = c.recv(65536)
+        assert frame[-8:] == b'datagram'
+        assert struct.unpack('>H', frame[:2])[0] == len(frame)
+        c.close()
+    finally:
+        SplicePipe.pull = pull
+        loop.call_later(0, loop.stop)
+        t.join()
+        relay.close()
+        tcp.close()
+        udp.close()
+
+
+def test_udp_dest_cache():
+    # a datagram to a name is resolved every time, the resolver caches it
+    # for its TTL, only literal addresses skip it
+    class FakeDNS(object):
+        def __init__(self):
+            self.resolved = []
+
+        def resolve(self, hostname, callback):
+            self.resolved.append(hostname)
+            callback((hostname, '192.0.2.%d' % len(self.resolved),
+                      ['192.0.2.%d' % len(self.resolved)]), None)
+
+    sent = []
+    handler = TCPRelayHandler.__new__(TCPRelayHandler)
+    handler._stage = STAGE_STREAM
+    handler._dns_resolver = FakeDNS()
+    handler._udp_dest_cache = {}
+    handler._udp_sendto = lambda dest, data: sent.append((dest[1], data))
+    port = struct.pack('>H', 53)
+    ip = b'\x01' + socket.inet_aton('198.51.100.1') + port
+    name = b'\x03\x0bexample.com' + port
+    for i in range(2):
+        handler._send_udp_frame(ip + b'ip')
+        handler._send_udp_frame(name + b'name')
+    assert handler._dns_resolver.resolved == [b'example.com', b'example.com']
+    assert sent == [(('198.51.100.1', 53), b'ip'), (('192.0.2.1', 53), b'name'),
+                    (('198.51.100.1', 53), b'ip'), (('192.0.2.2', 53), b'name')]
+    assert list(handler._udp_dest_cache) == [ip]
+
+
+def test_limited():
+    # refusals are all counted but logged once an interval for each key, and
+    # a null limit is the default one
+    warnings = []
+    warn = logging.warn
+    logging.warn = warnings.append
+    config = {'server': '127.0.0.1', 'server_port': 0, 'password': 'pw',
+              'method': 'none', 'protocol': 'origin', 'obfs': 'plain',
+              'protocol_param': '', 'obfs_param': '', 'timeout': 60,
+              'fast_open': False, 'verbose': 0, 'max_conn_per_ip': 1,
+              'max_conn_per_port': None, 'max_conn_per_user': None}
+    relay = TCPRelay(config, None, False)
+    try:
+        relay.stat_add('192.0.2.1', 1)
+        assert relay.admit('192.0.2.2')
+        for i in range(100):
+            assert not relay.admit('192.0.2.1')
+        assert relay.accept_stat['limited'] == 100
+        assert len(warnings) == 1
+        relay._limited_log['port 0 from 192.0.2.1'][0] -= LIMITED_LOG_INTERVAL
+        relay._sweep_limited_log()
+        assert warnings[-1] == 'port 0 from 192.0.2.1: 99 more connections refused'
+        assert not relay._limited_log
+
+        user = b'\x05\x00\x00\x00'
+        relay.server_users_cfg[user] = {'max_conn_per_user': None}
+        for i in range(100):
+            assert relay.add_user_connection(user, 1)
+        relay.server_users_cfg[user] = {'max_conn_per_user': '100'}
+        assert not relay.add_user_connection(user, 1)
+    finally:
+        logging.warn = warn
+        relay.close()
+
+
+if __name__ == '__main__':
+    test_redirect_table()
+    test_splice()
+    test_udp_dest_cache()
+    test_limited()
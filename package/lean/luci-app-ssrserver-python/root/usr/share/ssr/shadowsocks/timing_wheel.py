@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import logging
+import time
+
+# this TimingWheel is optimized for refreshing, not for precision
+# every value carries its own `last_activity` timestamp, so refreshing a
+# value is a single attribute write and never touches the wheel
+# a value is filed under the slot of the tick its timeout would fire at
+# when that slot comes due, the value is either expired or, if it has been
+# active in the meantime, filed again under its new deadline
+# add & remove are O(1), sweep only visits the slots that are due
+# timeouts fire at most one tick late
+
+
+class TimingWheel(object):
+    """This class is not thread safe"""
+
+    def __init__(self, timeout=60, close_callback=None, tick=1):
+        self.timeout = timeout
+        self.close_callback = close_callback
+        self._tick = tick
+        self._slots = [{} for i in range(int(timeout / tick) + 2)]
+        self._slot_of = {}
+        self._last_tick = int(time.time() / tick)
+
+    def _file(self, key, value):
+        # never file into a tick that has already been swept
+        t = max(int((value.last_activity + self.timeout) / self._tick),
+                self._last_tick + 1)
+        i = t % len(self._slots)
+        self._slots[i][key] = value
+        self._slot_of[key] = i
+
+    def add(self, key, value):
+        # O(1)
+        self.remove(key)
+        self._file(key, value)
+
+    def remove(self, key):
+        # O(1)
+        i = self._slot_of.pop(key, None)
+        if i is not None:
+            del self._slots[i][key]
+
+    def __contains__(self, key):
+        return key in self._slot_of
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def sweep(self, now=None):
+        # O(due slots + values filed in them)
+        if now is None:
+            now = time.time()
+        now_tick = int(now / self._tick)
+        first_tick = max(self._last_tick + 1, now_tick - len(self._slots) + 1)
+        self._last_tick = now_tick
+        c = 0
+        for t in range(first_tick, now_tick + 1):
+            i = t % len(self._slots)
+            slot = self._slots[i]
+            if not slot:
+                continue
+            self._slots[i] = {}
+            for key, value in slot.items():
+                if now - value.last_activity < self.timeout:
+                    self._file(key, value)
+                    continue
+                del self._slot_of[key]
+                if self.close_callback is not None:
+                    self.close_callback(value)
+                c += 1
+        if c:
+            logging.debug('%d keys swept' % c)
+        return c
+
+
+def test():
+    class Conn(object):
+        def __init__(self, t):
+            self.last_activity = t
+
+    closed = []
+    now = time.time()
+    w = TimingWheel(timeout=10, close_callback=closed.append)
+    a = Conn(now)
+    b = Conn(now)
+    w.add('a', a)
+    w.add('b', b)
+    w.add('c', Conn(now))
+    assert len(w) == 3
+    w.remove('c')
+    assert 'c' not in w
+
+    w.sweep(now + 5)
+    assert not closed
+    b.last_activity = now + 5
+    w.sweep(now + 11)
+    assert closed == [a]
+    assert 'a' not in w and 'b' in w
+    w.sweep(now + 14)
+    assert closed == [a]
+    w.sweep(now + 16)
+    assert closed == [a, b]
+    assert len(w) == 0
+
+    # a long pause between sweeps still expires everything that is due
+    w.add('a', Conn(now + 16))
+    w.add('b', Conn(now + 20))
+    w.sweep(now + 100)
+    assert len(w) == 0 and len(closed) == 4
+
+
+if __name__ == '__main__':
+    test()
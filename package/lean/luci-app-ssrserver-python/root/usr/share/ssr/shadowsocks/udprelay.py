@@ -72,7 +72,15 @@ import binascii
 import traceback
 import threading
 
-from shadowsocks import encrypt, obfs, eventloop, lru_cache, common, shell
+if __name__ == '__main__':
+    import os
+    import sys
+    import inspect
+    file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.join(file_path, '../'))
+
+from shadowsocks import encrypt, obfs, eventloop, common, shell, timing_wheel, \
+    handover
 from shadowsocks.common import pre_parse_header, parse_header, pack_addr
 
 # for each handler, we have 2 stream directions:
@@ -96,6 +104,10 @@ POST_MTU_MIN = 500
 POST_MTU_MAX = 1400
 SENDING_WINDOW_SIZE = 8192
 
+# datagrams a relay reads per loop iteration over all of its sockets,
+# every readable socket still gets at least one read
+UDP_RECV_BUDGET = 64
+
 STAGE_INIT = 0
 STAGE_RSP_ID = 1
 STAGE_DNS = 2
@@ -123,9 +135,122 @@ RSP_STATE_ERROR = b"\x03"
 RSP_STATE_DISCONNECT = b"\x04"
 RSP_STATE_REDIRECT = b"\x05"
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    from shadowsocks.ordereddict import OrderedDict
+
+# DNS queries get their own small pool of short lived sessions
+DNS_SESSION_SIZE = 16
+DNS_SESSION_TIMEOUT = 10
+
 def client_key(source_addr, server_af):
     # notice this is server af, not dest af
-    return '%s:%s:%d' % (source_addr[0], source_addr[1], server_af)
+    return (source_addr[0], source_addr[1], server_af)
+
+
+class UDPSession(object):
+    # an outbound socket relaying the datagrams of one client address
+    def __init__(self, key, sock, uid, client_addr, af, is_dns=False):
+        self.key = key
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.uid = uid
+        self.client_addr = client_addr
+        self.af = af
+        self.is_dns = is_dns
+        self.last_activity = 0
+
+
+class UDPSessionTable(object):
+    """This class is not thread safe"""
+
+    # sessions are found by client key or by outbound fd, both O(1)
+    # each pool keeps its sessions least recently used first, so a full
+    # pool evicts from the front on insert and sweep stops at the first
+    # session that has not timed out
+
+    def __init__(self, size, timeout, close_callback=None,
+                 dns_size=DNS_SESSION_SIZE, dns_timeout=DNS_SESSION_TIMEOUT):
+        self.close_callback = close_callback
+        self._sessions = {}
+        self._fd_to_session = {}
+        self._pools = (OrderedDict(), OrderedDict())  # indexed by is_dns
+        self._size = (max(size, 1), max(dns_size, 1))
+        self._timeout = (timeout, dns_timeout)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def has_fd(self, fd):
+        return fd in self._fd_to_session
+
+    def _touch(self, session):
+        pool = self._pools[session.is_dns]
+        del pool[session.key]
+        pool[session.key] = session
+        session.last_activity = time.time()
+
+    def get(self, key):
+        # O(1)
+        session = self._sessions.get(key, None)
+        if session is not None:
+            self._touch(session)
+        return session
+
+    def get_by_fd(self, fd):
+        # O(1)
+        session = self._fd_to_session.get(fd, None)
+        if session is not None:
+            self._touch(session)
+        return session
+
+    def add(self, session):
+        # O(1), evicts the least recently used session of a full pool
+        self.close(self._sessions.get(session.key, None))
+        pool = self._pools[session.is_dns]
+        while len(pool) >= self._size[session.is_dns]:
+            for key in pool:
+                break
+            self.close(pool[key])
+        self._sessions[session.key] = session
+        self._fd_to_session[session.fd] = session
+        pool[session.key] = session
+        session.last_activity = time.time()
+
+    def remove(self, session):
+        if session is None or \
+                self._sessions.get(session.key, None) is not session:
+            return False
+        del self._sessions[session.key]
+        del self._fd_to_session[session.fd]
+        del self._pools[session.is_dns][session.key]
+        return True
+
+    def close(self, session):
+        if self.remove(session) and self.close_callback is not None:
+            self.close_callback(session)
+
+    def sweep(self):
+        # O(sessions timed out)
+        now = time.time()
+        c = 0
+        for pool, timeout in zip(self._pools, self._timeout):
+            while pool:
+                for key in pool:
+                    break
+                session = pool[key]
+                if now - session.last_activity <= timeout:
+                    break
+                self.close(session)
+                c += 1
+        if c:
+            logging.debug('%d sessions swept' % c)
+        return c
+
+    def clear(self):
+        for session in list(self._sessions.values()):
+            self.close(session)
 
 class UDPRelay(object):
     def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None):
@@ -147,13 +272,9 @@ class UDPRelay(object):
         self._method = config['method']
         self._timeout = config['timeout']
         self._is_local = is_local
-        self._udp_cache_size = config['udp_cache']
-        self._cache = lru_cache.LRUCache(timeout=config['udp_timeout'],
-                                         close_callback=self._close_client_pair)
-        self._cache_dns_client = lru_cache.LRUCache(timeout=10,
-                                         close_callback=self._close_client_pair)
-        self._client_fd_to_server_addr = {}
-        #self._dns_cache = lru_cache.LRUCache(timeout=1800)
+        self._sessions = UDPSessionTable(config['udp_cache'],
+                                         config['udp_timeout'],
+                                         close_callback=self._close_session)
         self._eventloop = None
         self._closed = False
         self.server_transfer_ul = 0
@@ -182,13 +303,17 @@ class UDPRelay(object):
         server_info.buffer_size = BUF_SIZE
         server_info.overhead = 0
         self._protocol.set_server_info(server_info)
+        self._cipher_cache = {}
 
-        self._sockets = set()
         self._fd_to_handlers = {}
         self._reqid_to_hd = {}
         self._data_to_write_to_server_socket = []
+        self._recv_budget_max = max(1, int(config.get('udp_recv_budget',
+                                                      UDP_RECV_BUDGET)))
+        self._recv_budget = self._recv_budget_max
+        self._recv_budget_time = 0
 
-        self._timeout_cache = lru_cache.LRUCache(timeout=self._timeout,
+        self._timeout_wheel = timing_wheel.TimingWheel(timeout=self._timeout,
                                          close_callback=self._close_tcp_client)
 
         self._bind = config.get('out_bind', '')
@@ -210,10 +335,14 @@ class UDPRelay(object):
             raise Exception("can't get addrinfo for %s:%d" %
                             (self._listen_addr, self._listen_port))
         af, socktype, proto, canonname, sa = addrs[0]
-        server_socket = socket.socket(af, socktype, proto)
-        server_socket.bind((self._listen_addr, self._listen_port))
+        server_socket = handover.take(socktype, sa)
+        if server_socket is None:
+            server_socket = socket.socket(af, socktype, proto)
+            server_socket.bind((self._listen_addr, self._listen_port))
         server_socket.setblocking(False)
         self._server_socket = server_socket
+        # False once handed over, replies still go out through it
+        self._listening = True
         self._stat_callback = stat_callback
 
     def _get_a_server(self):
@@ -290,26 +419,12 @@ class UDPRelay(object):
             self.server_user_transfer_dl[user] += transfer + self.server_transfer_dl
             self.server_transfer_dl = 0
 
-    def _close_client_pair(self, client_pair):
-        client, uid = client_pair
-        self._close_client(client)
-
-    def _close_client(self, client):
-        if hasattr(client, 'close'):
-            if not self._is_local:
-                if client.fileno() in self._client_fd_to_server_addr:
-                    logging.debug('close_client: %s' %
-                                 (self._client_fd_to_server_addr[client.fileno()],))
-                else:
-                    client.info('close_client')
-            self._sockets.remove(client.fileno())
-            self._eventloop.remove(client)
-            del self._client_fd_to_server_addr[client.fileno()]
-            client.close()
-        else:
-            # just an address
-            client.info('close_client pass %s' % client)
-            pass
+    def _close_session(self, session):
+        if not self._is_local:
+            logging.debug('close_client: %s' %
+                          ((session.client_addr, session.af),))
+        self._eventloop.remove(session.sock)
+        session.sock.close()
 
     def _handel_protocol_error(self, client_address, ogn_data):
         #raise Exception('can not parse header')
@@ -334,14 +449,43 @@ class UDPRelay(object):
                 except Exception as e:
                     logging.warn("bind %s fail" % (bind_addr,))
 
-    def _handle_server(self):
-        server = self._server_socket
-        data, r_addr = server.recvfrom(BUF_SIZE)
+    def _recv_batch(self, sock, fd, handle_data):
+        # read until EAGAIN or until the budget of this loop iteration is
+        # used up, poll reports the socket again if anything is left
+        if self._recv_budget_time != self._eventloop.now:
+            self._recv_budget_time = self._eventloop.now
+            self._recv_budget = self._recv_budget_max
+        count = 0
+        recv_len = 0
+        while count < max(self._recv_budget, 1):
+            try:
+                data, r_addr = sock.recvfrom(BUF_SIZE)
+            except (OSError, IOError) as e:
+                if eventloop.errno_from_exception(e) not in \
+                        (errno.EAGAIN, errno.EWOULDBLOCK):
+                    shell.print_exception(e)
+                break
+            count += 1
+            recv_len += len(data)
+            try:
+                handle_data(sock, data, r_addr)
+            except Exception as e:
+                shell.print_exception(e)
+                if self._config['verbose']:
+                    traceback.print_exc()
+            if sock != self._server_socket and \
+                    not self._sessions.has_fd(fd):
+                # the handler closed this client socket
+                break
+        self._recv_budget -= count
+        if recv_len and self._stat_callback:
+            self._stat_callback(self._listen_port, recv_len)
+        return count > 0
+
+    def _handle_server(self, server, data, r_addr):
         ogn_data = data
         if not data:
             logging.debug('UDP handle_server: data is empty')
-        if self._stat_callback:
-            self._stat_callback(self._listen_port, len(data))
         uid = None
         if self._is_local:
             frag = common.ord(data[2])
@@ -352,7 +496,7 @@ class UDPRelay(object):
                 data = data[3:]
         else:
             ref_iv = [0]
-            data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0, data, ref_iv)
+            data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0, data, ref_iv, self._cipher_cache)
             # decrypt data
             if not data:
                 logging.debug('UDP handle_server: data is empty after decrypt')
@@ -400,17 +544,14 @@ class UDPRelay(object):
         user_id = self._listen_port
         try:
             server_port = remote_addr[1]
-            addrs = socket.getaddrinfo(server_addr, server_port, 0,
-                                        socket.SOCK_DGRAM, socket.SOL_UDP)
-            if not addrs: # drop
+            addrinfo = common.get_sockaddr(server_addr, server_port)
+            if addrinfo is None: # drop
                 return
-            af, socktype, proto, canonname, sa = addrs[0]
+            af, sa = addrinfo
             server_addr = sa[0]
             key = client_key(r_addr, af)
-            client_pair = self._cache.get(key, None)
-            if client_pair is None:
-                client_pair = self._cache_dns_client.get(key, None)
-            if client_pair is None:
+            session = self._sessions.get(key)
+            if session is None:
                 if self._forbidden_iplist:
                     if common.to_str(sa[0]) in self._forbidden_iplist:
                         logging.debug('IP %s is in forbidden list, drop' % common.to_str(sa[0]))
@@ -421,7 +562,7 @@ class UDPRelay(object):
                         logging.debug('Port %d is in forbidden list, reject' % sa[1])
                         # drop
                         return
-                client = socket.socket(af, socktype, proto)
+                client = socket.socket(af, socket.SOCK_DGRAM, socket.SOL_UDP)
                 client_uid = uid
                 client.setblocking(False)
                 self._socket_bind_addr(client, af)
@@ -432,29 +573,24 @@ class UDPRelay(object):
                     pass
                 if sa[1] == 53 and is_dns: #DNS
                     logging.debug("DNS query %s from %s:%d" % (common.to_str(sa[0]), r_addr[0], r_addr[1]))
-                    self._cache_dns_client[key] = (client, uid)
                 else:
-                    self._cache[key] = (client, uid)
-                self._client_fd_to_server_addr[client.fileno()] = (r_addr, af)
-
-                self._sockets.add(client.fileno())
+                    is_dns = False
+                self._sessions.add(UDPSession(key, client, uid, r_addr, af, is_dns))
                 self._eventloop.add(client, eventloop.POLL_IN, self)
 
-                logging.debug('UDP port %5d sockets %d' % (self._listen_port, len(self._sockets)))
+                logging.debug('UDP port %5d sockets %d' % (self._listen_port, len(self._sessions)))
 
                 if uid is not None:
                     user_id = struct.unpack('<I', client_uid)[0]
             else:
-                client, client_uid = client_pair
-            self._cache.clear(self._udp_cache_size)
-            self._cache_dns_client.clear(16)
+                client, client_uid = session.sock, session.uid
 
             if self._is_local:
                 ref_iv = [encrypt.encrypt_new_iv(self._method)]
                 self._protocol.obfs.server_info.iv = ref_iv[0]
                 data = self._protocol.client_udp_pre_encrypt(data)
                 #logging.debug("%s" % (binascii.hexlify(data),))
-                data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1, data, ref_iv)
+                data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1, data, ref_iv, self._cipher_cache)
                 if not data:
                     return
             else:
@@ -468,7 +604,7 @@ class UDPRelay(object):
         try:
             client.sendto(data, (server_addr, server_port))
             self.add_transfer_u(client_uid, len(data))
-            if client_pair is None: # new request
+            if session is None: # new request
                 addr, port = client.getsockname()[:2]
                 common.connect_log('UDP data to %s(%s):%d from %s:%d by user %d' %
                         (common.to_str(remote_addr[0]), common.to_str(server_addr), server_port, addr, port, user_id))
@@ -480,24 +616,15 @@ class UDPRelay(object):
             else:
                 shell.print_exception(e)
 
-    def _handle_client(self, sock):
-        data, r_addr = sock.recvfrom(BUF_SIZE)
+    def _handle_client(self, sock, data, r_addr):
         if not data:
             logging.debug('UDP handle_client: data is empty')
             return
-        if self._stat_callback:
-            self._stat_callback(self._listen_port, len(data))
 
-        client_addr = self._client_fd_to_server_addr.get(sock.fileno())
+        session = self._sessions.get_by_fd(sock.fileno())
         client_uid = None
-        if client_addr:
-            key = client_key(client_addr[0], client_addr[1])
-            client_pair = self._cache.get(key, None)
-            client_dns_pair = self._cache_dns_client.get(key, None)
-            if client_pair:
-                client, client_uid = client_pair
-            elif client_dns_pair:
-                client, client_uid = client_dns_pair
+        if session:
+            client_uid = session.uid
 
         if not self._is_local:
             addrlen = len(r_addr[0])
@@ -509,13 +636,13 @@ class UDPRelay(object):
             self._protocol.obfs.server_info.iv = ref_iv[0]
             data = self._protocol.server_udp_pre_encrypt(data, client_uid)
             response = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1,
-                                           data, ref_iv)
+                                           data, ref_iv, self._cipher_cache)
             if not response:
                 return
         else:
             ref_iv = [0]
             data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0,
-                                       data, ref_iv)
+                                       data, ref_iv, self._cipher_cache)
             if not data:
                 return
             self._protocol.obfs.server_info.recv_iv = ref_iv[0]
@@ -528,16 +655,15 @@ class UDPRelay(object):
 
             response = b'\x00\x00\x00' + data
 
-        if client_addr:
+        if session:
             if client_uid:
                 self.add_transfer_d(client_uid, len(response))
             else:
                 self.server_transfer_dl += len(response)
-            self.write_to_server_socket(response, client_addr[0])
-            if client_dns_pair:
-                logging.debug("remove dns client %s:%d" % (client_addr[0][0], client_addr[0][1]))
-                del self._cache_dns_client[key]
-                self._close_client(client_dns_pair[0])
+            self.write_to_server_socket(response, session.client_addr)
+            if session.is_dns:
+                logging.debug("remove dns client %s:%d" % (session.client_addr[0], session.client_addr[1]))
+                self._sessions.close(session)
         else:
             # this packet is from somewhere else we know
             # simply drop that packet
@@ -579,15 +705,29 @@ class UDPRelay(object):
                             eventloop.POLL_IN | eventloop.POLL_ERR, self)
         loop.add_periodic(self.handle_periodic)
 
+    def get_server_socket(self):
+        if self._listening:
+            return self._server_socket
+        return None
+
+    def stop_listening(self):
+        if self._listening and self._eventloop:
+            self._eventloop.remove(self._server_socket)
+            self._listening = False
+
+    def is_idle(self):
+        return len(self._sessions) == 0
+
     def remove_handler(self, client):
-        if hash(client) in self._timeout_cache:
-            del self._timeout_cache[hash(client)]
+        self._timeout_wheel.remove(hash(client))
 
     def update_activity(self, client):
-        self._timeout_cache[hash(client)] = client
+        client.last_activity = self._eventloop.now
+        if hash(client) not in self._timeout_wheel:
+            self._timeout_wheel.add(hash(client), client)
 
     def _sweep_timeout(self):
-        self._timeout_cache.sweep()
+        self._timeout_wheel.sweep(self._eventloop.now)
 
     def _close_tcp_client(self, client):
         if client.remote_address:
@@ -599,24 +739,15 @@ class UDPRelay(object):
         client.destroy_local()
 
     def handle_event(self, sock, fd, event):
+        handle = False
         if sock == self._server_socket:
             if event & eventloop.POLL_ERR:
                 logging.error('UDP server_socket err')
-            try:
-                self._handle_server()
-            except Exception as e:
-                shell.print_exception(e)
-                if self._config['verbose']:
-                    traceback.print_exc()
-        elif sock and (fd in self._sockets):
+            handle = self._recv_batch(sock, fd, self._handle_server)
+        elif sock and self._sessions.has_fd(fd):
             if event & eventloop.POLL_ERR:
                 logging.error('UDP client_socket err')
-            try:
-                self._handle_client(sock)
-            except Exception as e:
-                shell.print_exception(e)
-                if self._config['verbose']:
-                    traceback.print_exc()
+            handle = self._recv_batch(sock, fd, self._handle_client)
         else:
             if sock:
                 handler = self._fd_to_handlers.get(fd, None)
@@ -624,24 +755,21 @@ class UDPRelay(object):
                     handler.handle_event(sock, event)
             else:
                 logging.warn('poll removed fd')
+        return handle
 
     def handle_periodic(self):
         if self._closed:
-            self._cache.clear(0)
-            self._cache_dns_client.clear(0)
+            self._sessions.clear()
             if self._eventloop:
                 self._eventloop.remove_periodic(self.handle_periodic)
-                self._eventloop.remove(self._server_socket)
+            self.stop_listening()
             if self._server_socket:
                 self._server_socket.close()
                 self._server_socket = None
                 logging.info('closed UDP port %d', self._listen_port)
         else:
-            before_sweep_size = len(self._sockets)
-            self._cache.sweep()
-            self._cache_dns_client.sweep()
-            if before_sweep_size != len(self._sockets):
-                logging.debug('UDP port %5d sockets %d' % (self._listen_port, len(self._sockets)))
+            if self._sessions.sweep():
+                logging.debug('UDP port %5d sockets %d' % (self._listen_port, len(self._sessions)))
             self._sweep_timeout()
 
     def close(self, next_tick=False):
@@ -650,7 +778,43 @@ class UDPRelay(object):
         if not next_tick:
             if self._eventloop:
                 self._eventloop.remove_periodic(self.handle_periodic)
-                self._eventloop.remove(self._server_socket)
+            self.stop_listening()
             self._server_socket.close()
-            self._cache.clear(0)
-            self._cache_dns_client.clear(0)
+            self._sessions.clear()
+
+
+def test_session_table():
+    closed = []
+    table = UDPSessionTable(2, 60, close_callback=closed.append, dns_size=1)
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+             for i in range(4)]
+    try:
+        a = UDPSession(('1.1.1.1', 1, 2), socks[0], None, ('1.1.1.1', 1), 2)
+        b = UDPSession(('1.1.1.1', 2, 2), socks[1], None, ('1.1.1.1', 2), 2)
+        c = UDPSession(('1.1.1.1', 3, 2), socks[2], None, ('1.1.1.1', 3), 2)
+        d = UDPSession(('1.1.1.1', 4, 2), socks[3], None, ('1.1.1.1', 4), 2,
+                       True)
+        table.add(a)
+        table.add(b)
+        table.add(d)
+        assert table.get(a.key) is a
+        assert table.get_by_fd(b.fd) is b
+        # a was used least recently
+        table.add(c)
+        assert closed == [a]
+        assert table.get(a.key) is None and not table.has_fd(a.fd)
+        assert len(table) == 3
+
+        b.last_activity -= 61
+        d.last_activity -= 11
+        assert table.sweep() == 2
+        assert closed == [a, b, d]
+        table.close(c)
+        assert len(table) == 0 and closed == [a, b, d, c]
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+if __name__ == '__main__':
+    test_session_table()
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# load a forbidden_ip file of random IPv4 and IPv6 prefixes and time lookups
+# of random addresses against it, next to the linear scan over
+# (network, prefix size) pairs IPNetwork used to do, which is only run for
+# the smaller sizes
+#
+# usage: python tests/bench_forbidden_ip.py [prefixes ...]
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import time
+import random
+import socket
+import struct
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shadowsocks import common
+
+LOOKUPS = 100000
+LINEAR_MAX = 10000
+
+
+def random_v4():
+    return socket.inet_ntoa(struct.pack('!I', random.getrandbits(32)))
+
+
+def random_v6():
+    return socket.inet_ntop(socket.AF_INET6,
+                            struct.pack('!QQ', random.getrandbits(64),
+                                        random.getrandbits(64)))
+
+
+def write_prefixes(path, n):
+    # three quarters IPv4, mostly long prefixes like an abuse feed
+    with open(path, 'w') as f:
+        for i in range(n):
+            if i % 4:
+                f.write('%s/%d\n' % (random_v4(), random.randint(16, 32)))
+            else:
+                f.write('%s/%d\n' % (random_v6(), random.randint(32, 128)))
+
+
+def linear_contains(networks, addr):
+    addr_family = common.is_ip(addr)
+    if addr_family is socket.AF_INET:
+        ip, = struct.unpack('!I', socket.inet_aton(addr))
+    else:
+        hi, lo = struct.unpack('!QQ', common.inet_pton(addr_family, addr))
+        ip = (hi << 64) | lo
+    return any(map(lambda n_ps: n_ps[0] == ip >> n_ps[1],
+                   networks[addr_family]))
+
+
+def linear_networks(path):
+    networks = {socket.AF_INET: [], socket.AF_INET6: []}
+    with open(path) as f:
+        for line in f:
+            addr, prefix = line.strip().split('/')
+            addr_family = common.is_ip(addr)
+            prefix_size = common.IPNetwork.ADDRLENGTH[addr_family] - \
+                int(prefix)
+            if addr_family is socket.AF_INET:
+                ip, = struct.unpack('!I', socket.inet_aton(addr))
+            else:
+                hi, lo = struct.unpack('!QQ',
+                                       common.inet_pton(addr_family, addr))
+                ip = (hi << 64) | lo
+            networks[addr_family].append((ip >> prefix_size, prefix_size))
+    return networks
+
+
+def bench(n, addrs):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        write_prefixes(path, n)
+        start = time.time()
+        ip_network = common.IPNetwork('')
+        ip_network.add_file(path)
+        load = time.time() - start
+        start = time.time()
+        hits = sum(1 for addr in addrs if addr in ip_network)
+        lookup = time.time() - start
+        print('%8d prefixes  load %7.2f s  lookup %7.1f us  %d hits' %
+              (n, load, lookup * 1e6 / len(addrs), hits))
+        if n <= LINEAR_MAX:
+            networks = linear_networks(path)
+            sample = addrs[:len(addrs) // 10]
+            start = time.time()
+            linear_hits = sum(1 for addr in sample
+                              if linear_contains(networks, addr))
+            lookup = time.time() - start
+            assert linear_hits == sum(1 for addr in sample
+                                      if addr in ip_network)
+            print('%8s linear scan      lookup %7.1f us' %
+                  ('', lookup * 1e6 / len(sample)))
+    finally:
+        os.unlink(path)
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+    addrs = [random_v4() if i % 4 else random_v6() for i in range(LOOKUPS)]
+    for n in sizes:
+        bench(n, addrs)
+
+
+if __name__ == '__main__':
+    main()
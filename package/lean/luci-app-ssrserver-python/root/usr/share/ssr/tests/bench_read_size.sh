@@ -0,0 +1,53 @@
+#!/bin/bash
+
+# download a large file through sslocal and ssserver once per
+# read_size_policy, print the throughput and, if strace is installed, the
+# syscalls the server made
+#
+# usage: tests/bench_read_size.sh [url]
+
+PYTHON=${PYTHON:-python}
+URL=${1:-http://127.0.0.1/file}
+
+mkdir -p tmp
+
+for POLICY in peek fionread adaptive; do
+    cat > tmp/read_size.json <<EOF
+{
+    "server": "127.0.0.1",
+    "server_port": 8388,
+    "local_port": 1081,
+    "password": "aes_password",
+    "timeout": 60,
+    "method": "aes-256-cfb",
+    "protocol": "auth_aes128_md5",
+    "obfs": "http_simple",
+    "local_address": "127.0.0.1",
+    "fast_open": false,
+    "read_size_policy": "$POLICY"
+}
+EOF
+
+    $PYTHON shadowsocks/local.py -c tmp/read_size.json &
+    LOCAL=$!
+    if command -v strace > /dev/null; then
+        strace -c -f -o tmp/strace-$POLICY.txt \
+            $PYTHON shadowsocks/server.py -c tmp/read_size.json --forbidden-ip "" &
+    else
+        $PYTHON shadowsocks/server.py -c tmp/read_size.json --forbidden-ip "" &
+    fi
+    SERVER=$!
+
+    sleep 3
+
+    SPEED=$(curl -s -o /dev/null -w '%{speed_download}' --socks5-hostname 127.0.0.1:1081 $URL)
+
+    kill -s SIGINT $LOCAL
+    kill -s SIGINT $SERVER
+    wait $SERVER
+
+    echo "$POLICY: $SPEED bytes/s"
+    if [ -f tmp/strace-$POLICY.txt ]; then
+        grep -E 'calls|recvfrom|ioctl|sendto|epoll_wait|total' tmp/strace-$POLICY.txt
+    fi
+done
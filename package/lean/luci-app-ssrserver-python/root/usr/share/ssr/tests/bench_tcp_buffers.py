@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# relay data from a fast source to a slow peer the way TCPRelayHandler
+# does, once with fresh bytes per recv and a joined list as write queue
+# (the old handler) and once with pooled recv_into buffers and a WriteQueue
+# tracemalloc's peak is reset before every step, the sum of the per step
+# peaks approximates the bytes allocated while relaying
+#
+# usage: python3 tests/bench_tcp_buffers.py [megabytes]
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import time
+import socket
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shadowsocks import buffer_pool
+
+BUF_SIZE = 32 * 1024
+PEER_READ = 16 * 1024
+
+
+def make_pipes():
+    feeder, src = socket.socketpair()
+    dst, peer = socket.socketpair()
+    for s in (feeder, src, dst, peer):
+        s.setblocking(False)
+    dst.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16 * 1024)
+    return feeder, src, dst, peer
+
+
+def feed(feeder, payload):
+    try:
+        feeder.send(payload)
+    except socket.error:
+        pass
+
+
+def drain(peer, sink):
+    try:
+        return peer.recv_into(sink, PEER_READ)
+    except socket.error:
+        return 0
+
+
+class OldRelay(object):
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.pending = []
+
+    def send(self, data):
+        try:
+            s = self.dst.send(data)
+        except socket.error:
+            s = 0
+        if s < len(data):
+            self.pending.append(data[s:])
+
+    def step(self):
+        if self.pending:
+            data = b''.join(self.pending)
+            self.pending = []
+            self.send(data)
+            return
+        try:
+            data = self.src.recv(BUF_SIZE)
+        except socket.error:
+            return
+        self.send(data)
+
+
+class NewRelay(object):
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.pool = buffer_pool.BufferPool(BUF_SIZE + 64)
+        self.queue = buffer_pool.WriteQueue(self.pool)
+
+    def step(self):
+        if self.queue:
+            self.queue.write_to(self.dst)
+            return
+        buf = self.pool.get()
+        try:
+            l = self.src.recv_into(buf, BUF_SIZE)
+        except socket.error:
+            self.pool.put(buf)
+            return
+        self.queue.append(memoryview(buf)[:l])
+        self.queue.write_to(self.dst)
+
+
+def run(relay_class, total):
+    feeder, src, dst, peer = make_pipes()
+    payload = memoryview(os.urandom(BUF_SIZE))
+    sink = bytearray(PEER_READ)
+    relay = relay_class(src, dst)
+    received = 0
+    allocated = 0
+    tracemalloc.start()
+    start = time.time()
+    while received < total:
+        feed(feeder, payload)
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        relay.step()
+        allocated += tracemalloc.get_traced_memory()[1] - current
+        received += drain(peer, sink)
+    elapsed = time.time() - start
+    tracemalloc.stop()
+    for s in (feeder, src, dst, peer):
+        s.close()
+    return allocated, elapsed
+
+
+def main():
+    mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    total = mb * 1024 * 1024
+    print('relaying %d MB to a slow peer' % mb)
+    for name, relay_class in (('bytes + list', OldRelay),
+                              ('pool + WriteQueue', NewRelay)):
+        allocated, elapsed = run(relay_class, total)
+        print('%-18s %10.0f bytes allocated/MB %8.2f s' %
+              (name, allocated / mb, elapsed))
+
+
+if __name__ == '__main__':
+    main()
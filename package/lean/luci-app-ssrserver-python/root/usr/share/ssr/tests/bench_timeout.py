@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# compare the per packet cost of refreshing an idle timeout with the old
+# LRUCache path and with the timing wheel, and the cost of a sweep
+#
+# usage: python tests/bench_timeout.py [connections] [packets]
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shadowsocks import lru_cache, timing_wheel
+
+
+class Conn(object):
+    def __init__(self):
+        self.last_activity = 0
+
+
+def bench_lru(conns, order):
+    cache = lru_cache.LRUCache(timeout=300)
+    for c in conns:
+        cache[hash(c)] = c
+    start = time.time()
+    for i in order:
+        c = conns[i]
+        cache[hash(c)] = c
+    refresh = time.time() - start
+    start = time.time()
+    cache.sweep()
+    return refresh, time.time() - start
+
+
+def bench_wheel(conns, order):
+    wheel = timing_wheel.TimingWheel(timeout=300)
+    now = time.time()
+    for c in conns:
+        c.last_activity = now
+        wheel.add(hash(c), c)
+    start = time.time()
+    for i in order:
+        conns[i].last_activity = now
+    refresh = time.time() - start
+    start = time.time()
+    wheel.sweep(now + 2)
+    return refresh, time.time() - start
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    packets = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    conns = [Conn() for i in range(n)]
+    order = [random.randrange(n) for i in range(packets)]
+    print('%d connections, %d packets' % (n, packets))
+    for name, bench in (('lru_cache', bench_lru), ('timing_wheel', bench_wheel)):
+        refresh, sweep = bench(conns, order)
+        print('%-14s refresh %7.1f ns/packet  sweep %8.3f ms' %
+              (name, refresh * 1e9 / packets, sweep * 1e3))
+
+
+if __name__ == '__main__':
+    main()
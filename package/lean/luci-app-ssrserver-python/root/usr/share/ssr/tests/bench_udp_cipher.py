@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# packets/sec of per datagram encryption as UDPRelay does it, with a new
+# cipher per packet and with a reused context from a cipher cache
+#
+# usage: python tests/bench_udp_cipher.py [packets] [size]
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shadowsocks import encrypt
+
+METHODS = ['aes-128-ctr', 'aes-256-cfb', 'chacha20']
+
+
+def bench(method, packets, size, cipher_cache):
+    key = encrypt.encrypt_key(b'key', method)
+    data = os.urandom(size)
+    ivs = [encrypt.encrypt_new_iv(method) for i in range(256)]
+    start = time.time()
+    for i in range(packets):
+        ref_iv = [ivs[i & 255]]
+        encrypt.encrypt_all_iv(key, method, 1, data, ref_iv, cipher_cache)
+    return packets / (time.time() - start)
+
+
+def main():
+    packets = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1400
+    print('%d packets of %d bytes' % (packets, size))
+    for method in METHODS:
+        try:
+            before = bench(method, packets, size, None)
+            after = bench(method, packets, size, {})
+        except Exception as e:
+            print('%-12s skipped: %s' % (method, e))
+            continue
+        print('%-12s new cipher %9.0f pkts/s  reused %9.0f pkts/s  x%.2f' %
+              (method, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()